@@ -0,0 +1,97 @@
+"""
+File: benchmarks/bench_fair_scheduler.py
+Mục đích: Đo thời gian chờ của các Page nhỏ khi 1 Page "viral" dồn hàng nghìn
+job vào hàng đợi, với JobQueue + FairScheduler (deficit round-robin)
+
+Page viral enqueue trước toàn bộ job của nó, sau đó mỗi Page nhỏ enqueue vài
+job. Với hàng đợi FIFO cũ, job của Page nhỏ phải chờ toàn bộ job viral
+(ước tính in ở cuối để so sánh).
+
+Cách chạy (từ thư mục python/):
+    python benchmarks/bench_fair_scheduler.py
+    python benchmarks/bench_fair_scheduler.py --viral-jobs 2000 --workers 50 --cap 25
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# DB tạm, phải set trước khi import database
+os.environ["PYTHON_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench_fair_"), "bench.sqlite")
+
+from database import ensure_schema  # noqa: E402
+from job_queue import JobQueue, FairScheduler  # noqa: E402
+
+VIRAL_PAGE = "viral_page"
+
+
+async def run(args) -> dict:
+    done = asyncio.Event()
+    total = args.viral_jobs + args.pages * args.page_jobs
+    finished = 0
+
+    async def handler(
+        sender_id: str, page_id: str, image_url: str, message_id: Optional[str] = None, job_id: Optional[int] = None
+    ):
+        nonlocal finished
+        await asyncio.sleep(args.job_ms / 1000)
+        finished += 1
+        if finished >= total:
+            done.set()
+
+    queue = JobQueue(
+        handler=handler,
+        num_workers=args.workers,
+        poll_interval=0.05,
+        scheduler=FairScheduler(default_max_concurrency=args.cap),
+    )
+
+    for i in range(args.viral_jobs):
+        queue.enqueue(f"user{i}", VIRAL_PAGE, "http://example/img.jpg")
+    for p in range(args.pages):
+        for i in range(args.page_jobs):
+            queue.enqueue(f"user{i}", f"shop_{p}", "http://example/img.jpg")
+
+    queue.start()
+    await asyncio.wait_for(done.wait(), timeout=600)
+    await queue.adrain(5)
+    return queue.scheduler.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fair per-page job scheduling")
+    parser.add_argument("--viral-jobs", type=int, default=1000)
+    parser.add_argument("--pages", type=int, default=10, help="Số Page nhỏ")
+    parser.add_argument("--page-jobs", type=int, default=3, help="Số job mỗi Page nhỏ")
+    parser.add_argument("--workers", type=int, default=20)
+    parser.add_argument("--job-ms", type=float, default=50, help="Thời gian xử lý 1 job (ms)")
+    parser.add_argument("--cap", type=int, default=0,
+                        help="Số job đồng thời tối đa mỗi Page (0 = không giới hạn)")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"🔬 Benchmark Fair Scheduler ({args.viral_jobs} job viral, {args.pages} Page nhỏ x "
+          f"{args.page_jobs} job, {args.workers} worker, {args.job_ms:g}ms/job, cap={args.cap})")
+    print("=" * 60)
+
+    ensure_schema()
+    stats = asyncio.run(run(args))
+
+    pages = stats["pages"]
+    viral = pages.pop(VIRAL_PAGE)
+    small_p95 = max(p["p95_wait_ms"] for p in pages.values())
+    small_max = max(p["max_wait_ms"] for p in pages.values())
+    fifo_estimate = args.viral_jobs * args.job_ms / args.workers
+
+    print(f"  Page viral : avg={viral['avg_wait_ms']}ms  p95={viral['p95_wait_ms']}ms  max={viral['max_wait_ms']}ms")
+    print(f"  Page nhỏ   : p95 (tệ nhất)={small_p95}ms  max={small_max}ms")
+    print(f"  FIFO cũ    : Page nhỏ chờ ước tính ~{fifo_estimate:.0f}ms")
+    print(f"  capped_skips={stats['capped_skips']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+File: benchmarks/bench_http_sessions.py
+Mục đích: Đo độ trễ p50/p95 khi gọi HTTP không có Session (mở kết nối mới mỗi lần)
+so với HTTP session keep-alive dùng chung (http_clients.http_pool)
+
+Cách chạy (từ thư mục python/):
+    python benchmarks/bench_http_sessions.py
+    python benchmarks/bench_http_sessions.py --url https://graph.facebook.com/v18.0/ -n 50
+
+Mặc định gọi vào graph.facebook.com (host của Send API); 1 lần gọi không token
+trả về 4xx nhưng vẫn đo đúng chi phí kết nối TCP/TLS.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+from http_clients import http_pool  # noqa: E402
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _measure(fn, url, n):
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        try:
+            fn(url)
+        except requests.RequestException as e:
+            print(f"   ⚠️ Lỗi request: {e}")
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def run(url: str, n: int) -> dict:
+    def fresh(u):
+        # Giống code cũ: requests.get ở module level, không Session
+        requests.get(u, timeout=10).content
+
+    def pooled(u):
+        http_pool.get(u).content
+
+    # Warm-up: lần đầu của pooled mở kết nối, không tính
+    pooled(url)
+
+    results = {}
+    for name, fn in (("fresh_connection", fresh), ("shared_session", pooled)):
+        latencies = _measure(fn, url, n)
+        if not latencies:
+            continue
+        results[name] = {
+            "n": len(latencies),
+            "p50_ms": round(statistics.median(latencies), 2),
+            "p95_ms": round(_percentile(latencies, 95), 2),
+            "mean_ms": round(statistics.mean(latencies), 2),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark HTTP keep-alive sessions")
+    parser.add_argument("--url", default="https://graph.facebook.com/v18.0/")
+    parser.add_argument("-n", type=int, default=30, help="Số request mỗi chế độ")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"🔬 Benchmark HTTP sessions: {args.url} (n={args.n})")
+    print("=" * 60)
+
+    results = run(args.url, args.n)
+    for name, r in results.items():
+        print(f"  {name:18s} p50={r['p50_ms']:8.2f}ms  p95={r['p95_ms']:8.2f}ms  mean={r['mean_ms']:8.2f}ms")
+
+    if "fresh_connection" in results and "shared_session" in results:
+        saved = results["fresh_connection"]["p50_ms"] - results["shared_session"]["p50_ms"]
+        print(f"\n✅ p50 tiết kiệm được: {saved:.2f}ms mỗi request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+File: benchmarks/bench_image_preprocess.py
+Mục đích: Đo dung lượng payload base64 và thời gian xử lý ảnh trước/sau
+image_preprocess.prepare_image (thu nhỏ + nén lại)
+
+Cách chạy (từ thư mục python/):
+    python benchmarks/bench_image_preprocess.py --dir ../samples/invoices
+    python benchmarks/bench_image_preprocess.py            # dùng ảnh tổng hợp 4032x3024
+"""
+
+import argparse
+import base64
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import settings  # noqa: E402
+from image_preprocess import prepare_image, PILLOW_AVAILABLE  # noqa: E402
+
+_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def load_images(path: str):
+    images = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith(_EXTENSIONS):
+            with open(os.path.join(path, name), "rb") as f:
+                images.append((name, f.read()))
+    return images
+
+
+def synthetic_images(count: int = 3):
+    """Ảnh giống ảnh chụp điện thoại 12MP: nền nhiễu + chữ (để JPEG không nén quá dễ)"""
+    from PIL import Image, ImageDraw
+
+    images = []
+    for i in range(count):
+        img = Image.effect_noise((4032, 3024), 40 + i * 10).convert("RGB")
+        draw = ImageDraw.Draw(img)
+        for row in range(60):
+            draw.text((200, 100 + row * 45), f"Mon {row:02d} ........ {row * 1000 + 500:,}d", fill=(0, 0, 0))
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=92)
+        images.append((f"synthetic_{i}.jpg", buffer.getvalue()))
+    return images
+
+
+def run(images) -> dict:
+    rows = []
+    for name, data in images:
+        start = time.perf_counter()
+        prepared = prepare_image(data)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        rows.append({
+            "name": name,
+            "original_b64": len(base64.b64encode(data)),
+            "prepared_b64": len(base64.b64encode(prepared.data)),
+            "ms": elapsed_ms,
+        })
+
+    original = sum(r["original_b64"] for r in rows)
+    prepared = sum(r["prepared_b64"] for r in rows)
+    latencies = [r["ms"] for r in rows]
+    return {
+        "rows": rows,
+        "images": len(rows),
+        "original_b64_kb": round(original / 1024, 1),
+        "prepared_b64_kb": round(prepared / 1024, 1),
+        "saved_pct": round(100 * (1 - prepared / original), 1) if original else 0.0,
+        "p50_ms": round(statistics.median(latencies), 1) if latencies else None,
+        "max_ms": round(max(latencies), 1) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark image preprocessing")
+    parser.add_argument("--dir", help="Thư mục ảnh hóa đơn mẫu")
+    args = parser.parse_args()
+
+    if not PILLOW_AVAILABLE:
+        print("❌ Chưa cài Pillow (pip install Pillow)")
+        return
+
+    images = load_images(args.dir) if args.dir else synthetic_images()
+
+    print("=" * 60)
+    print(f"🔬 Benchmark Image Preprocess ({len(images)} ảnh, max_side={settings.image_max_side}, "
+          f"{settings.image_format} q={settings.image_quality})")
+    print("=" * 60)
+
+    result = run(images)
+    for r in result["rows"]:
+        print(f"  {r['name']:24s} {r['original_b64'] / 1024:9.1f}KB -> {r['prepared_b64'] / 1024:8.1f}KB  {r['ms']:7.1f}ms")
+    print(f"\n✅ Payload base64: {result['original_b64_kb']}KB -> {result['prepared_b64_kb']}KB "
+          f"(-{result['saved_pct']}%), xử lý p50={result['p50_ms']}ms max={result['max_ms']}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+File: benchmarks/bench_prize_inventory.py
+Mục đích: Kiểm tra giới hạn số lượng giải (prize_inventory) khi hàng trăm lượt
+quay đồng thời trên CÙNG 1 Page: số giải có "limit" được phát ra phải đúng bằng
+limit, không hơn không kém
+
+Mỗi hóa đơn được gửi 2 lần song song (như user gửi lại ảnh), chạy qua
+InvoiceService.claim_and_draw + _spin_lucky_wheel giống lucky_draw_node trên
+1 file SQLite tạm. Lỗi DB (database is locked...) được thử lại như JobQueue.
+Kiểm tra:
+- Số lần phát mỗi giải có limit == limit (khi số lượt quay đủ lớn để hết suất)
+- Cột used trong bảng prize_inventory == limit
+- Mỗi hóa đơn chỉ được quay đúng 1 lần
+
+Exit code 1 nếu có kiểm tra sai.
+
+Cách chạy (từ thư mục python/):
+    python benchmarks/bench_prize_inventory.py
+    python benchmarks/bench_prize_inventory.py --spins 1000 --threads 64 --limit 100
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# DB tạm + tắt log, phải set trước khi import database
+os.environ["PYTHON_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench_inventory_"), "bench.sqlite")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+from database import SessionLocal, ensure_schema  # noqa: E402
+from nodes import _spin_lucky_wheel  # noqa: E402
+from services import InvoiceService  # noqa: E402
+
+PAGE_ID = "bench_inventory_page"
+MAX_RETRIES = 20
+
+
+def build_prizes(limit: int) -> list:
+    """2 giải có giới hạn chiếm phần lớn tỉ lệ + 1 giải không giới hạn"""
+    return [
+        {"name": "Voucher 50k", "rate": 0.6, "limit": limit, "period": "day"},
+        {"name": "Voucher 20k", "rate": 0.3, "limit": max(1, limit // 2), "period": "total"},
+        {"name": "Chúc may mắn lần sau", "rate": 0.1},
+    ]
+
+
+def run(spins: int, threads: int, limit: int) -> dict:
+    ensure_schema()
+    prizes = build_prizes(limit)
+    tenant = {"id": PAGE_ID, "version": "bench-v1"}
+
+    lock = threading.Lock()
+    won = Counter()
+    duplicates = 0
+    retries = 0
+    errors = 0
+
+    def submit(invoice_id: str):
+        nonlocal duplicates, retries, errors
+        for attempt in range(MAX_RETRIES):
+            try:
+                prize = InvoiceService.claim_and_draw(
+                    invoice_id, PAGE_ID, f"user_{invoice_id}",
+                    draw=lambda db: _spin_lucky_wheel(tenant, prizes, db),
+                )
+            except OperationalError:
+                with lock:
+                    retries += 1
+                time.sleep(0.01 * (attempt + 1))
+                continue
+            with lock:
+                if prize is None:
+                    duplicates += 1
+                else:
+                    won[prize["name"]] += 1
+            return
+        with lock:
+            errors += 1
+
+    # Mỗi hóa đơn gửi 2 lần, xen kẽ để 2 bản chạy gần như cùng lúc
+    invoice_ids = [f"HD-{i:06d}" for i in range(spins) for _ in range(2)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(submit, invoice_ids))
+    elapsed = time.perf_counter() - start
+
+    db = SessionLocal()
+    try:
+        used = {
+            row.prize_key: row.used
+            for row in db.execute(
+                text("SELECT prize_key, used FROM prize_inventory WHERE page_id = :page_id"),
+                {"page_id": PAGE_ID},
+            )
+        }
+        claimed = db.execute(
+            text("SELECT COUNT(*) FROM invoice WHERE page_id = :page_id"), {"page_id": PAGE_ID}
+        ).scalar()
+    finally:
+        db.close()
+
+    return {
+        "prizes": prizes,
+        "won": dict(won),
+        "used": used,
+        "claimed": claimed,
+        "duplicates": duplicates,
+        "retries": retries,
+        "errors": errors,
+        "elapsed": elapsed,
+    }
+
+
+def check(result: dict, spins: int) -> list:
+    """Danh sách lỗi (rỗng = đúng)"""
+    failures = []
+    for prize in result["prizes"]:
+        cap = prize.get("limit")
+        if cap is None:
+            continue
+        name = prize["name"]
+        handed = result["won"].get(name, 0)
+        if handed != cap:
+            failures.append(f"{name}: phát {handed} suất, limit {cap}")
+        if result["used"].get(name) != cap:
+            failures.append(f"{name}: prize_inventory.used={result['used'].get(name)}, limit {cap}")
+    total_won = sum(result["won"].values())
+    if result["claimed"] != spins or total_won != spins:
+        failures.append(f"{spins} hóa đơn nhưng claim {result['claimed']}, quay {total_won}")
+    if result["duplicates"] != spins:
+        failures.append(f"{spins} bản gửi trùng nhưng chỉ {result['duplicates']} bị từ chối")
+    if result["errors"]:
+        failures.append(f"{result['errors']} lượt lỗi DB sau {MAX_RETRIES} lần thử")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrency check for limited prizes")
+    parser.add_argument("--spins", type=int, default=400, help="Số hóa đơn (mỗi hóa đơn gửi 2 lần)")
+    parser.add_argument("--threads", type=int, default=32, help="Số lượt quay đồng thời")
+    parser.add_argument("--limit", type=int, default=50, help="limit của giải chính")
+    args = parser.parse_args()
+
+    if args.spins < 2 * args.limit:
+        parser.error("--spins phải >= 2 x --limit để mọi giải có giới hạn chắc chắn hết suất")
+
+    print("=" * 60)
+    print(f"🔬 Prize Inventory ({args.spins} hóa đơn x2, {args.threads} thread, limit={args.limit})")
+    print("=" * 60)
+
+    result = run(args.spins, args.threads, args.limit)
+    for prize in result["prizes"]:
+        name = prize["name"]
+        cap = prize.get("limit")
+        print(f"  {name:24s} phát={result['won'].get(name, 0):>5}  limit={cap if cap is not None else '-':>5}  "
+              f"used={result['used'].get(name, '-')}")
+    print(f"\n  claim={result['claimed']}  trùng bị từ chối={result['duplicates']}  "
+          f"retry DB={result['retries']}  {result['elapsed']:.2f}s")
+
+    failures = check(result, args.spins)
+    if failures:
+        for failure in failures:
+            print(f"  ❌ {failure}")
+        sys.exit(1)
+    print("  ✅ Số giải phát ra đúng bằng limit, mỗi hóa đơn quay đúng 1 lần")
+
+
+if __name__ == "__main__":
+    main()
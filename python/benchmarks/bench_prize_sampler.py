@@ -0,0 +1,122 @@
+"""
+File: benchmarks/bench_prize_sampler.py
+Mục đích: Kiểm định phân phối của prize_sampler.AliasSampler (chi-square)
+và so sánh tốc độ với vòng lặp cộng dồn cũ
+
+Cách chạy (từ thư mục python/):
+    python benchmarks/bench_prize_sampler.py
+    python benchmarks/bench_prize_sampler.py -n 5000000 --seed 42
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prize_sampler import AliasSampler  # noqa: E402
+
+# Cấu hình giải kiểu thường gặp: nhiều giải nhỏ, 1 giải lớn rất hiếm
+SAMPLE_PRIZES = [
+    {"name": "Chúc may mắn lần sau", "rate": 0.5},
+    {"name": "Voucher 10k", "rate": 0.25},
+    {"name": "Voucher 20k", "rate": 0.15},
+    {"name": "Voucher 50k", "rate": 0.07},
+    {"name": "Nước miễn phí", "rate": 0.029},
+    {"name": "Giải đặc biệt", "rate": 0.001},
+]
+
+
+def linear_scan(prizes, rng):
+    """Thuật toán cũ của _spin_lucky_wheel"""
+    rand = rng.random()
+    cumulative = 0.0
+    for prize in prizes:
+        cumulative += prize.get("rate", 0)
+        if rand < cumulative:
+            return prize
+    return prizes[-1]
+
+
+def chi_square_p_value(statistic: float, dof: int) -> float:
+    """p-value xấp xỉ (Wilson-Hilferty) - đủ dùng khi không có scipy"""
+    if dof <= 0:
+        return 1.0
+    z = ((statistic / dof) ** (1 / 3) - (1 - 2 / (9 * dof))) / math.sqrt(2 / (9 * dof))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def goodness_of_fit(prizes, n: int, seed: int) -> dict:
+    sampler = AliasSampler(prizes, rng=random.Random(seed))
+    counts = [0] * len(prizes)
+    for _ in range(n):
+        counts[sampler.draw_index()] += 1
+
+    statistic = 0.0
+    dof = -1
+    for observed, p in zip(counts, sampler.probabilities):
+        if p <= 0:
+            continue
+        expected = p * n
+        statistic += (observed - expected) ** 2 / expected
+        dof += 1
+
+    return {
+        "counts": counts,
+        "expected": [round(p * n, 1) for p in sampler.probabilities],
+        "chi2": round(statistic, 3),
+        "dof": dof,
+        "p_value": round(chi_square_p_value(statistic, dof), 4),
+    }
+
+
+def throughput(prizes, n: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    for _ in range(n):
+        linear_scan(prizes, rng)
+    linear = time.perf_counter() - start
+
+    sampler = AliasSampler(prizes, rng=random.Random(seed))
+    start = time.perf_counter()
+    for _ in range(n):
+        sampler.draw()
+    alias = time.perf_counter() - start
+
+    return {
+        "linear_ns_per_draw": round(linear / n * 1e9, 1),
+        "alias_ns_per_draw": round(alias / n * 1e9, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark / chi-square test for prize sampler")
+    parser.add_argument("-n", type=int, default=1_000_000, help="Số lượt quay")
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--prizes", type=int, default=0,
+                        help="Dùng N giải rate đều thay cho bộ giải mẫu (đo tốc độ theo số giải)")
+    args = parser.parse_args()
+
+    prizes = SAMPLE_PRIZES
+    if args.prizes:
+        prizes = [{"name": f"Giải {i}", "rate": 1 / args.prizes} for i in range(args.prizes)]
+
+    print("=" * 60)
+    print(f"🔬 Benchmark Prize Sampler ({len(prizes)} giải, {args.n:,} lượt quay, seed={args.seed})")
+    print("=" * 60)
+
+    fit = goodness_of_fit(prizes, args.n, args.seed)
+    for prize, observed, expected in zip(prizes, fit["counts"], fit["expected"]):
+        print(f"  {prize['name'][:24]:24s} observed={observed:>10,}  expected={expected:>12,.1f}")
+    verdict = "✅ khớp phân phối" if fit["p_value"] >= 0.001 else "❌ lệch phân phối"
+    print(f"\n  chi2={fit['chi2']} dof={fit['dof']} p={fit['p_value']} -> {verdict}")
+
+    speed = throughput(prizes, min(args.n, 1_000_000), args.seed)
+    print(f"  linear scan: {speed['linear_ns_per_draw']}ns/lượt, alias: {speed['alias_ns_per_draw']}ns/lượt")
+
+
+if __name__ == "__main__":
+    main()
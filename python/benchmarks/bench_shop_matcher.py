@@ -0,0 +1,114 @@
+"""
+File: benchmarks/bench_shop_matcher.py
+Mục đích: Đo throughput của matcher tên quán local + extractor mã hóa đơn
+và tỉ lệ đồng thuận với LLM
+
+Corpus là file JSONL do validate_invoice_node ghi ra khi đặt
+VALIDATION_CORPUS_PATH (nên bật thêm SHOP_MATCH_SHADOW=true để LLM chấm cả
+những mẫu matcher đã tự quyết). Mỗi dòng gồm ocr_text, shop_patterns, llm_valid (+ llm_invoice_id nếu có).
+
+Cách chạy (từ thư mục python/):
+    python benchmarks/bench_shop_matcher.py --corpus ../data/validation_corpus.jsonl
+    python benchmarks/bench_shop_matcher.py            # dùng vài mẫu dựng sẵn
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import settings  # noqa: E402
+from shop_matcher import match_shop  # noqa: E402
+from invoice_extractor import extract_invoice_fields  # noqa: E402
+
+# Mẫu dựng sẵn theo các ví dụ trong prompt validate
+SAMPLE_CORPUS = [
+    {"ocr_text": "NHÀ HÀNG EM AN TINH NGHỊCH\n12 Lê Lợi, Q1\nSố HĐ: 001", "shop_patterns": ["Em An Tinh Nghịch"], "llm_valid": True, "llm_invoice_id": "001"},
+    {"ocr_text": "QUÁN EM AN TĨNH NGHỊCH\nHotline 0909\nBill: 88", "shop_patterns": ["Em An Tinh Nghịch"], "llm_valid": True},
+    {"ocr_text": "Nhà hàng Soma Tea\n45 Hai Bà Trưng\nSố: 12", "shop_patterns": ["Em An Tinh Nghịch"], "llm_valid": False},
+    {"ocr_text": "CIRCLE K VIETNAM\nStore #1023\n26/01/2026 19:45\nTotal 45.360", "shop_patterns": ["Circle K", "WinMart"], "llm_valid": True, "llm_invoice_id": "260126-1945-45K"},
+    {"ocr_text": "Highlands Coffee\nPhiếu thanh toán\n#A12", "shop_patterns": ["Phúc Long"], "llm_valid": False},
+    {"ocr_text": "PHUC LONG COFFEE & TEA\n23 Ngô Đức Kế\nMã HĐ: PL-77", "shop_patterns": ["Phúc Long"], "llm_valid": True, "llm_invoice_id": "PL-77"},
+]
+
+
+def load_corpus(path: str):
+    samples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                samples.append(json.loads(line))
+    return samples
+
+
+def run(samples, repeat: int = 200) -> dict:
+    decisions = {"accept": 0, "reject": 0, "uncertain": 0}
+    agree = 0
+    decided = 0
+    confusion = {}
+    id_total = 0
+    id_agree = 0
+    fast_path = 0
+
+    for s in samples:
+        patterns = s.get("shop_patterns") or [s.get("shop_name") or ""]
+        m = match_shop(s["ocr_text"], patterns, settings.shop_match_accept, settings.shop_match_reject)
+        decisions[m.decision] += 1
+        key = f"{m.decision}/llm_{'valid' if s['llm_valid'] else 'invalid'}"
+        confusion[key] = confusion.get(key, 0) + 1
+        if m.decision != "uncertain":
+            decided += 1
+            if (m.decision == "accept") == bool(s["llm_valid"]):
+                agree += 1
+
+        fields = extract_invoice_fields(s["ocr_text"])
+        if m.decision == "reject" or (m.decision == "accept" and fields.certain):
+            fast_path += 1
+        if s.get("llm_valid") and s.get("llm_invoice_id"):
+            id_total += 1
+            if (fields.invoice_id or "").lower() == str(s["llm_invoice_id"]).lower():
+                id_agree += 1
+
+    # Throughput
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for s in samples:
+            match_shop(s["ocr_text"], s.get("shop_patterns") or [s.get("shop_name") or ""])
+            extract_invoice_fields(s["ocr_text"])
+    elapsed = time.perf_counter() - start
+    calls = repeat * len(samples)
+
+    return {
+        "samples": len(samples),
+        "decisions": decisions,
+        "local_coverage": round(decided / len(samples), 4) if samples else 0.0,
+        "agreement_on_decided": round(agree / decided, 4) if decided else None,
+        "confusion": confusion,
+        "invoice_id_agreement": round(id_agree / id_total, 4) if id_total else None,
+        "no_network_validation_rate": round(fast_path / len(samples), 4) if samples else 0.0,
+        "matches_per_sec": round(calls / elapsed, 1) if elapsed else None,
+        "us_per_match": round(elapsed / calls * 1e6, 2) if calls else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark local shop-name matcher")
+    parser.add_argument("--corpus", help="File JSONL ghi bởi VALIDATION_CORPUS_PATH")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    samples = load_corpus(args.corpus) if args.corpus else SAMPLE_CORPUS
+
+    print("=" * 60)
+    print(f"🔬 Benchmark Shop Matcher ({len(samples)} mẫu, "
+          f"accept>={settings.shop_match_accept}, reject<{settings.shop_match_reject})")
+    print("=" * 60)
+    print(json.dumps(run(samples, args.repeat), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
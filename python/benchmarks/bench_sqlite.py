@@ -0,0 +1,141 @@
+"""
+File: benchmarks/bench_sqlite.py
+Mục đích: So sánh throughput ghi/đọc hóa đơn của SQLite cấu hình mặc định
+(rollback journal, synchronous=FULL) với cấu hình của database.build_engine
+(WAL, synchronous=NORMAL, busy_timeout, mmap, cache_size)
+
+Mỗi writer ghi 1 hóa đơn + cập nhật thống kê tenant trong 1 transaction
+(giống InvoiceService.mark_invoice_used), reader tra hóa đơn theo id
+(giống is_invoice_used), chạy song song trong thời gian cố định.
+
+Cách chạy (từ thư mục python/):
+    python benchmarks/bench_sqlite.py
+    python benchmarks/bench_sqlite.py --writers 8 --readers 8 --seconds 10
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+from database import Base, build_engine  # noqa: E402
+
+PAGE_ID = "bench_page"
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _seed(engine):
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO tenant (id, shop_name, is_active, totalSpins, totalPrizes, totalUsers) "
+                 "VALUES (:id, 'Bench', 1, 0, 0, 0)"),
+            {"id": PAGE_ID},
+        )
+
+
+def run_mode(name: str, pragmas, writers: int, readers: int, seconds: float) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bench_sqlite_")
+    engine = build_engine(f"sqlite:///{os.path.join(workdir, 'bench.sqlite')}", pragmas=pragmas)
+    _seed(engine)
+
+    ids = []
+    ids_lock = threading.Lock()
+    write_latencies, read_latencies = [], []
+    errors = {"write": 0, "read": 0}
+    stop_at = time.perf_counter() + seconds
+
+    def writer():
+        while time.perf_counter() < stop_at:
+            invoice_id = uuid.uuid4().hex
+            start = time.perf_counter()
+            try:
+                with engine.begin() as conn:
+                    conn.execute(
+                        text("INSERT INTO invoice (id, page_id, sender_id, prize_won, created_at) "
+                             "VALUES (:id, :page, 'S', 'Voucher', CURRENT_TIMESTAMP)"),
+                        {"id": invoice_id, "page": PAGE_ID},
+                    )
+                    conn.execute(
+                        text("UPDATE tenant SET totalSpins = totalSpins + 1 WHERE id = :page"),
+                        {"page": PAGE_ID},
+                    )
+            except OperationalError:
+                errors["write"] += 1
+                continue
+            write_latencies.append((time.perf_counter() - start) * 1000)
+            with ids_lock:
+                ids.append(invoice_id)
+
+    def reader():
+        while time.perf_counter() < stop_at:
+            with ids_lock:
+                invoice_id = random.choice(ids) if ids else "missing"
+            start = time.perf_counter()
+            try:
+                with engine.connect() as conn:
+                    conn.execute(text("SELECT id FROM invoice WHERE id = :id"), {"id": invoice_id}).first()
+            except OperationalError:
+                errors["read"] += 1
+                continue
+            read_latencies.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with engine.connect() as conn:
+        journal_mode = conn.execute(text("PRAGMA journal_mode")).scalar()
+    engine.dispose()
+
+    return {
+        "mode": name,
+        "journal_mode": journal_mode,
+        "inserts_per_sec": round(len(write_latencies) / seconds, 1),
+        "lookups_per_sec": round(len(read_latencies) / seconds, 1),
+        "write_p50_ms": round(statistics.median(write_latencies), 2) if write_latencies else None,
+        "write_p95_ms": round(_percentile(write_latencies, 95), 2) if write_latencies else None,
+        "read_p95_ms": round(_percentile(read_latencies, 95), 2) if read_latencies else None,
+        "locked_errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SQLite engine settings")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"🔬 Benchmark SQLite ({args.writers} writers, {args.readers} readers, {args.seconds}s)")
+    print("=" * 60)
+
+    # {} = không set PRAGMA nào (giống engine cũ), None = cấu hình từ settings
+    for name, pragmas in (("default", {}), ("tuned", None)):
+        r = run_mode(name, pragmas, args.writers, args.readers, args.seconds)
+        print(f"  {r['mode']:8s} [{r['journal_mode']:6s}] insert={r['inserts_per_sec']:8.1f}/s  "
+              f"lookup={r['lookups_per_sec']:9.1f}/s  write p50={r['write_p50_ms']}ms "
+              f"p95={r['write_p95_ms']}ms  read p95={r['read_p95_ms']}ms  locked={r['locked_errors']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+File: benchmarks/run_benchmarks.py
+Mục đích: Bộ micro-benchmark cho các đường nóng thuần (không gọi mạng/LLM),
+lưu kết quả ra JSON để so sánh giữa các commit
+
+Các case:
+- webhook_*: json.loads body + main.parse_webhook_messages (phần parse của receive_message)
+- dedupe_*: MessageDeduper.seen (trúng ring trong RAM / message mới ghi SQLite)
+- spin_wheel_*: nodes._spin_lucky_wheel (giải không giới hạn / có limit -> trừ suất trong DB)
+- validate_parse_*: nodes._parse_validation_response (bóc code fence + json.loads)
+- tenant_*: TenantService.get_or_create_tenant (cache còn hạn / revalidate version / cache trống)
+- invoice_*: InvoiceService.is_invoice_used, InvoiceService.claim_and_draw
+
+DB là file SQLite tạm (PYTHON_DB_PATH), log tắt xuống WARNING để không đo chi phí ghi log.
+Mỗi case chạy `--repeat` vòng x `--number` lần, ghi median/min/p95 µs mỗi lần gọi
+của các vòng. Kết quả ghi vào benchmarks/results/<thời gian>-<commit>.json.
+
+Cách chạy (từ thư mục python/):
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --only tenant,invoice --repeat 10
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<file cũ>.json --threshold 15
+
+--compare in chênh lệch median so với file cũ và trả exit code 1 nếu có case
+chậm hơn quá --threshold % (dùng được trong CI).
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+# DB tạm + tắt log/trace, phải set trước khi import config
+os.environ["PYTHON_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench_hot_"), "bench.sqlite")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("LOG_FORMAT", "text")
+os.environ["TRACE_SAMPLE_RATE"] = "0"
+os.environ["VALIDATION_CORPUS_PATH"] = ""
+
+from dedupe import MessageDeduper  # noqa: E402
+from main import parse_webhook_messages  # noqa: E402
+from nodes import _parse_validation_response, _spin_lucky_wheel  # noqa: E402
+from services import InvoiceService, TenantService, tenant_cache  # noqa: E402
+
+PAGE_ID = "bench_page_0001"
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+SAMPLE_PRIZES = [
+    {"name": "Chúc may mắn lần sau", "rate": 0.5},
+    {"name": "Voucher 10k", "rate": 0.25},
+    {"name": "Voucher 20k", "rate": 0.15},
+    {"name": "Voucher 50k", "rate": 0.07},
+    {"name": "Nước miễn phí", "rate": 0.029},
+    {"name": "Giải đặc biệt", "rate": 0.001},
+]
+
+VALIDATION_JSON = {
+    "valid": True,
+    "reason": "Hóa đơn hợp lệ của WinMart",
+    "data": {"invoice_id": "HD-2024-0012345", "shop_name": "WinMart", "total": 125000, "date": "2024-05-01"},
+}
+
+Case = Tuple[str, Callable[[], object]]
+
+
+# ========================================
+# DỮ LIỆU MẪU
+# ========================================
+
+def _webhook_event(page_id: str, index: int, kind: str = "image") -> dict:
+    event = {
+        "sender": {"id": f"user_{index}"},
+        "recipient": {"id": page_id},
+        "timestamp": 1700000000000 + index,
+    }
+    if kind == "image":
+        event["message"] = {
+            "mid": f"m_{uuid.uuid4().hex}",
+            "attachments": [{"type": "image", "payload": {"url": f"https://scontent.xx.fbcdn.net/v/{index}.jpg?_nc=abc"}}],
+        }
+    elif kind == "echo":
+        event["message"] = {"mid": f"m_{uuid.uuid4().hex}", "is_echo": True, "text": "Chúc mừng bạn!"}
+    else:
+        event["message"] = {"mid": f"m_{uuid.uuid4().hex}", "text": "xin chào shop"}
+    return event
+
+
+def _webhook_body(entries: int, events_per_entry: int) -> bytes:
+    """Payload có lẫn echo và text như traffic thật (2/3 là ảnh)"""
+    kinds = ("image", "echo", "image", "text", "image", "image")
+    body = {"object": "page", "entry": []}
+    for e in range(entries):
+        page_id = f"page_{e}"
+        body["entry"].append({
+            "id": page_id,
+            "time": 1700000000000,
+            "messaging": [_webhook_event(page_id, i, kinds[i % len(kinds)]) for i in range(events_per_entry)],
+        })
+    return json.dumps(body).encode()
+
+
+def _validation_texts() -> Dict[str, str]:
+    raw = json.dumps(VALIDATION_JSON, ensure_ascii=False, indent=2)
+    return {
+        "fenced_json": f"Đây là kết quả kiểm tra:\n```json\n{raw}\n```\nHết.",
+        "fenced_plain": f"```\n{raw}\n```",
+        "bare": raw,
+    }
+
+
+# ========================================
+# CASE
+# ========================================
+
+def build_cases() -> List[Case]:
+    cases: List[Case] = []
+
+    # --- Webhook ---
+    single = _webhook_body(1, 1)
+    batch = _webhook_body(5, 12)
+    cases.append(("webhook_parse_single", lambda: parse_webhook_messages(json.loads(single))))
+    cases.append(("webhook_parse_batch_60", lambda: parse_webhook_messages(json.loads(batch))))
+
+    # --- Dedupe ---
+    deduper = MessageDeduper(ttl=3600, bucket_seconds=60)
+    deduper.seen("m_known")
+    cases.append(("dedupe_memory_hit", lambda: deduper.seen("m_known")))
+    cases.append(("dedupe_miss_db_insert", lambda: deduper.seen(f"m_{uuid.uuid4().hex}")))
+
+    # --- Lucky wheel ---
+    tenant = {"id": PAGE_ID, "version": "bench-v1"}
+    limited_prizes = [dict(p, limit=10 ** 9) if i else dict(p) for i, p in enumerate(SAMPLE_PRIZES)]
+    limited_tenant = {"id": PAGE_ID + "_limited", "version": "bench-v1"}
+    cases.append(("spin_wheel_unlimited", lambda: _spin_lucky_wheel(tenant, SAMPLE_PRIZES)))
+    cases.append(("spin_wheel_limited_db", lambda: _spin_lucky_wheel(limited_tenant, limited_prizes)))
+
+    # --- Validate: bóc JSON ---
+    for name, response_text in _validation_texts().items():
+        cases.append((f"validate_parse_{name}", lambda t=response_text: _parse_validation_response(t)))
+
+    # --- Tenant ---
+    TenantService.get_or_create_tenant(PAGE_ID)
+    revalidate_interval = tenant_cache.revalidate_interval
+
+    def tenant_revalidate():
+        # Entry còn trong cache nhưng quá revalidate_interval -> 1 truy vấn version
+        tenant_cache.revalidate_interval = -1
+        try:
+            return TenantService.get_or_create_tenant(PAGE_ID)
+        finally:
+            tenant_cache.revalidate_interval = revalidate_interval
+
+    def tenant_cold():
+        tenant_cache.invalidate(PAGE_ID)
+        return TenantService.get_or_create_tenant(PAGE_ID)
+
+    cases.append(("tenant_cached", lambda: TenantService.get_or_create_tenant(PAGE_ID)))
+    cases.append(("tenant_revalidate", tenant_revalidate))
+    cases.append(("tenant_cold", tenant_cold))
+
+    # --- Invoice ---
+    InvoiceService.claim_and_draw("HD-USED", PAGE_ID, "user_0", lambda db: {"name": "Voucher 10k"})
+
+    def claim_new():
+        return InvoiceService.claim_and_draw(
+            f"HD-{uuid.uuid4().hex[:12]}", PAGE_ID, "user_0", lambda db: _spin_lucky_wheel(tenant, SAMPLE_PRIZES, db)
+        )
+
+    cases.append(("invoice_used_hit", lambda: InvoiceService.is_invoice_used("HD-USED", PAGE_ID)))
+    cases.append(("invoice_used_miss", lambda: InvoiceService.is_invoice_used("HD-MISSING", PAGE_ID)))
+    cases.append(("invoice_claim_new", claim_new))
+    cases.append(("invoice_claim_duplicate", lambda: InvoiceService.claim_and_draw(
+        "HD-USED", PAGE_ID, "user_0", lambda db: {"name": "Voucher 10k"})))
+
+    return cases
+
+
+# ========================================
+# ĐO
+# ========================================
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(fn: Callable[[], object], number: int, repeat: int) -> dict:
+    """µs mỗi lần gọi của từng vòng (vòng đầu làm warm-up, không tính)"""
+    fn()
+    rounds = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - start) / number * 1e6)
+    rounds = rounds[1:]
+    median = statistics.median(rounds)
+    return {
+        "median_us": round(median, 3),
+        "min_us": round(min(rounds), 3),
+        "p95_us": round(_percentile(rounds, 95), 3),
+        "ops_per_sec": round(1e6 / median, 1) if median else None,
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _git_dirty() -> bool:
+    try:
+        return bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=BENCH_DIR, capture_output=True, text=True, timeout=5,
+        ).stdout.strip())
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
+def compare(results: dict, baseline_path: str, threshold: float) -> List[str]:
+    """In chênh lệch median so với file cũ, trả về danh sách case chậm hơn threshold %"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    print(f"\n📊 So với {os.path.basename(baseline_path)} (commit {baseline['meta'].get('commit')})")
+    regressions = []
+    for name, current in results.items():
+        old = baseline["results"].get(name)
+        if not old or not old.get("median_us"):
+            print(f"  {name:28s} (mới)")
+            continue
+        delta = (current["median_us"] - old["median_us"]) / old["median_us"] * 100
+        mark = "✅"
+        if delta > threshold:
+            mark = "❌"
+            regressions.append(name)
+        elif delta < -threshold:
+            mark = "🚀"
+        print(f"  {name:28s} {old['median_us']:>10.2f}µs -> {current['median_us']:>10.2f}µs  {delta:+7.1f}% {mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for pure hot paths (JSON output)")
+    parser.add_argument("--number", type=int, default=200, help="Số lần gọi mỗi vòng")
+    parser.add_argument("--repeat", type=int, default=7, help="Số vòng đo mỗi case")
+    parser.add_argument("--only", default="", help="Chỉ chạy case có tên chứa 1 trong các chuỗi (phân cách bằng dấu phẩy)")
+    parser.add_argument("--output", help="File JSON kết quả (mặc định benchmarks/results/<thời gian>-<commit>.json)")
+    parser.add_argument("--compare", help="File JSON cũ để so sánh")
+    parser.add_argument("--threshold", type=float, default=10, help="Chậm hơn bao nhiêu %% thì tính là regression")
+    args = parser.parse_args()
+
+    filters = [f.strip() for f in args.only.split(",") if f.strip()]
+    cases = [
+        (name, fn) for name, fn in build_cases()
+        if not filters or any(f in name for f in filters)
+    ]
+
+    commit = _git_commit()
+    print("=" * 60)
+    print(f"🔬 Micro-benchmark đường nóng ({len(cases)} case, {args.repeat}x{args.number} lần, commit {commit})")
+    print("=" * 60)
+
+    results = {}
+    for name, fn in cases:
+        r = measure(fn, args.number, args.repeat)
+        results[name] = r
+        print(f"  {name:28s} median={r['median_us']:>10.2f}µs  min={r['min_us']:>10.2f}µs  "
+              f"p95={r['p95_us']:>10.2f}µs  {r['ops_per_sec']:>12,.0f}/s")
+
+    now = datetime.now(timezone.utc)
+    report = {
+        "meta": {
+            "commit": commit,
+            "dirty": _git_dirty(),
+            "timestamp": now.isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "number": args.number,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{now.strftime('%Y%m%dT%H%M%S')}-{commit or 'nogit'}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Đã ghi {output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"\n❌ Chậm hơn {args.threshold}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
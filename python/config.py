@@ -34,6 +34,152 @@ class Settings(BaseSettings):
     fb_api_version: str = "v18.0"
     fb_graph_url: str = f"https://graph.facebook.com/v18.0"
     
+    # Invoice Job Queue Settings
+    # PIPELINE_ASYNC=true: chạy graph bằng ainvoke trên event loop,
+    # INVOICE_WORKERS khi đó là số invoice đồng thời (không tốn thread)
+    pipeline_async: bool = os.getenv("PIPELINE_ASYNC", "true").lower() == "true"
+    invoice_workers: int = int(os.getenv("INVOICE_WORKERS", "4"))
+    invoice_async_workers: int = int(os.getenv("INVOICE_ASYNC_WORKERS", "200"))
+    job_poll_interval: float = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+    job_max_attempts: int = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    job_lease_seconds: float = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+    job_drain_timeout: float = float(os.getenv("JOB_DRAIN_TIMEOUT", "25"))
+    # Job lỗi chờ JOB_RETRY_BACKOFF_BASE * 2^(lần thử - 1) giây (tối đa ..._MAX) rồi mới thử lại
+    job_retry_backoff_base: float = float(os.getenv("JOB_RETRY_BACKOFF_BASE", "2"))
+    job_retry_backoff_max: float = float(os.getenv("JOB_RETRY_BACKOFF_MAX", "60"))
+    # Ngân sách thời gian cho 1 invoice (xem deadline.py). 0 = không giới hạn
+    invoice_deadline_seconds: float = float(os.getenv("INVOICE_DEADLINE_SECONDS", "60"))
+    deadline_min_node_seconds: float = float(os.getenv("DEADLINE_MIN_NODE_SECONDS", "2"))
+    # Lập lịch công bằng theo Page (deficit round-robin). 0 = không giới hạn,
+    # tenant ghi đè bằng config["job_max_concurrency"] / config["job_weight"]
+    job_tenant_max_concurrency: int = int(os.getenv("JOB_TENANT_MAX_CONCURRENCY", "0"))
+    job_tenant_weight: int = int(os.getenv("JOB_TENANT_WEIGHT", "1"))
+    
+    # Outbox tin nhắn Messenger (xem outbox.py). OUTBOX_ENABLED=false: gửi thẳng trong pipeline
+    outbox_enabled: bool = os.getenv("OUTBOX_ENABLED", "true").lower() == "true"
+    outbox_concurrency: int = int(os.getenv("OUTBOX_CONCURRENCY", "50"))
+    outbox_page_rate: float = float(os.getenv("OUTBOX_PAGE_RATE", "20"))
+    outbox_page_burst: int = int(os.getenv("OUTBOX_PAGE_BURST", "40"))
+    outbox_max_attempts: int = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+    outbox_backoff_base: float = float(os.getenv("OUTBOX_BACKOFF_BASE", "1"))
+    outbox_backoff_max: float = float(os.getenv("OUTBOX_BACKOFF_MAX", "300"))
+    outbox_poll_interval: float = float(os.getenv("OUTBOX_POLL_INTERVAL", "0.5"))
+    outbox_lease_seconds: float = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+    outbox_drain_timeout: float = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", "10"))
+    
+    # "Đã xem" + "đang soạn tin" gửi ngay từ webhook (xem sender_actions.py)
+    sender_actions_enabled: bool = os.getenv("SENDER_ACTIONS_ENABLED", "true").lower() == "true"
+    sender_action_timeout: float = float(os.getenv("SENDER_ACTION_TIMEOUT", "3"))
+    sender_actions_max_inflight: int = int(os.getenv("SENDER_ACTIONS_MAX_INFLIGHT", "200"))
+    # Messenger tự tắt typing sau ~20s -> gửi lại typing_on theo chu kỳ cho job dài
+    typing_refresh_seconds: float = float(os.getenv("TYPING_REFRESH_SECONDS", "15"))
+    typing_max_seconds: float = float(os.getenv("TYPING_MAX_SECONDS", "120"))
+    # User gửi ảnh mới trong khoảng này sau ảnh trước -> tính là gửi lại
+    resend_window_seconds: float = float(os.getenv("RESEND_WINDOW_SECONDS", "120"))
+    
+    # Metrics Prometheus ở GET /metrics (xem metrics.py)
+    metrics_enabled: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    metrics_max_pages: int = int(os.getenv("METRICS_MAX_PAGES", "1000"))
+    
+    # Trace từng invoice (xem tracing.py). Mặc định tắt (TRACE_PATH rỗng); trong Docker
+    # đặt cạnh DB trên volume, VD /app/data/traces.jsonl (không ghi vào layer của container)
+    trace_path: str = os.getenv("TRACE_PATH", "")
+    trace_sample_rate: float = float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))
+    # Trace lỗi hoặc chậm hơn ngưỡng này luôn được ghi (0 = chỉ theo sample rate)
+    trace_slow_seconds: float = float(os.getenv("TRACE_SLOW_SECONDS", "30"))
+    trace_max_bytes: int = int(os.getenv("TRACE_MAX_BYTES", str(100 * 1024 * 1024)))
+    
+    # Logging (xem logging_setup.py). LOG_FORMAT: json | text
+    log_format: str = os.getenv("LOG_FORMAT", "json").lower()
+    log_level: str = os.getenv("LOG_LEVEL", "INFO")
+    # Level riêng từng module, vd "nodes=WARNING,llm_guard=DEBUG"
+    log_levels: str = os.getenv("LOG_LEVELS", "")
+    log_queue_size: int = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    log_max_chars: int = int(os.getenv("LOG_MAX_CHARS", "2000"))
+    # OCR text / AI response: cắt ngắn và giới hạn số lần ghi mỗi phút
+    log_payload_max_chars: int = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "500"))
+    log_payloads_per_minute: int = int(os.getenv("LOG_PAYLOADS_PER_MINUTE", "30"))
+    
+    # LLM Proxy Connection Pool Settings (xem llm_clients.py)
+    llm_pool_max_connections: int = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "100"))
+    llm_pool_max_keepalive: int = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "20"))
+    llm_pool_keepalive_expiry: float = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "60"))
+    llm_http2: bool = os.getenv("LLM_HTTP2", "true").lower() == "true"
+    llm_request_timeout: float = float(os.getenv("LLM_REQUEST_TIMEOUT", "120"))
+    
+    # Giới hạn đồng thời + circuit breaker theo model, chuỗi model dự phòng (xem llm_guard.py)
+    llm_max_concurrency: int = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+    llm_model_concurrency: str = os.getenv("LLM_MODEL_CONCURRENCY", "")
+    llm_queue_timeout: float = float(os.getenv("LLM_QUEUE_TIMEOUT", "5"))
+    llm_breaker_window: int = int(os.getenv("LLM_BREAKER_WINDOW", "20"))
+    llm_breaker_min_calls: int = int(os.getenv("LLM_BREAKER_MIN_CALLS", "10"))
+    llm_breaker_failure_rate: float = float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5"))
+    llm_breaker_slow_seconds: float = float(os.getenv("LLM_BREAKER_SLOW_SECONDS", "30"))
+    llm_breaker_slow_rate: float = float(os.getenv("LLM_BREAKER_SLOW_RATE", "0.8"))
+    llm_breaker_open_seconds: float = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+    ocr_fallback_models: str = os.getenv("OCR_FALLBACK_MODELS", "gemini-2.5-flash")
+    validate_fallback_models: str = os.getenv("VALIDATE_FALLBACK_MODELS", "gemini-2.5-flash")
+    
+    # Shared HTTP Sessions (tải ảnh CDN + Messenger Send API, xem http_clients.py)
+    http_pool_maxsize: int = int(os.getenv("HTTP_POOL_MAXSIZE", "50"))
+    http_connect_timeout: float = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+    http_read_timeout: float = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+    http_retries: int = int(os.getenv("HTTP_RETRIES", "2"))
+    http_retry_backoff: float = float(os.getenv("HTTP_RETRY_BACKOFF", "0.3"))
+    
+    # Tenant Config Cache (xem services.TenantCache)
+    tenant_cache_max_size: int = int(os.getenv("TENANT_CACHE_MAX_SIZE", "1024"))
+    tenant_cache_ttl: float = float(os.getenv("TENANT_CACHE_TTL", "300"))
+    tenant_cache_revalidate: float = float(os.getenv("TENANT_CACHE_REVALIDATE", "2"))
+    
+    # OCR Result Cache (xem ocr_cache.py). OCR_CACHE_MAX_ENTRIES=0 để tắt
+    ocr_cache_max_entries: int = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "5000"))
+    ocr_cache_max_age: float = float(os.getenv("OCR_CACHE_MAX_AGE", str(7 * 86400)))
+    
+    # SQLite engine (xem database.build_engine). File DB dùng chung với app NestJS
+    db_journal_mode: str = os.getenv("DB_JOURNAL_MODE", "WAL")
+    db_synchronous: str = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+    db_busy_timeout_ms: int = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+    db_mmap_size: int = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+    db_cache_size_kb: int = int(os.getenv("DB_CACHE_SIZE_KB", "65536"))
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    db_pool_timeout: float = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    
+    # Local Shop Matcher (xem shop_matcher.py)
+    shop_match_enabled: bool = os.getenv("SHOP_MATCH_ENABLED", "true").lower() == "true"
+    shop_match_accept: float = float(os.getenv("SHOP_MATCH_ACCEPT", "0.9"))
+    shop_match_reject: float = float(os.getenv("SHOP_MATCH_REJECT", "0.5"))
+    # Shadow mode: luôn gọi LLM để đo độ đồng thuận, không bỏ qua LLM
+    shop_match_shadow: bool = os.getenv("SHOP_MATCH_SHADOW", "false").lower() == "true"
+    # File JSONL ghi lại (OCR text, kết quả matcher, kết quả LLM) - để trống để tắt
+    validation_corpus_path: str = os.getenv("VALIDATION_CORPUS_PATH", "")
+    
+    # Pipeline mode mặc định khi tenant không đặt config["pipeline_mode"]:
+    # "two_step" (OCR rồi validate) hoặc "single_call" (1 request ảnh -> text + JSON)
+    pipeline_mode: str = os.getenv("PIPELINE_MODE", "two_step")
+    single_call_model: str = os.getenv("SINGLE_CALL_MODEL", "gemini-3-pro-preview")
+    
+    # Seed RNG quay thưởng (để trống = ngẫu nhiên; chỉ đặt khi test phân phối)
+    prize_rng_seed: str = os.getenv("PRIZE_RNG_SEED", "")
+    
+    # Múi giờ (lệch UTC, giờ) để tính kỳ ngày/tuần/tháng của giới hạn giải, VN = +7
+    prize_period_utc_offset: float = float(os.getenv("PRIZE_PERIOD_UTC_OFFSET", "7"))
+    
+    # Chu kỳ ghi thống kê tenant (totalSpins...) xuống DB, xem stats_aggregator.py
+    tenant_stats_flush_interval: float = float(os.getenv("TENANT_STATS_FLUSH_INTERVAL", "2"))
+    
+    # Chống trùng message_id giữa các worker (xem dedupe.py)
+    dedupe_ttl: float = float(os.getenv("DEDUPE_TTL", "3600"))
+    dedupe_bucket_seconds: float = float(os.getenv("DEDUPE_BUCKET_SECONDS", "60"))
+    
+    # Tiền xử lý ảnh trước khi gửi LLM (xem image_preprocess.py)
+    image_preprocess: bool = os.getenv("IMAGE_PREPROCESS", "true").lower() == "true"
+    image_max_bytes: int = int(os.getenv("IMAGE_MAX_BYTES", str(15 * 1024 * 1024)))
+    image_max_side: int = int(os.getenv("IMAGE_MAX_SIDE", "2048"))
+    image_format: str = os.getenv("IMAGE_FORMAT", "JPEG")  # JPEG | WEBP
+    image_quality: int = int(os.getenv("IMAGE_QUALITY", "85"))
+    
     class Config:
         env_file = ".env"
         case_sensitive = False
@@ -84,6 +230,8 @@ if __name__ == "__main__":
     print(f"DeepSeek API Key: {'✅ Set' if settings.deepseek_api_key else '❌ Missing'}")
     print(f"\nPort: {settings.port}")
     print(f"DeepSeek Model: {settings.deepseek_model}")
+    print(f"Pipeline Mode: {'async' if settings.pipeline_async else 'sync'}")
+    print(f"Invoice Workers: {settings.invoice_async_workers if settings.pipeline_async else settings.invoice_workers}")
     
     if not is_valid:
         print(f"\n❌ Missing settings: {', '.join(missing)}")
@@ -1,9 +1,12 @@
-from sqlalchemy import create_engine, Column, String, Boolean, Integer, DateTime, JSON
+from sqlalchemy import create_engine, event, text, Column, String, Text, Boolean, Integer, Float, DateTime, JSON, Index, PrimaryKeyConstraint
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool
 import os
 import datetime
 from dotenv import load_dotenv
 
+from config import settings
+
 # Load env
 load_dotenv()
 
@@ -50,9 +53,61 @@ print(f"📦 [Database] Đường dẫn DB: {DB_FILE}")
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{DB_FILE}"
 
 # 3. Kết nối
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# File DB được các worker Python và app NestJS cùng ghi (volume Docker dùng chung).
+# Chế độ rollback-journal mặc định khóa cả file khi ghi -> "database is locked".
+# WAL cho phép đọc song song với 1 writer; busy_timeout để writer chờ thay vì lỗi ngay.
+# journal_mode=WAL lưu luôn trong file DB nên cũng áp dụng cho kết nối của NestJS.
+
+def _sqlite_pragmas() -> dict:
+    return {
+        "journal_mode": settings.db_journal_mode,
+        "synchronous": settings.db_synchronous,   # NORMAL an toàn với WAL, ít fsync hơn FULL
+        "busy_timeout": settings.db_busy_timeout_ms,
+        "mmap_size": settings.db_mmap_size,
+        "cache_size": -settings.db_cache_size_kb,  # số âm = KiB
+        "temp_store": "MEMORY",
+    }
+
+
+def build_engine(url: str = SQLALCHEMY_DATABASE_URL, pragmas: dict = None):
+    """
+    Tạo engine SQLite với QueuePool và các PRAGMA ở trên (chạy cho mỗi kết nối mới)
+
+    Args:
+        url: SQLAlchemy URL
+        pragmas: Ghi đè PRAGMA (None = theo settings, {} = không set gì, như mặc định SQLite)
+    """
+    pragmas = _sqlite_pragmas() if pragmas is None else pragmas
+
+    new_engine = create_engine(
+        url,
+        connect_args={
+            "check_same_thread": False,
+            # Timeout chờ lock của driver sqlite3 (giây), khớp với busy_timeout
+            "timeout": pragmas.get("busy_timeout", 5000) / 1000,
+        },
+        poolclass=QueuePool,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+    )
+
+    @event.listens_for(new_engine, "connect")
+    def _apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        except Exception as e:
+            # VD: DB đang bị khóa lúc đổi journal_mode -> vẫn dùng được, lần kết nối sau thử lại
+            print(f"⚠️ [Database] Không set được PRAGMA: {e}")
+        finally:
+            cursor.close()
+
+    return new_engine
+
+
+engine = build_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -80,13 +135,164 @@ class Tenant(Base):
 class Invoice(Base):
     __tablename__ = "invoice"
     
-    id = Column(String, primary_key=True, index=True)
+    id = Column(String, index=True)
     page_id = Column(String, index=True)
     sender_id = Column(String, index=True)
     prize_won = Column(String)
     
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
+    __table_args__ = (
+        # Khóa chính (page_id, id): 2 Page khác nhau có thể trùng số hóa đơn
+        PrimaryKeyConstraint("page_id", "id"),
+    )
+
+class InvoiceJob(Base):
+    """
+    Job xử lý hóa đơn trong hàng đợi bền vững (xem job_queue.py).
+    Các cột *_at dùng epoch seconds (float) để so sánh lease cho nhanh.
+    """
+    __tablename__ = "invoice_job"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    page_id = Column(String, index=True)
+    sender_id = Column(String)
+    image_url = Column(String)
+    message_id = Column(String, nullable=True, index=True)
+
+    # pending -> running -> (xóa khi xong) | failed
+    status = Column(String, default="pending")
+    attempts = Column(Integer, default=0)
+    worker_id = Column(String, nullable=True)
+    last_error = Column(String, nullable=True)
+
+    created_at = Column(Float)
+    started_at = Column(Float, nullable=True)
+    lease_expires_at = Column(Float, nullable=True)
+    # Job lỗi chờ đến thời điểm này mới được thử lại (exponential backoff), NULL = ngay
+    available_at = Column(Float, nullable=True)
+
+    __table_args__ = (
+        Index("ix_invoice_job_status_id", "status", "id"),
+    )
+
+class OcrCacheEntry(Base):
+    """
+    Kết quả OCR theo SHA-256 của ảnh gốc (xem ocr_cache.py).
+    Các cột *_at dùng epoch seconds (float).
+    """
+    __tablename__ = "ocr_cache"
+
+    image_hash = Column(String, primary_key=True)
+    ocr_text = Column(Text)
+    image_size = Column(Integer)
+    hits = Column(Integer, default=0)
+
+    created_at = Column(Float, index=True)
+    last_used_at = Column(Float, index=True)
+
+class ProcessedMessage(Base):
+    """
+    message_id (mid) Messenger đã nhận, dùng chung giữa các worker (xem dedupe.py).
+    created_at: epoch seconds (float).
+    """
+    __tablename__ = "processed_message"
+
+    message_id = Column(String, primary_key=True)
+    created_at = Column(Float, index=True)
+
+class PrizeInventory(Base):
+    """
+    Số giải đã phát theo kỳ cho các giải có giới hạn (xem prize_inventory.py).
+    period_key: "2026-01-26" (ngày), "2026-W05" (tuần), "2026-01" (tháng), "all".
+    """
+    __tablename__ = "prize_inventory"
+
+    page_id = Column(String)
+    prize_key = Column(String)
+    period_key = Column(String)
+    used = Column(Integer, default=0)
+    updated_at = Column(Float)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("page_id", "prize_key", "period_key"),
+    )
+
+class OutboundMessage(Base):
+    """
+    Tin nhắn Messenger chờ gửi (outbox, xem outbox.py).
+    payload: JSON body của Send API (không chứa access token).
+    Các cột *_at dùng epoch seconds (float).
+    """
+    __tablename__ = "outbound_message"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    page_id = Column(String, index=True)
+    recipient_id = Column(String)
+    payload = Column(Text)
+
+    # pending -> sending -> (xóa khi gửi xong) | failed
+    status = Column(String, default="pending")
+    attempts = Column(Integer, default=0)
+    last_error = Column(String, nullable=True)
+
+    next_attempt_at = Column(Float)
+    lease_expires_at = Column(Float, nullable=True)
+    created_at = Column(Float)
+
+    __table_args__ = (
+        Index("ix_outbound_message_status_next", "status", "next_attempt_at"),
+    )
+
+# ====================================================================
+# SCHEMA / MIGRATION
+# ====================================================================
+
+def _migrate_invoice_primary_key(bind):
+    """
+    DB cũ: invoice.id là khóa chính duy nhất -> đổi sang khóa (page_id, id).
+    SQLite không ALTER được PRIMARY KEY nên tạo bảng mới rồi copy dữ liệu.
+    """
+    with bind.begin() as conn:
+        columns = conn.execute(text("PRAGMA table_info(invoice)")).mappings().all()
+        pk_columns = {c["name"] for c in columns if c["pk"]}
+        if not columns or pk_columns == {"id", "page_id"}:
+            return
+
+        print("🔧 [Database] Migration: invoice PRIMARY KEY (id) -> (page_id, id)")
+        conn.execute(text("ALTER TABLE invoice RENAME TO invoice_old"))
+        for index in conn.execute(text("PRAGMA index_list(invoice_old)")).mappings().all():
+            if index["origin"] == "c":
+                conn.execute(text(f'DROP INDEX IF EXISTS "{index["name"]}"'))
+        Invoice.__table__.create(bind=conn)
+        conn.execute(text("""
+            INSERT OR IGNORE INTO invoice (id, page_id, sender_id, prize_won, created_at)
+            SELECT id, COALESCE(page_id, ''), sender_id, prize_won, created_at FROM invoice_old
+        """))
+        conn.execute(text("DROP TABLE invoice_old"))
+
+
+def _add_missing_columns(bind):
+    """create_all không thêm cột vào bảng đã có -> ALTER TABLE ADD COLUMN cho DB cũ"""
+    missing = [
+        ("invoice_job", "available_at", "FLOAT"),
+    ]
+    with bind.begin() as conn:
+        for table, column, ddl in missing:
+            columns = {c["name"] for c in conn.execute(text(f"PRAGMA table_info({table})")).mappings().all()}
+            if columns and column not in columns:
+                print(f"🔧 [Database] Migration: thêm cột {table}.{column}")
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def ensure_schema(bind=None):
+    """Tạo bảng còn thiếu + chạy các migration nhỏ (gọi 1 lần lúc khởi động)"""
+    bind = bind or engine
+    Base.metadata.create_all(bind=bind)
+    _migrate_invoice_primary_key(bind)
+    _add_missing_columns(bind)
+
+
 def get_db():
     db = SessionLocal()
     try:
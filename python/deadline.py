@@ -0,0 +1,93 @@
+"""
+File: deadline.py
+Mục đích: Ngân sách thời gian end-to-end cho 1 invoice
+
+process_invoice_async/sync đặt state["deadline"] = now + INVOICE_DEADLINE_SECONDS
+(epoch seconds). Mỗi node mạng (tải ảnh, LLM, gửi tin) lấy timeout = min(timeout
+mặc định, thời gian còn lại). Còn ít hơn DEADLINE_MIN_NODE_SECONDS thì node bỏ
+qua bước tốn thời gian (trả lời user "hệ thống đang bận") thay vì làm p99 kéo dài.
+Số lần hết ngân sách được đếm theo node (xem /health).
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Trả lời user khi invoice hết ngân sách thời gian trước khi xử lý xong
+DEADLINE_MESSAGE = (
+    "Hệ thống đang quá tải nên chưa xử lý kịp hóa đơn của bạn. "
+    "Bạn vui lòng gửi lại ảnh sau ít phút nhé!"
+)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Invoice đã hết ngân sách thời gian"""
+
+
+def new_deadline(now: Optional[float] = None) -> Optional[float]:
+    """Deadline cho invoice bắt đầu xử lý lúc `now`, None nếu tắt (INVOICE_DEADLINE_SECONDS=0)"""
+    if settings.invoice_deadline_seconds <= 0:
+        return None
+    return (time.time() if now is None else now) + settings.invoice_deadline_seconds
+
+
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    """Số giây còn lại (có thể âm), None nếu không có deadline"""
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def timeout_for(deadline: Optional[float], default: float) -> float:
+    """Timeout cho 1 lần gọi mạng: min(default, thời gian còn lại), luôn > 0"""
+    left = remaining(deadline)
+    if left is None:
+        return default
+    return max(0.01, min(default, left))
+
+
+def check(deadline: Optional[float]):
+    """Raise DeadlineExceeded nếu đã quá deadline"""
+    left = remaining(deadline)
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("Invoice đã hết ngân sách thời gian")
+
+
+class DeadlineTracker:
+    """Đếm số lần hết ngân sách theo node"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._exhausted: Dict[str, int] = {}
+
+    def record(self, node: str):
+        with self._lock:
+            self._exhausted[node] = self._exhausted.get(node, 0) + 1
+        logger.warning(f"⏰ [Deadline] {node}: hết ngân sách thời gian")
+
+    def exhausted(self, deadline: Optional[float], node: str) -> bool:
+        """
+        True (và đếm) nếu còn ít hơn DEADLINE_MIN_NODE_SECONDS,
+        node nên bỏ qua bước gọi mạng
+        """
+        left = remaining(deadline)
+        if left is None or left >= settings.deadline_min_node_seconds:
+            return False
+        self.record(node)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "budget_seconds": settings.invoice_deadline_seconds,
+                "exhausted": dict(self._exhausted),
+            }
+
+
+# Dùng chung toàn process
+deadlines = DeadlineTracker()
@@ -0,0 +1,164 @@
+"""
+File: dedupe.py
+Mục đích: Chống xử lý trùng tin nhắn Messenger (Facebook retry webhook) giữa nhiều worker
+
+Thay cho dict PROCESSED_MESSAGES trong main.py (chỉ sống trong 1 process,
+mất khi restart, dọn dẹp O(n) ngay trong request webhook).
+
+2 tầng:
+1. Ring theo time bucket trong RAM: N bucket, mỗi bucket giữ các message_id
+   nhận trong BUCKET_SECONDS giây. Sang bucket mới thì bỏ nguyên bucket cũ
+   -> hết hạn O(1), không cần quét.
+2. Bảng `processed_message` (SQLite) dùng chung giữa các uvicorn worker và
+   giữ qua restart: INSERT OR IGNORE, rowcount = 0 nghĩa là đã có worker khác nhận.
+   Các dòng quá DEDUPE_TTL được xóa bởi vòng dọn dẹp chạy nền (không nằm trong webhook).
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import text
+
+from config import settings
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class MessageDeduper:
+    """
+    Args:
+        ttl: Thời gian nhớ 1 message_id (giây)
+        bucket_seconds: Độ rộng mỗi bucket của ring trong RAM
+    """
+
+    def __init__(self, ttl: float = 3600, bucket_seconds: float = 60):
+        self.ttl = ttl
+        self.bucket_seconds = bucket_seconds
+        self._num_buckets = max(1, int(-(-ttl // bucket_seconds)))
+        self._buckets = [set() for _ in range(self._num_buckets)]
+        self._bucket_epochs = [-1] * self._num_buckets
+
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.purged = 0
+
+    # ========================================
+    # RING TRONG RAM
+    # ========================================
+
+    def _epoch(self, now: float) -> int:
+        return int(now // self.bucket_seconds)
+
+    def _in_memory(self, message_id: str, epoch: int) -> bool:
+        oldest = epoch - self._num_buckets
+        for bucket, bucket_epoch in zip(self._buckets, self._bucket_epochs):
+            if bucket_epoch > oldest and message_id in bucket:
+                return True
+        return False
+
+    def _remember(self, message_id: str, epoch: int):
+        index = epoch % self._num_buckets
+        if self._bucket_epochs[index] != epoch:
+            # Bucket đã quay vòng -> bỏ nguyên bucket cũ
+            self._buckets[index] = set()
+            self._bucket_epochs[index] = epoch
+        self._buckets[index].add(message_id)
+
+    # ========================================
+    # API
+    # ========================================
+
+    def seen(self, message_id: str, now: Optional[float] = None) -> bool:
+        """
+        Kiểm tra và đánh dấu message_id (atomic giữa các worker).
+
+        Returns:
+            True nếu message đã được nhận trước đó -> bỏ qua
+        """
+        now = time.time() if now is None else now
+        epoch = self._epoch(now)
+
+        with self._lock:
+            if self._in_memory(message_id, epoch):
+                self.memory_hits += 1
+                return True
+
+        inserted = self._claim_in_db(message_id, now)
+
+        with self._lock:
+            self._remember(message_id, epoch)
+            if inserted:
+                self.misses += 1
+                return False
+            self.db_hits += 1
+            return True
+
+    def _claim_in_db(self, message_id: str, now: float) -> bool:
+        """True nếu process này là nơi đầu tiên ghi nhận message_id"""
+        db = SessionLocal()
+        try:
+            inserted = db.execute(
+                text("INSERT OR IGNORE INTO processed_message (message_id, created_at) VALUES (:mid, :now)"),
+                {"mid": message_id, "now": now},
+            ).rowcount
+            db.commit()
+            return inserted == 1
+        except Exception as e:
+            # DB lỗi: vẫn xử lý (ring trong RAM chặn retry trong process này)
+            logger.warning(f"⚠️ [Dedupe] Lỗi ghi processed_message: {e}")
+            db.rollback()
+            return True
+        finally:
+            db.close()
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        """Xóa các message_id quá TTL trong SQLite"""
+        now = time.time() if now is None else now
+        db = SessionLocal()
+        try:
+            removed = db.execute(
+                text("DELETE FROM processed_message WHERE created_at < :min_created"),
+                {"min_created": now - self.ttl},
+            ).rowcount or 0
+            db.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ [Dedupe] Lỗi dọn processed_message: {e}")
+            db.rollback()
+            return 0
+        finally:
+            db.close()
+
+        with self._lock:
+            self.purged += removed
+        return removed
+
+    async def run_purge_loop(self, interval: float = 60):
+        """Vòng dọn dẹp chạy nền (khởi động trong lifespan của FastAPI)"""
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.purge_expired)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "ttl": self.ttl,
+                "buckets": self._num_buckets,
+                "in_memory": sum(len(b) for b in self._buckets),
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "purged": self.purged,
+            }
+
+
+# Dùng chung toàn process
+message_deduper = MessageDeduper(
+    ttl=settings.dedupe_ttl,
+    bucket_seconds=settings.dedupe_bucket_seconds,
+)
@@ -11,30 +11,74 @@ Mô tả các bước:
 2. Validate Invoice: Gọi DeepSeek AI kiểm tra theo patterns của tenant
 3. Lucky Draw: Kiểm tra trùng (Firebase) + quay thưởng theo config tenant
 4. Send Message: Gửi kết quả về Messenger bằng token của tenant
+
+Tenant có pipeline_mode = "single_call" đi đường tắt:
+Load Tenant -> OCR+Validate (1 request) -> Lucky Draw -> ...
+và quay về OCR -> Validate nếu request đó thất bại.
+
+Có 2 bản graph dùng chung cấu trúc:
+- app_graph: node sync, chạy bằng app_graph.invoke (mỗi invoice giữ 1 thread)
+- app_graph_async: node async, chạy bằng app_graph_async.ainvoke trên event loop
 """
 
 from langgraph.graph import StateGraph, END
 from state import InvoiceState
+from metrics import instrument_node
+from tracing import trace_node
 from nodes import (
     load_tenant_node,
     download_and_ocr_node,
     validate_invoice_node,
     lucky_draw_node,
     send_message_node,
+    load_tenant_node_async,
+    download_and_ocr_node_async,
+    validate_invoice_node_async,
+    lucky_draw_node_async,
+    send_message_node_async,
+    ocr_validate_node,
+    ocr_validate_node_async,
+    route_after_load_tenant,
+    route_after_ocr_validate,
 )
 
 
-def create_invoice_graph():
+def create_invoice_graph(use_async: bool = False):
     """
     Tạo và compile StateGraph cho invoice processing workflow
     
     Workflow:
         Load Tenant -> OCR -> Validate -> Lucky Draw -> Send Message -> END
     
+    Args:
+        use_async: True để dùng các node async (chạy bằng ainvoke)
+    
     Returns:
         Compiled graph có thể invoke với InvoiceState
     """
     
+    if use_async:
+        nodes = {
+            "load_tenant": load_tenant_node_async,
+            "ocr": download_and_ocr_node_async,
+            "ocr_validate": ocr_validate_node_async,
+            "validate_invoice": validate_invoice_node_async,
+            "lucky_draw": lucky_draw_node_async,
+            "send_message": send_message_node_async,
+        }
+    else:
+        nodes = {
+            "load_tenant": load_tenant_node,
+            "ocr": download_and_ocr_node,
+            "ocr_validate": ocr_validate_node,
+            "validate_invoice": validate_invoice_node,
+            "lucky_draw": lucky_draw_node,
+            "send_message": send_message_node,
+        }
+    
+    # Đo thời gian từng node theo page_id (xem metrics.py) + ghi span vào trace của invoice (xem tracing.py)
+    nodes = {name: trace_node(name, instrument_node(name, fn)) for name, fn in nodes.items()}
+    
     # Khởi tạo StateGraph với InvoiceState
     workflow = StateGraph(InvoiceState)
     
@@ -43,19 +87,22 @@ def create_invoice_graph():
     # ========================================
     
     # Node 0: Load Tenant - Lấy config từ Firebase
-    workflow.add_node("load_tenant", load_tenant_node)
+    workflow.add_node("load_tenant", nodes["load_tenant"])
     
     # Node 1: OCR - Tải ảnh và trích xuất text
-    workflow.add_node("ocr", download_and_ocr_node)
+    workflow.add_node("ocr", nodes["ocr"])
+    
+    # Node 1+2: OCR + Validate trong 1 request (tenant pipeline_mode = single_call)
+    workflow.add_node("ocr_validate", nodes["ocr_validate"])
     
     # Node 2: Validate Invoice - Gọi DeepSeek AI kiểm tra
-    workflow.add_node("validate_invoice", validate_invoice_node)
+    workflow.add_node("validate_invoice", nodes["validate_invoice"])
     
     # Node 3: Lucky Draw - Kiểm tra trùng + quay thưởng
-    workflow.add_node("lucky_draw", lucky_draw_node)
+    workflow.add_node("lucky_draw", nodes["lucky_draw"])
     
     # Node 4: Send Message - Gửi kết quả về Messenger
-    workflow.add_node("send_message", send_message_node)
+    workflow.add_node("send_message", nodes["send_message"])
     
     # ========================================
     # ĐỊNH NGHĨA LUỒNG XỬ LÝ (EDGES)
@@ -64,8 +111,19 @@ def create_invoice_graph():
     # Entry point: Bắt đầu từ Load Tenant
     workflow.set_entry_point("load_tenant")
     
-    # Load Tenant -> OCR
-    workflow.add_edge("load_tenant", "ocr")
+    # Load Tenant -> OCR (two_step) hoặc OCR+Validate (single_call)
+    workflow.add_conditional_edges(
+        "load_tenant",
+        route_after_load_tenant,
+        {"ocr": "ocr", "ocr_validate": "ocr_validate"},
+    )
+    
+    # OCR+Validate -> Lucky Draw (thành công) / Validate (OCR cache hit) / OCR (fallback)
+    workflow.add_conditional_edges(
+        "ocr_validate",
+        route_after_ocr_validate,
+        {"lucky_draw": "lucky_draw", "validate_invoice": "validate_invoice", "ocr": "ocr"},
+    )
     
     # OCR -> Validate Invoice
     workflow.add_edge("ocr", "validate_invoice")
@@ -85,11 +143,14 @@ def create_invoice_graph():
     
     app_graph = workflow.compile()
     
-    print("✅ [Graph] LangGraph workflow đã được compile thành công")
+    mode = "async" if use_async else "sync"
+    print(f"✅ [Graph] LangGraph workflow ({mode}) đã được compile thành công")
     print("   Flow: Load Tenant -> OCR -> Validate -> Lucky Draw -> Send Message -> END")
+    print("   Single-call: Load Tenant -> OCR+Validate -> Lucky Draw -> Send Message -> END")
     
     return app_graph
 
 
 # Tạo graph instance để sử dụng trong main.py
 app_graph = create_invoice_graph()
+app_graph_async = create_invoice_graph(use_async=True)
@@ -0,0 +1,193 @@
+"""
+File: http_clients.py
+Mục đích: HTTP session dùng chung (keep-alive) theo từng host
+
+Dùng cho:
+- Tải ảnh hóa đơn từ CDN của Facebook (scontent-*.fbcdn.net)
+- Gọi Messenger Send API (graph.facebook.com)
+
+Mỗi host có 1 requests.Session (bản sync) và 1 httpx.AsyncClient (bản async)
+với pool size, timeout và retry cấu hình được qua env (HTTP_*).
+Retry:
+- GET: retry cả lỗi kết nối lẫn 5xx/429 (an toàn vì idempotent)
+- POST: chỉ retry lỗi kết nối (request chưa tới server), tránh gửi trùng tin nhắn
+"""
+
+import logging
+import threading
+from typing import Any, Dict
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _host_key(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class HostSessionPool:
+    """
+    Quản lý session keep-alive theo host (scheme + netloc)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, requests.Session] = {}
+        self._async_clients: Dict[str, httpx.AsyncClient] = {}
+        self._requests: Dict[str, int] = {}
+
+    @property
+    def timeout(self):
+        """(connect, read) timeout mặc định cho requests"""
+        return (settings.http_connect_timeout, settings.http_read_timeout)
+
+    # ========================================
+    # SYNC (requests)
+    # ========================================
+
+    def session_for(self, url: str) -> requests.Session:
+        """Lấy requests.Session dùng chung cho host của url"""
+        host = _host_key(url)
+        session = self._sessions.get(host)
+        if session is not None:
+            return session
+
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = self._create_session()
+                self._sessions[host] = session
+                logger.info(f"🔌 [HTTP Pool] Tạo session cho {host}")
+        return session
+
+    def _create_session(self) -> requests.Session:
+        retry = Retry(
+            total=settings.http_retries,
+            connect=settings.http_retries,
+            read=settings.http_retries,
+            status=settings.http_retries,
+            backoff_factor=settings.http_retry_backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # POST không nằm trong allowed_methods -> chỉ retry lỗi kết nối
+            allowed_methods=frozenset({"GET", "HEAD"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=settings.http_pool_maxsize,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        self._count(url)
+        return self.session_for(url).get(url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        self._count(url)
+        return self.session_for(url).post(url, **kwargs)
+
+    # ========================================
+    # ASYNC (httpx)
+    # ========================================
+
+    def async_client_for(self, url: str) -> httpx.AsyncClient:
+        """
+        Lấy httpx.AsyncClient dùng chung cho host của url.
+        LƯU Ý: client gắn với event loop đầu tiên sử dụng nó (event loop của server).
+        """
+        host = _host_key(url)
+        client = self._async_clients.get(host)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._async_clients.get(host)
+            if client is None:
+                client = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=settings.http_pool_maxsize,
+                        max_keepalive_connections=settings.http_pool_maxsize,
+                    ),
+                    timeout=httpx.Timeout(
+                        settings.http_read_timeout,
+                        connect=settings.http_connect_timeout,
+                    ),
+                    # httpx chỉ retry lỗi kết nối -> an toàn cho cả POST
+                    transport=httpx.AsyncHTTPTransport(retries=settings.http_retries),
+                )
+                self._async_clients[host] = client
+                logger.info(f"🔌 [HTTP Pool] Tạo async client cho {host}")
+        return client
+
+    async def aget(self, url: str, **kwargs) -> httpx.Response:
+        self._count(url)
+        return await self.async_client_for(url).get(url, **kwargs)
+
+    async def apost(self, url: str, **kwargs) -> httpx.Response:
+        self._count(url)
+        return await self.async_client_for(url).post(url, **kwargs)
+
+    def astream(self, method: str, url: str, **kwargs):
+        """Context manager httpx stream (async with http_pool.astream("GET", url) as r)"""
+        self._count(url)
+        return self.async_client_for(url).stream(method, url, **kwargs)
+
+    # ========================================
+    # STATS / SHUTDOWN
+    # ========================================
+
+    def _count(self, url: str):
+        host = _host_key(url)
+        with self._lock:
+            self._requests[host] = self._requests.get(host, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Số request và connection đang giữ theo host (hiển thị ở /debug/pools)"""
+        hosts = {}
+        for host, count in list(self._requests.items()):
+            info: Dict[str, Any] = {"requests": count}
+            session = self._sessions.get(host)
+            if session is not None:
+                adapter = session.get_adapter(host)
+                pools = list(adapter.poolmanager.pools._container.values())
+                info["sync_connections_opened"] = sum(p.num_connections for p in pools)
+                info["sync_requests_on_pool"] = sum(p.num_requests for p in pools)
+            client = self._async_clients.get(host)
+            if client is not None:
+                pool = getattr(getattr(client, "_transport", None), "_pool", None)
+                info["async_connections"] = len(getattr(pool, "connections", []) or [])
+            hosts[host] = info
+        return {
+            "pool_maxsize": settings.http_pool_maxsize,
+            "retries": settings.http_retries,
+            "hosts": hosts,
+        }
+
+    async def aclose(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            clients = list(self._async_clients.values())
+            self._sessions.clear()
+            self._async_clients.clear()
+        for session in sessions:
+            session.close()
+        for client in clients:
+            await client.aclose()
+
+
+# Pool dùng chung toàn process
+http_pool = HostSessionPool()
@@ -0,0 +1,167 @@
+"""
+File: image_preprocess.py
+Mục đích: Tải ảnh hóa đơn có giới hạn dung lượng và thu nhỏ/nén lại trước khi gửi cho LLM
+
+Ảnh chụp từ điện thoại thường 3-8MB (12MP+), base64 còn tăng thêm ~33%,
+trong khi OCR chỉ cần cạnh dài ~2000px. Các bước:
+1. Tải ảnh dạng stream, dừng ngay khi vượt IMAGE_MAX_BYTES (không đọc hết vào RAM)
+2. Decode (JPEG dùng draft mode để decode thẳng ở độ phân giải thấp hơn)
+3. Xoay ảnh theo EXIF orientation (ảnh điện thoại hay bị nằm ngang)
+4. Thu nhỏ về cạnh dài tối đa IMAGE_MAX_SIDE
+5. Nén lại JPEG/WebP (IMAGE_FORMAT, IMAGE_QUALITY)
+
+Hash cho OCR cache vẫn tính trên bytes GỐC (không phụ thuộc cấu hình nén).
+Không có Pillow hoặc ảnh không decode được -> gửi nguyên ảnh gốc như trước.
+"""
+
+import io
+import logging
+import time
+from typing import NamedTuple, Optional
+
+from config import settings
+from http_clients import http_pool
+from deadline import check, timeout_for
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageOps
+    PILLOW_AVAILABLE = True
+except ImportError:
+    PILLOW_AVAILABLE = False
+
+_CHUNK_SIZE = 64 * 1024
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+class ImageTooLarge(ValueError):
+    """Ảnh vượt quá IMAGE_MAX_BYTES"""
+
+
+class PreparedImage(NamedTuple):
+    data: bytes
+    mime: str
+
+
+def _too_large(size: int) -> ImageTooLarge:
+    return ImageTooLarge(f"Image exceeds {settings.image_max_bytes} bytes (got {size}+)")
+
+
+def _check_content_length(headers) -> None:
+    # Server báo trước dung lượng -> từ chối luôn, không cần tải
+    length = headers.get("content-length")
+    if length and length.isdigit() and int(length) > settings.image_max_bytes:
+        raise _too_large(int(length))
+
+
+# ========================================
+# DOWNLOAD (stream + giới hạn dung lượng)
+# ========================================
+
+def download_image(url: str, deadline: Optional[float] = None) -> bytes:
+    """
+    Tải ảnh bằng session dùng chung, dừng khi vượt IMAGE_MAX_BYTES
+
+    Args:
+        deadline: Deadline của invoice (epoch seconds), timeout không vượt quá nó
+
+    Raises:
+        ImageTooLarge, DeadlineExceeded, requests.RequestException
+    """
+    check(deadline)
+    timeout = (
+        timeout_for(deadline, settings.http_connect_timeout),
+        timeout_for(deadline, settings.http_read_timeout),
+    )
+    response = http_pool.get(url, stream=True, timeout=timeout)
+    try:
+        response.raise_for_status()
+        _check_content_length(response.headers)
+
+        buffer = bytearray()
+        for chunk in response.iter_content(_CHUNK_SIZE):
+            buffer += chunk
+            if len(buffer) > settings.image_max_bytes:
+                raise _too_large(len(buffer))
+            # Timeout của requests tính theo từng lần đọc -> tự kiểm tra tổng thời gian
+            check(deadline)
+        return bytes(buffer)
+    finally:
+        response.close()
+
+
+async def adownload_image(url: str, deadline: Optional[float] = None) -> bytes:
+    """Bản async của download_image (httpx stream)"""
+    check(deadline)
+    timeout = timeout_for(deadline, settings.http_read_timeout)
+    async with http_pool.astream("GET", url, timeout=timeout) as response:
+        response.raise_for_status()
+        _check_content_length(response.headers)
+
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes(_CHUNK_SIZE):
+            buffer += chunk
+            if len(buffer) > settings.image_max_bytes:
+                raise _too_large(len(buffer))
+            check(deadline)
+        return bytes(buffer)
+
+
+# ========================================
+# PREPROCESS (xoay EXIF + thu nhỏ + nén lại)
+# ========================================
+
+def prepare_image(image_bytes: bytes) -> PreparedImage:
+    """
+    Chuẩn bị ảnh để gửi cho LLM. Chạy CPU (decode/encode), bản async nên
+    gọi qua asyncio.to_thread.
+
+    Returns:
+        PreparedImage (bytes + mime type cho data URL)
+    """
+    original = PreparedImage(image_bytes, "image/jpeg")
+    if not settings.image_preprocess or not PILLOW_AVAILABLE:
+        return original
+
+    start = time.perf_counter()
+    max_side = settings.image_max_side
+    fmt = settings.image_format.upper()
+    if fmt not in _MIME_TYPES:
+        fmt = "JPEG"
+
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            original_dims = img.size
+            # 274 = EXIF Orientation; 1/không có = ảnh đã đúng chiều
+            rotated = img.getexif().get(274, 1) != 1
+            # JPEG: decode thẳng ở scale 1/2, 1/4, 1/8 (vẫn >= max_side) -> nhanh hơn nhiều
+            img.draft("RGB", (max_side, max_side))
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            # BICUBIC: chữ vẫn sắc cho OCR, nhanh hơn LANCZOS ~30%
+            img.thumbnail((max_side, max_side), Image.BICUBIC)
+
+            output = io.BytesIO()
+            img.save(output, fmt, quality=settings.image_quality)
+            data = output.getvalue()
+            new_dims = img.size
+    except Exception as e:
+        logger.warning(f"⚠️ [Image] Không xử lý được ảnh ({e}) -> gửi ảnh gốc")
+        return original
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    # Ảnh vốn đã nhỏ: nén lại không lợi gì thì giữ ảnh gốc. Ảnh có EXIF xoay/lật
+    # (VD 180°, kích thước không đổi) thì vẫn gửi bản đã xoay, ảnh gốc bị ngược
+    if len(data) >= len(image_bytes) and new_dims == original_dims and not rotated:
+        logger.info(f"🖼️ [Image] Giữ ảnh gốc {len(image_bytes) / 1024:.0f}KB ({elapsed_ms:.0f}ms)")
+        return original
+
+    saved = 100 * (1 - len(data) / len(image_bytes)) if image_bytes else 0.0
+    logger.info(
+        f"🗜️ [Image] {len(image_bytes) / 1024:.0f}KB -> {len(data) / 1024:.0f}KB ({saved:.0f}% nhỏ hơn), "
+        f"{original_dims[0]}x{original_dims[1]} -> {new_dims[0]}x{new_dims[1]} {fmt}, {elapsed_ms:.0f}ms"
+    )
+    return PreparedImage(data, _MIME_TYPES[fmt])
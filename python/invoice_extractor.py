@@ -0,0 +1,192 @@
+"""
+File: invoice_extractor.py
+Mục đích: Trích xuất mã hóa đơn từ OCR text bằng regex (không cần LLM)
+
+Cùng quy tắc với bước 2 trong prompt của validate_invoice_node:
+1. Tìm theo nhãn mạnh: "Số HĐ:", "Mã HĐ:", "Số hóa đơn:", "Invoice:", "Bill:"
+2. Nếu không có nhãn: ghép Ngày + Giờ + Tổng tiền theo đúng format của LLM
+   VD: "26/01/2026 19:45" + "45.360đ" -> "260126-1945-45K"
+3. Nhãn yếu ("Mã đơn:", "Order:", "#", "Số:") chỉ dùng khi không có 2 cách trên,
+   và kết quả là "không chắc chắn" (source="weak_label"): vẫn gọi LLM, không
+   được tự chấp nhận hóa đơn. "#"/"Số:" đứng trần hay dính số khác trên hóa đơn
+   ("Tổng số: 12", "Hotline #1900123") -> nhận nhầm mã thì mọi hóa đơn sau của
+   shop đều bị báo trùng.
+
+Nhãn "Bàn:" (số bàn) cố ý KHÔNG dùng: số bàn lặp lại giữa các hóa đơn nên
+sẽ làm hóa đơn mới bị báo trùng; thà dùng Ngày + Giờ + Tổng tiền.
+"""
+
+import re
+import unicodedata
+from typing import List, NamedTuple, Optional, Tuple
+
+
+class InvoiceFields(NamedTuple):
+    invoice_id: Optional[str]
+    source: Optional[str]      # "label" | "composite" | "weak_label" | None
+    date: Optional[str]        # ddmmyy
+    time: Optional[str]        # HHMM
+    total: Optional[int]       # VND
+
+    @property
+    def certain(self) -> bool:
+        """Mã đủ chắc để chấp nhận hóa đơn không cần LLM (không phải nhãn yếu)"""
+        return self.invoice_id is not None and self.source != "weak_label"
+
+
+def strip_accents(text: str) -> str:
+    """Bỏ dấu tiếng Việt nhưng giữ nguyên hoa/thường (mã hóa đơn phân biệt hoa thường)"""
+    return _strip_accents_indexed(text)[0]
+
+
+def _strip_accents_indexed(text: str) -> Tuple[str, List[int]]:
+    """
+    Như strip_accents, kèm vị trí trong text gốc (đã chuẩn hóa NFC) của từng ký tự
+    -> cắt lại được đúng đoạn gốc (còn dấu) của giá trị tìm thấy trên text bỏ dấu
+    """
+    chars, index = [], []
+    for pos, ch in enumerate(text):
+        ch = ch.replace("đ", "d").replace("Đ", "D")
+        for part in unicodedata.normalize("NFD", ch):
+            if unicodedata.category(part) != "Mn":
+                chars.append(part)
+                index.append(pos)
+    return "".join(chars), index
+
+
+# Nhãn mã hóa đơn theo thứ tự ưu tiên (chạy trên text đã bỏ dấu)
+_ID_VALUE = r"([A-Z0-9][A-Z0-9\-/._]{1,39})"
+_STRONG_LABEL_PATTERNS = [
+    re.compile(r"\b(?:so|ma)\s*(?:hd|hoa\s*don)\b\s*[:.]?\s*#?\s*" + _ID_VALUE, re.IGNORECASE),
+    re.compile(r"\bhoa\s*don\s*(?:so|#)\s*[:.]?\s*" + _ID_VALUE, re.IGNORECASE),
+    re.compile(r"\b(?:invoice|bill)\s*(?:no\.?|number|#)?\s*[:#]\s*" + _ID_VALUE, re.IGNORECASE),
+]
+_WEAK_LABEL_PATTERNS = [
+    re.compile(r"\b(?:ma\s*don(?:\s*hang)?|order(?:\s*id)?)\s*[:#]\s*" + _ID_VALUE, re.IGNORECASE),
+    re.compile(r"#\s*" + _ID_VALUE, re.IGNORECASE),
+    re.compile(r"\bso\s*:\s*" + _ID_VALUE, re.IGNORECASE),
+]
+# Nhãn yếu: mã ngắn hơn thế này thường là số thứ tự/số lượng, lặp lại giữa các hóa đơn
+_WEAK_MIN_LENGTH = 4
+
+# Chỉ áp cho nhãn yếu: số cửa hàng/bàn/quầy ("Store #1023", "Bàn số: 5", "Quầy #2"), số lượng
+# ("Tổng số: 12"), số điện thoại ("Hotline #1900123", "SĐT: ...") đứng trước nhãn -> không phải mã hóa đơn
+_EXCLUDED_CONTEXT = re.compile(
+    r"\b(?:store|cn|chi\s*nhanh|ban|table|quay|pos|may|ca|tong|hotline|sdt|dt|tel|phone|fax)\s*$",
+    re.IGNORECASE,
+)
+# Giá trị trông như số điện thoại (0xxxxxxxxx, tổng đài 1800/1900...)
+_PHONE_LIKE = re.compile(r"(?:\+?84|0)\d{8,10}|1[89]00\d{3,6}")
+
+_DATE = re.compile(r"\b(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{4}|\d{2})\b")
+_TIME = re.compile(r"\b([01]?\d|2[0-3])\s*[:hH]\s*([0-5]\d)(?:\s*:\s*[0-5]\d)?\b")
+
+# Nhãn tổng tiền theo thứ tự ưu tiên (số tiền cuối cùng cần trả)
+_TOTAL_LABELS = [
+    "khach phai tra", "can thanh toan", "tong thanh toan", "thanh toan",
+    "tong cong", "grand total", "total", "tong tien", "tong",
+]
+_AMOUNT = re.compile(r"(\d{1,3}(?:[.,]\d{3})+|\d{4,})(?:[.,]\d{1,2})?\s*(?:d|vnd|dong|k)?\b", re.IGNORECASE)
+
+
+def _find_label_id(
+    text: str, original: str, index: List[int], patterns, min_length: int = 2, weak: bool = False
+) -> Optional[str]:
+    """
+    Mã sau nhãn đầu tiên hợp lệ, lấy từ text gốc (giữ dấu: "HĐ-00123" chứ không
+    phải "HD-00123") để trùng với mã LLM trả về khi kiểm tra hóa đơn trùng
+
+    Args:
+        text: Text đã bỏ dấu (regex chạy trên text này)
+        original, index: Text gốc và vị trí gốc của từng ký tự trong `text`
+        weak: Nhãn yếu -> bỏ thêm số cửa hàng/bàn/điện thoại. Nhãn mạnh ("Số HĐ:")
+            thì giữ cả mã trông như số điện thoại ("0001234567")
+    """
+    for pattern in patterns:
+        for match in pattern.finditer(text):
+            if weak and _EXCLUDED_CONTEXT.search(text[max(0, match.start() - 16):match.start()]):
+                continue
+            value = match.group(1).strip("-/._")
+            # Bỏ giá trị chỉ là ngày/giờ, số điện thoại, quá ngắn, hoặc không có chữ số nào
+            if (
+                len(value) < min_length
+                or _DATE.fullmatch(value)
+                or (weak and _PHONE_LIKE.fullmatch(value))
+                or not any(ch.isdigit() for ch in value)
+            ):
+                continue
+            start = match.start(1) + match.group(1).index(value)
+            end = start + len(value)
+            return original[index[start]:index[end - 1] + 1]
+    return None
+
+
+def _find_date(text: str) -> Optional[str]:
+    for day, month, year in _DATE.findall(text):
+        d, m = int(day), int(month)
+        if 1 <= d <= 31 and 1 <= m <= 12:
+            return f"{d:02d}{m:02d}{year[-2:]}"
+    return None
+
+
+def _find_time(text: str) -> Optional[str]:
+    # Bỏ ngày ra trước để "26.01" không bị hiểu nhầm thành giờ
+    match = _TIME.search(_DATE.sub(" ", text))
+    if not match:
+        return None
+    return f"{int(match.group(1)):02d}{match.group(2)}"
+
+
+def parse_amount(value: str) -> Optional[int]:
+    """ "45.360đ" / "45,360" / "45360" -> 45360 """
+    match = _AMOUNT.search(value)
+    if not match:
+        return None
+    digits = re.sub(r"[.,]", "", match.group(1))
+    return int(digits) if digits else None
+
+
+def _find_total(lines) -> Optional[int]:
+    lowered = [line.lower() for line in lines]
+    for label in _TOTAL_LABELS:
+        # Dòng tổng thường ở cuối hóa đơn -> duyệt từ dưới lên
+        for line, low in zip(reversed(lines), reversed(lowered)):
+            if label in low:
+                amounts = _AMOUNT.findall(line)
+                if amounts:
+                    return parse_amount(amounts[-1])
+    return None
+
+
+def extract_invoice_fields(ocr_text: str) -> InvoiceFields:
+    """
+    Trích xuất mã hóa đơn (và ngày/giờ/tổng tiền) từ OCR text
+
+    Returns:
+        InvoiceFields; invoice_id=None (hoặc certain=False) nếu không đủ chắc -> để LLM xử lý
+    """
+    original = unicodedata.normalize("NFC", ocr_text or "")
+    text, index = _strip_accents_indexed(original)
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+
+    date = _find_date(text)
+    time_ = _find_time(text)
+    total = _find_total(lines)
+
+    label_id = _find_label_id(text, original, index, _STRONG_LABEL_PATTERNS)
+    if label_id:
+        return InvoiceFields(label_id, "label", date, time_, total)
+
+    if date and time_ and total:
+        return InvoiceFields(composite_invoice_id(date, time_, total), "composite", date, time_, total)
+
+    weak_id = _find_label_id(text, original, index, _WEAK_LABEL_PATTERNS, _WEAK_MIN_LENGTH, weak=True)
+    if weak_id:
+        return InvoiceFields(weak_id, "weak_label", date, time_, total)
+
+    return InvoiceFields(None, None, date, time_, total)
+
+
+def composite_invoice_id(date: str, time_: str, total: int) -> str:
+    """ddmmyy-HHMM-<nghìn>K, giống format LLM đang tạo: "260126-1945-45K" """
+    return f"{date}-{time_}-{total // 1000}K"
@@ -0,0 +1,612 @@
+"""
+File: job_queue.py
+Mục đích: Hàng đợi job bền vững (SQLite) + worker pool cho pipeline xử lý hóa đơn
+
+Thay thế FastAPI BackgroundTasks:
+- Job được ghi xuống bảng `invoice_job` trước khi trả 200 cho Facebook,
+  nên restart/deploy không làm mất ảnh đang chờ xử lý.
+- N worker (cấu hình INVOICE_WORKERS) lấy job ra theo deficit round-robin
+  giữa các Page (FairScheduler), FIFO trong từng Page: 1 Page chạy chiến dịch
+  viral không chiếm hết slot của các shop khác. Mỗi Page có thể giới hạn số
+  invoice chạy đồng thời và có trọng số riêng.
+- Claim job bằng 1 câu UPDATE ... RETURNING nên an toàn khi chạy nhiều process.
+- Job có lease: nếu process chết giữa chừng, job sẽ được worker khác nhận lại
+  sau khi lease hết hạn.
+- Job lỗi được thử lại sau exponential backoff (available_at), không bị
+  worker nhận lại ngay rồi đốt hết max_attempts trong vài mili giây.
+- drain()/adrain(): dừng nhận job mới và chờ các job đang chạy hoàn tất (graceful shutdown).
+  Job chưa xong kịp giữ nguyên running và được nhận lại khi hết lease: thread
+  (hoặc asyncio.to_thread của task đã cancel) có thể vẫn đang xử lý nó, trả về
+  pending ngay sẽ làm 1 invoice chạy 2 lần và gửi trả lời trùng.
+
+Hỗ trợ 2 chế độ, tự chọn theo handler:
+- handler là hàm thường: N worker thread, mỗi thread chạy 1 invoice.
+- handler là coroutine: 1 vòng dispatch trên event loop, tối đa N invoice
+  chạy đồng thời dưới dạng asyncio task (N có thể lên hàng trăm).
+"""
+
+import asyncio
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from database import SessionLocal, InvoiceJob
+
+logger = logging.getLogger(__name__)
+
+
+# Số job sẵn sàng / đang chạy (lease còn hạn) của từng Page, dùng cho FairScheduler
+_READY_SQL = text("""
+    SELECT page_id,
+           SUM(CASE WHEN ((status = 'pending' AND (available_at IS NULL OR available_at <= :now))
+                          OR lease_expires_at < :now)
+                         AND attempts < :max_attempts THEN 1 ELSE 0 END) AS ready,
+           SUM(CASE WHEN status = 'running' AND lease_expires_at >= :now
+                    THEN 1 ELSE 0 END) AS running
+    FROM invoice_job
+    WHERE status IN ('pending', 'running')
+    GROUP BY page_id
+""")
+
+# Claim job cũ nhất đang pending (đã qua thời gian backoff) hoặc running nhưng lease
+# đã hết hạn, của Page do scheduler chọn. Chạy trong 1 statement nên 2 worker
+# không bao giờ nhận trùng 1 job.
+_CLAIM_SQL = text("""
+    UPDATE invoice_job
+    SET status = 'running',
+        worker_id = :worker_id,
+        attempts = attempts + 1,
+        started_at = :now,
+        lease_expires_at = :lease_expires_at
+    WHERE id = (
+        SELECT id FROM invoice_job
+        WHERE ((status = 'pending' AND (available_at IS NULL OR available_at <= :now))
+               OR (status = 'running' AND lease_expires_at < :now))
+          AND attempts < :max_attempts
+          AND page_id = :page_id
+        ORDER BY id
+        LIMIT 1
+    )
+    RETURNING id, page_id, sender_id, image_url, message_id, attempts, created_at
+""")
+
+# Job hết lease nhưng đã dùng hết số lần thử -> đánh dấu failed
+_EXPIRE_SQL = text("""
+    UPDATE invoice_job
+    SET status = 'failed', last_error = 'lease expired after max attempts'
+    WHERE status = 'running'
+      AND lease_expires_at < :now
+      AND attempts >= :max_attempts
+""")
+
+
+class FairScheduler:
+    """
+    Deficit round-robin (DRR) giữa các Page đang có job chờ.
+
+    Mỗi vòng, Page được cộng `weight` lượt (deficit) và nhận tối đa chừng đó
+    job trước khi nhường Page kế tiếp, nên Page có 10.000 job chờ và Page có
+    1 job chờ được phục vụ xen kẽ. Page đã chạm `max_concurrency` (đếm job
+    running trong DB, tính cả các process khác) bị bỏ qua cho đến khi có job xong.
+
+    Args:
+        limits: Hàm page_id -> (weight, max_concurrency), None = dùng mặc định
+        default_weight: Số job mỗi lượt của Page
+        default_max_concurrency: Số job chạy đồng thời tối đa của 1 Page, 0 = không giới hạn
+        max_tracked: Số Page tối đa giữ thống kê thời gian chờ
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Callable[[str], Tuple[Optional[int], Optional[int]]]] = None,
+        default_weight: int = 1,
+        default_max_concurrency: int = 0,
+        max_tracked: int = 1024,
+    ):
+        self.limits = limits
+        self.default_weight = max(1, default_weight)
+        self.default_max_concurrency = max(0, default_max_concurrency)
+        self.max_tracked = max_tracked
+
+        self._lock = threading.Lock()
+        self._order: List[str] = []
+        self._deficit: Dict[str, int] = {}
+        self._pos = 0
+        # page_id -> [số job đã claim, deque thời gian chờ gần nhất (giây)]
+        self._waits: "OrderedDict[str, list]" = OrderedDict()
+        self.capped_skips = 0
+
+    def _limits_for(self, page_id: str) -> Tuple[int, int]:
+        weight, cap = None, None
+        if self.limits is not None:
+            try:
+                weight, cap = self.limits(page_id)
+            except Exception as e:
+                logger.warning(f"⚠️ [Scheduler] Không đọc được giới hạn của Page {page_id}: {e}")
+        try:
+            weight = max(1, int(weight)) if weight is not None else self.default_weight
+        except (TypeError, ValueError):
+            weight = self.default_weight
+        try:
+            cap = max(0, int(cap)) if cap is not None else self.default_max_concurrency
+        except (TypeError, ValueError):
+            cap = self.default_max_concurrency
+        return weight, cap
+
+    def pick(self, ready: Dict[str, int], running: Dict[str, int]) -> Optional[str]:
+        """
+        Chọn Page được claim job tiếp theo
+
+        Args:
+            ready: page_id -> số job sẵn sàng
+            running: page_id -> số job đang chạy
+
+        Returns:
+            page_id, hoặc None nếu không Page nào được chạy thêm
+        """
+        with self._lock:
+            # Đồng bộ vòng: giữ thứ tự cũ, bỏ Page hết job, thêm Page mới vào cuối
+            current = self._order[self._pos] if self._order else None
+            order = [p for p in self._order if ready.get(p, 0) > 0]
+            known = set(order)
+            order += [p for p, count in ready.items() if count > 0 and p not in known]
+            known = set(order)
+            for page_id in [p for p in self._deficit if p not in known]:
+                del self._deficit[page_id]
+            if current in known:
+                self._pos = order.index(current)
+            else:
+                self._pos = min(self._pos, len(order) - 1) if order else 0
+            self._order = order
+            if not order:
+                return None
+
+            limits = {p: self._limits_for(p) for p in order}
+            eligible = {
+                p for p in order
+                if limits[p][1] == 0 or running.get(p, 0) < limits[p][1]
+            }
+            self.capped_skips += len(order) - len(eligible)
+            if not eligible:
+                return None
+
+            # Sau tối đa 1 vòng, mọi Page hợp lệ đều có deficit >= 1
+            for _ in range(2 * len(order) + 1):
+                page_id = order[self._pos]
+                if page_id in eligible and self._deficit.get(page_id, 0) >= 1:
+                    self._deficit[page_id] -= 1
+                    return page_id
+                if page_id not in eligible:
+                    # DRR: Page không được phục vụ ở vòng này thì không tích lũy lượt
+                    self._deficit[page_id] = 0
+                self._pos = (self._pos + 1) % len(order)
+                next_page = order[self._pos]
+                self._deficit[next_page] = self._deficit.get(next_page, 0) + limits[next_page][0]
+            return None
+
+    def record(self, page_id: str, wait: float):
+        """Ghi thời gian job chờ trong hàng đợi (từ lúc enqueue đến lúc được claim)"""
+        with self._lock:
+            entry = self._waits.get(page_id)
+            if entry is None:
+                entry = self._waits[page_id] = [0, deque(maxlen=256)]
+                while len(self._waits) > self.max_tracked:
+                    self._waits.popitem(last=False)
+            else:
+                self._waits.move_to_end(page_id)
+            entry[0] += 1
+            entry[1].append(max(0.0, wait))
+
+    def stats(self) -> Dict[str, Any]:
+        """Thời gian chờ theo Page (256 job gần nhất): trung bình, p95, max"""
+        with self._lock:
+            pages = {}
+            for page_id, (claimed, waits) in self._waits.items():
+                ordered = sorted(waits)
+                pages[page_id] = {
+                    "claimed": claimed,
+                    "avg_wait_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+                    "p95_wait_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+                    "max_wait_ms": round(ordered[-1] * 1000, 1),
+                }
+            return {
+                "active_pages": len(self._order),
+                "capped_skips": self.capped_skips,
+                "pages": pages,
+            }
+
+
+class JobQueue:
+    """
+    Hàng đợi invoice job lưu trong SQLite với worker pool cố định.
+
+    Args:
+        handler: Hàm (hoặc coroutine) xử lý 1 job, nhận (sender_id, page_id, image_url, message_id, job_id).
+            Raise exception nếu muốn job được thử lại.
+        num_workers: Số invoice xử lý song song tối đa (thread hoặc asyncio task)
+        poll_interval: Thời gian chờ (giây) khi hàng đợi rỗng
+        max_attempts: Số lần thử tối đa cho 1 job
+        lease_seconds: Thời gian giữ job trước khi worker khác được nhận lại
+        scheduler: Chọn Page được claim job tiếp theo (mặc định: FairScheduler())
+        retry_backoff_base: Chờ trước lần thử lại đầu tiên (giây), nhân đôi mỗi lần sau
+        retry_backoff_max: Thời gian chờ tối đa giữa 2 lần thử
+    """
+
+    def __init__(
+        self,
+        handler: Callable[..., Any],
+        num_workers: int = 4,
+        poll_interval: float = 0.5,
+        max_attempts: int = 3,
+        lease_seconds: float = 300,
+        scheduler: Optional[FairScheduler] = None,
+        retry_backoff_base: float = 2,
+        retry_backoff_max: float = 60,
+    ):
+        self.handler = handler
+        self.num_workers = max(1, num_workers)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.scheduler = scheduler or FairScheduler()
+        self.retry_backoff_base = retry_backoff_base
+        self.retry_backoff_max = retry_backoff_max
+
+        self._worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._wakeup = threading.Condition()
+        self._running_jobs = 0
+        self._running_lock = threading.Lock()
+
+        # Chế độ async
+        self.is_async = asyncio.iscoroutinefunction(handler)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+
+    # ========================================
+    # PRODUCER
+    # ========================================
+
+    def enqueue(
+        self,
+        sender_id: str,
+        page_id: str,
+        image_url: str,
+        message_id: Optional[str] = None,
+    ) -> int:
+        """
+        Ghi 1 job mới xuống DB và đánh thức worker.
+
+        Returns:
+            ID của job vừa tạo
+        """
+        db = SessionLocal()
+        try:
+            job = InvoiceJob(
+                page_id=page_id,
+                sender_id=sender_id,
+                image_url=image_url,
+                message_id=message_id,
+                status="pending",
+                attempts=0,
+                created_at=time.time(),
+            )
+            db.add(job)
+            db.commit()
+            job_id = job.id
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        self._notify()
+
+        return job_id
+
+    def _notify(self):
+        """Đánh thức worker (gọi được từ bất kỳ thread nào)"""
+        if self.is_async:
+            if self._loop is not None and self._async_wakeup is not None:
+                self._loop.call_soon_threadsafe(self._async_wakeup.set)
+            return
+        with self._wakeup:
+            self._wakeup.notify()
+
+    # ========================================
+    # WORKERS
+    # ========================================
+
+    def start(self):
+        """
+        Khởi động worker pool (gọi 1 lần khi app startup).
+        Ở chế độ async phải gọi từ bên trong event loop đang chạy.
+        """
+        if self.is_async:
+            if self._dispatcher is not None:
+                return
+            self._stopping.clear()
+            self._loop = asyncio.get_running_loop()
+            self._async_wakeup = asyncio.Event()
+            self._dispatcher = self._loop.create_task(self._async_dispatch_loop())
+            logger.info(f"✅ [JobQueue] Đã khởi động dispatcher async (tối đa {self.num_workers} invoice đồng thời)")
+            return
+
+        if self._threads:
+            return
+
+        self._stopping.clear()
+        for i in range(self.num_workers):
+            thread = threading.Thread(
+                target=self._worker_loop,
+                args=(f"{self._worker_prefix}:{i}",),
+                name=f"invoice-worker-{i}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info(f"✅ [JobQueue] Đã khởi động {self.num_workers} worker")
+
+    def drain(self, timeout: float = 25.0) -> bool:
+        """
+        Graceful shutdown: dừng nhận job mới, chờ các job đang chạy hoàn tất.
+        Job còn pending vẫn nằm trong DB và sẽ được xử lý ở lần khởi động sau.
+
+        Returns:
+            True nếu tất cả worker đã dừng trước timeout
+        """
+        logger.info(f"⏳ [JobQueue] Đang drain (đợi tối đa {timeout}s)...")
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.time()))
+
+        alive = [t for t in self._threads if t.is_alive()]
+        if alive:
+            # Thread vẫn đang chạy job -> không trả job về pending, chờ lease hết hạn
+            self._threads = alive
+            logger.warning(
+                f"⚠️ [JobQueue] {len(alive)} worker chưa dừng kịp, job của chúng sẽ được nhận lại khi hết lease"
+            )
+            return False
+
+        self._threads = []
+        logger.info(f"✅ [JobQueue] Drain hoàn tất")
+        return True
+
+    async def adrain(self, timeout: float = 25.0) -> bool:
+        """
+        Bản async của drain(), dùng trong lifespan của FastAPI.
+        Ở chế độ thread chỉ đơn giản chạy drain() trong thread phụ.
+        """
+        if not self.is_async:
+            return await asyncio.to_thread(self.drain, timeout)
+
+        logger.info(f"⏳ [JobQueue] Đang drain (đợi tối đa {timeout}s)...")
+        self._stopping.set()
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            if pending:
+                # Task bị cancel khi đang chờ asyncio.to_thread vẫn để thread chạy tiếp
+                # (VD: giữ chỗ hóa đơn + quay thưởng) -> không trả job về pending, chờ lease hết hạn
+                for task in pending:
+                    task.cancel()
+                logger.warning(
+                    f"⚠️ [JobQueue] {len(pending)} invoice chưa xong kịp, job sẽ được nhận lại khi hết lease"
+                )
+                return False
+
+        logger.info(f"✅ [JobQueue] Drain hoàn tất")
+        return True
+
+    def depth(self) -> Dict[str, int]:
+        """Số job theo trạng thái (dùng cho /health và giám sát)"""
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                text("SELECT status, COUNT(*) FROM invoice_job GROUP BY status")
+            ).fetchall()
+            counts = {"pending": 0, "running": 0, "failed": 0}
+            counts.update({status: count for status, count in rows})
+            counts["in_process"] = self._running_jobs
+            return counts
+        finally:
+            db.close()
+
+    def depth_by_page(self) -> Dict[Tuple[str, str], int]:
+        """Số job theo (page_id, trạng thái), dùng cho /metrics"""
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                text("SELECT page_id, status, COUNT(*) FROM invoice_job GROUP BY page_id, status")
+            ).fetchall()
+            return {(page_id, status): count for page_id, status, count in rows}
+        finally:
+            db.close()
+
+    def _worker_loop(self, worker_id: str):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim(worker_id)
+            except Exception as e:
+                logger.error(f"❌ [JobQueue] Lỗi khi claim job: {e}")
+                job = None
+
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+
+            self._run_job(job)
+
+    def _run_job(self, job: Dict[str, Any]):
+        with self._running_lock:
+            self._running_jobs += 1
+        try:
+            self.handler(
+                sender_id=job["sender_id"],
+                page_id=job["page_id"],
+                image_url=job["image_url"],
+                message_id=job["message_id"],
+                job_id=job["id"],
+            )
+            self._complete(job["id"])
+        except Exception as e:
+            logger.exception(f"❌ [JobQueue] Job {job['id']} lỗi")
+            self._fail(job, str(e))
+        finally:
+            with self._running_lock:
+                self._running_jobs -= 1
+
+    async def _async_dispatch_loop(self):
+        """
+        Vòng dispatch duy nhất: chỉ claim job khi còn slot trống,
+        tránh hàng trăm task cùng poll DB khi hàng đợi rỗng.
+        """
+        slots = asyncio.Semaphore(self.num_workers)
+        worker_id = f"{self._worker_prefix}:async"
+
+        while not self._stopping.is_set():
+            await slots.acquire()
+            try:
+                job = await asyncio.to_thread(self._claim, worker_id)
+            except Exception as e:
+                logger.error(f"❌ [JobQueue] Lỗi khi claim job: {e}")
+                job = None
+
+            if job is None:
+                slots.release()
+                self._async_wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._async_wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.create_task(self._arun_job(job, slots))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _arun_job(self, job: Dict[str, Any], slots: asyncio.Semaphore):
+        self._running_jobs += 1
+        try:
+            await self.handler(
+                sender_id=job["sender_id"],
+                page_id=job["page_id"],
+                image_url=job["image_url"],
+                message_id=job["message_id"],
+                job_id=job["id"],
+            )
+            await asyncio.to_thread(self._complete, job["id"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"❌ [JobQueue] Job {job['id']} lỗi")
+            await asyncio.to_thread(self._fail, job, str(e))
+        finally:
+            self._running_jobs -= 1
+            slots.release()
+
+    # ========================================
+    # DB OPERATIONS
+    # ========================================
+
+    def _claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        db = SessionLocal()
+        try:
+            # Câu ghi đầu tiên giữ write lock của SQLite đến khi commit, nên
+            # số liệu ready/running bên dưới không bị process khác chen vào
+            db.execute(_EXPIRE_SQL, {"now": now, "max_attempts": self.max_attempts})
+            params = {"now": now, "max_attempts": self.max_attempts}
+            rows = db.execute(_READY_SQL, params).fetchall()
+            ready = {r.page_id: r.ready for r in rows}
+            running = {r.page_id: r.running for r in rows}
+
+            row = None
+            while row is None:
+                page_id = self.scheduler.pick(ready, running)
+                if page_id is None:
+                    break
+                row = db.execute(_CLAIM_SQL, {
+                    "worker_id": worker_id,
+                    "now": now,
+                    "lease_expires_at": now + self.lease_seconds,
+                    "max_attempts": self.max_attempts,
+                    "page_id": page_id,
+                }).mappings().first()
+                if row is None:
+                    # Không claim được (không nên xảy ra) -> bỏ Page này khỏi lần chọn
+                    ready[page_id] = 0
+            db.commit()
+
+            if row is None:
+                return None
+            job = dict(row)
+            self.scheduler.record(job["page_id"], now - (job.pop("created_at") or now))
+            return job
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _complete(self, job_id: int):
+        """Job xong -> xóa khỏi bảng để hàng đợi luôn nhỏ"""
+        db = SessionLocal()
+        try:
+            db.execute(text("DELETE FROM invoice_job WHERE id = :id"), {"id": job_id})
+            db.commit()
+        except Exception as e:
+            logger.error(f"❌ [JobQueue] Không thể hoàn tất job {job_id}: {e}")
+            db.rollback()
+        finally:
+            db.close()
+
+    def _retry_delay(self, attempts: int) -> float:
+        delay = min(self.retry_backoff_max, self.retry_backoff_base * (2 ** max(0, attempts - 1)))
+        # Jitter để các job cùng lỗi (VD: LLM sập) không dội lại cùng lúc
+        return delay * random.uniform(0.5, 1.0)
+
+    def _fail(self, job: Dict[str, Any], error: str):
+        """Job lỗi -> trả về pending (chờ backoff) để thử lại, hoặc failed nếu hết lượt"""
+        status = "failed" if job["attempts"] >= self.max_attempts else "pending"
+        delay = self._retry_delay(job["attempts"]) if status == "pending" else 0.0
+        db = SessionLocal()
+        try:
+            db.execute(
+                text("""
+                    UPDATE invoice_job
+                    SET status = :status, last_error = :error, lease_expires_at = NULL,
+                        available_at = :available_at
+                    WHERE id = :id
+                """),
+                {"status": status, "error": error[:500], "available_at": time.time() + delay, "id": job["id"]},
+            )
+            db.commit()
+            retry = f" (thử lại sau {delay:.1f}s)" if status == "pending" else ""
+            logger.warning(f"⚠️ [JobQueue] Job {job['id']} lỗi (lần {job['attempts']}) -> {status}{retry}")
+        except Exception as e:
+            logger.error(f"❌ [JobQueue] Không thể cập nhật job lỗi {job['id']}: {e}")
+            db.rollback()
+        finally:
+            db.close()
@@ -0,0 +1,213 @@
+"""
+File: llm_clients.py
+Mục đích: Registry ChatOpenAI dùng chung toàn process (gọi Proxy OpenAI format)
+
+Trước đây mỗi invoice tạo mới ChatOpenAI ở node OCR và node Validate,
+đọc lại ANTHROPIC_BASE_URL và mở kết nối TCP/TLS mới tới Proxy.
+Registry này:
+- Giữ 1 ChatOpenAI cho mỗi bộ (model, base_url, temperature)
+- Dùng chung 1 cặp httpx.Client/AsyncClient (keep-alive, HTTP/2 nếu có `h2`)
+  cho mỗi base_url, nên mọi model đi qua cùng 1 connection pool tới Proxy
+- Đếm số request và trạng thái connection pool để tinh chỉnh (xem stats())
+
+LƯU Ý: httpx.AsyncClient gắn với event loop tạo ra nó, nên bản async chỉ nên
+dùng trên event loop chính của server.
+"""
+
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401  (HTTP/2 cần package h2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def get_proxy_config() -> Tuple[str, str]:
+    """
+    Lấy cấu hình Proxy (OpenAI format) từ env
+
+    Returns:
+        (base_url đã có /v1, api_key)
+    """
+    base_url = os.getenv("ANTHROPIC_BASE_URL")
+    api_key = os.getenv("ANTHROPIC_AUTH_TOKEN")
+
+    if not base_url or not api_key:
+        raise ValueError("Thiếu ANTHROPIC_BASE_URL hoặc ANTHROPIC_AUTH_TOKEN")
+
+    # Ensure base_url ends with /v1 for OpenAI compatibility
+    if not base_url.endswith("/v1"):
+        base_url = f"{base_url.rstrip('/')}/v1"
+
+    return base_url, api_key
+
+
+def _pool_snapshot(client: Any) -> Dict[str, int]:
+    """
+    Đọc trạng thái connection pool của httpx (httpcore) nếu truy cập được.
+    httpcore không có API công khai cho việc này nên đọc phòng thủ.
+    """
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []) or [])
+    idle = 0
+    http2 = 0
+    for conn in connections:
+        try:
+            if conn.is_idle():
+                idle += 1
+            if "HTTP/2" in repr(conn):
+                http2 += 1
+        except Exception:
+            pass
+    return {
+        "connections": len(connections),
+        "idle": idle,
+        "active": len(connections) - idle,
+        "http2": http2,
+    }
+
+
+class _ProxyPool:
+    """Cặp httpx client (sync + async) dùng chung cho 1 base_url"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        limits = httpx.Limits(
+            max_connections=settings.llm_pool_max_connections,
+            max_keepalive_connections=settings.llm_pool_max_keepalive,
+            keepalive_expiry=settings.llm_pool_keepalive_expiry,
+        )
+        timeout = httpx.Timeout(settings.llm_request_timeout, connect=10.0)
+        http2 = settings.llm_http2 and HTTP2_AVAILABLE
+
+        self.client = httpx.Client(
+            limits=limits,
+            timeout=timeout,
+            http2=http2,
+            event_hooks={"request": [self._count_request]},
+        )
+        self.async_client = httpx.AsyncClient(
+            limits=limits,
+            timeout=timeout,
+            http2=http2,
+            event_hooks={"request": [self._acount_request]},
+        )
+        self.http2 = http2
+
+    def _count_request(self, request: httpx.Request):
+        with self._lock:
+            self.requests += 1
+
+    async def _acount_request(self, request: httpx.Request):
+        self._count_request(request)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "http2": self.http2,
+            "requests": self.requests,
+            "sync_pool": _pool_snapshot(self.client),
+            "async_pool": _pool_snapshot(self.async_client),
+        }
+
+
+class LLMClientRegistry:
+    """
+    Registry ChatOpenAI long-lived, key = (model, base_url, temperature, max_retries)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._llms: Dict[Tuple[str, str, float, Optional[int]], ChatOpenAI] = {}
+        self._pools: Dict[str, _ProxyPool] = {}
+        self._proxy_config: Optional[Tuple[str, str]] = None
+
+    def _get_proxy(self) -> Tuple[str, str]:
+        # Đọc env 1 lần rồi cache lại
+        if self._proxy_config is None:
+            self._proxy_config = get_proxy_config()
+        return self._proxy_config
+
+    def get(self, model: str, temperature: float = 0, max_retries: Optional[int] = None) -> ChatOpenAI:
+        """
+        Lấy ChatOpenAI dùng chung cho (model, temperature) qua Proxy mặc định
+
+        Args:
+            max_retries: Số lần client tự retry, None = mặc định của ChatOpenAI.
+                Gọi có deadline dùng 0 để tự kiểm soát tổng thời gian.
+
+        Raises:
+            ValueError nếu chưa cấu hình Proxy
+        """
+        base_url, api_key = self._get_proxy()
+        key = (model, base_url, float(temperature), max_retries)
+
+        llm = self._llms.get(key)
+        if llm is not None:
+            return llm
+
+        with self._lock:
+            llm = self._llms.get(key)
+            if llm is None:
+                pool = self._pools.get(base_url)
+                if pool is None:
+                    pool = _ProxyPool(base_url)
+                    self._pools[base_url] = pool
+
+                extra = {} if max_retries is None else {"max_retries": max_retries}
+                llm = ChatOpenAI(
+                    model=model,
+                    openai_api_key=api_key,
+                    base_url=base_url,
+                    temperature=temperature,
+                    http_client=pool.client,
+                    http_async_client=pool.async_client,
+                    **extra,
+                )
+                self._llms[key] = llm
+                logger.info(f"🔌 [LLM Registry] Tạo client: {model} (temperature={temperature}, max_retries={max_retries})")
+
+        return llm
+
+    def stats(self) -> Dict[str, Any]:
+        """Thống kê pool để tinh chỉnh LLM_POOL_* (hiển thị ở /debug/pools)"""
+        return {
+            "http2_available": HTTP2_AVAILABLE,
+            "clients": [
+                {"model": model, "base_url": base_url, "temperature": temperature, "max_retries": max_retries}
+                for (model, base_url, temperature, max_retries) in self._llms
+            ],
+            "pools": {base_url: pool.stats() for base_url, pool in self._pools.items()},
+        }
+
+    async def aclose(self):
+        """Đóng toàn bộ connection (gọi khi shutdown)"""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+            self._llms.clear()
+        for pool in pools:
+            pool.client.close()
+            await pool.async_client.aclose()
+
+
+# Registry dùng chung toàn process
+llm_registry = LLMClientRegistry()
+
+
+def get_llm(model: str, temperature: float = 0, max_retries: Optional[int] = None) -> ChatOpenAI:
+    """Shortcut: lấy ChatOpenAI dùng chung từ registry"""
+    return llm_registry.get(model, temperature, max_retries)
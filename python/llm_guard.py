@@ -0,0 +1,407 @@
+"""
+File: llm_guard.py
+Mục đích: Giới hạn đồng thời + circuit breaker theo từng model và chuỗi model
+dự phòng, dùng chung cho node OCR, Validate và OCR+Validate
+
+Trước đây các node gọi Proxy không giới hạn số request và không có breaker:
+khi Proxy chậm/lỗi, mọi invoice treo hết LLM_REQUEST_TIMEOUT rồi mới lỗi,
+hàng đợi dồn ứ. Giờ mỗi lần gọi đi qua invoke_llm()/ainvoke_llm():
+- Semaphore theo model (LLM_MAX_CONCURRENCY, ghi đè từng model bằng
+  LLM_MODEL_CONCURRENCY="model=n,..."). Chờ slot quá LLM_QUEUE_TIMEOUT giây
+  -> chuyển sang model kế tiếp thay vì xếp hàng vô hạn.
+- Circuit breaker theo model, cửa sổ N lần gọi gần nhất: tỉ lệ lỗi hoặc tỉ lệ
+  gọi chậm (> LLM_BREAKER_SLOW_SECONDS) vượt ngưỡng -> mở mạch trong
+  LLM_BREAKER_OPEN_SECONDS giây (bỏ qua model ngay lập tức), sau đó cho 1 request
+  thử (half-open): thành công thì đóng mạch, lỗi thì mở lại.
+- Chuỗi model: thử lần lượt (VD gemini-3-pro-preview -> gemini-2.5-flash),
+  hết model thì raise LLMUnavailable để node dùng fast path local (nếu có).
+- Có deadline: mỗi model chỉ được 1 phần ngân sách còn lại (chia đều cho các
+  model chưa thử), timeout được tính là lỗi của model để breaker mở mạch.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from config import settings
+from llm_clients import get_llm
+from deadline import DeadlineExceeded, check, remaining, timeout_for
+from metrics import record_llm
+
+logger = logging.getLogger(__name__)
+
+
+class LLMUnavailable(Exception):
+    """Mọi model trong chuỗi đều lỗi, đang mở mạch hoặc hết slot"""
+
+    def __init__(self, models: Sequence[str], errors: List[str]):
+        self.models = list(models)
+        self.errors = errors
+        super().__init__(f"Không model nào khả dụng ({', '.join(self.models)}): {'; '.join(errors)}")
+
+
+def model_chain(primary: str, fallbacks: str = "") -> List[str]:
+    """Model chính + danh sách dự phòng dạng "a,b" (bỏ trùng, giữ thứ tự)"""
+    chain = []
+    for model in [primary] + fallbacks.split(","):
+        model = model.strip()
+        if model and model not in chain:
+            chain.append(model)
+    return chain
+
+
+def _parse_model_limits(value: str) -> Dict[str, int]:
+    limits = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        model, limit = item.split("=", 1)
+        try:
+            limits[model.strip()] = max(1, int(limit))
+        except ValueError:
+            logger.warning(f"⚠️ [LLM Guard] LLM_MODEL_CONCURRENCY không hợp lệ: {item!r}")
+    return limits
+
+
+class ModelGuard:
+    """
+    Semaphore + circuit breaker cho 1 model
+
+    Args:
+        max_concurrency: Số request đồng thời tối đa tới model
+        window: Số lần gọi gần nhất dùng để tính tỉ lệ lỗi/chậm
+        min_calls: Số lần gọi tối thiểu trong cửa sổ trước khi được mở mạch
+        failure_rate: Tỉ lệ lỗi để mở mạch
+        slow_seconds: Lần gọi lâu hơn ngưỡng này tính là chậm
+        slow_rate: Tỉ lệ gọi chậm để mở mạch
+        open_seconds: Thời gian mở mạch trước khi cho request thử
+    """
+
+    def __init__(
+        self,
+        model: str,
+        max_concurrency: int = 32,
+        window: int = 20,
+        min_calls: int = 10,
+        failure_rate: float = 0.5,
+        slow_seconds: float = 30.0,
+        slow_rate: float = 0.8,
+        open_seconds: float = 30.0,
+    ):
+        self.model = model
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+
+        self._lock = threading.Lock()
+        self._sync_slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._async_slots: Optional[asyncio.Semaphore] = None
+        # (ok, slow) của các lần gọi gần nhất
+        self._window: deque = deque(maxlen=max(1, window))
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._probe_inflight = False
+        self.in_flight = 0
+
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.short_circuited = 0
+        self.saturated = 0
+        self.trips = 0
+
+    # ========================================
+    # CIRCUIT BREAKER
+    # ========================================
+
+    def allow(self) -> bool:
+        """Được gọi model không (open -> False; half-open chỉ cho 1 request thử)"""
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self.short_circuited += 1
+                    return False
+                self.state = "half_open"
+                self._probe_inflight = False
+            if self.state == "half_open":
+                if self._probe_inflight:
+                    self.short_circuited += 1
+                    return False
+                self._probe_inflight = True
+            return True
+
+    def cancel(self):
+        """Đã allow() nhưng không gọi (hết slot / bị hủy) -> trả lượt thử"""
+        with self._lock:
+            self._probe_inflight = False
+
+    def record(self, ok: bool, latency: float):
+        slow = latency > self.slow_seconds
+        with self._lock:
+            self.calls += 1
+            self.failures += 0 if ok else 1
+            self.slow_calls += 1 if slow else 0
+
+            if self.state == "half_open":
+                self._probe_inflight = False
+                if ok and not slow:
+                    self.state = "closed"
+                    self._window.clear()
+                    logger.info(f"✅ [LLM Guard] {self.model}: request thử thành công -> đóng mạch")
+                else:
+                    self._trip("request thử thất bại")
+                return
+
+            self._window.append((ok, slow))
+            if len(self._window) < self.min_calls:
+                return
+            total = len(self._window)
+            failed = sum(1 for ok_, _ in self._window if not ok_)
+            slowed = sum(1 for _, slow_ in self._window if slow_)
+            if failed / total >= self.failure_rate:
+                self._trip(f"tỉ lệ lỗi {failed}/{total}")
+            elif slowed / total >= self.slow_rate:
+                self._trip(f"tỉ lệ gọi chậm {slowed}/{total} (> {self.slow_seconds:g}s)")
+
+    def _trip(self, reason: str):
+        # Gọi khi đang giữ self._lock
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._window.clear()
+        self.trips += 1
+        logger.warning(f"🔴 [LLM Guard] {self.model}: mở mạch {self.open_seconds:g}s ({reason})")
+
+    # ========================================
+    # CONCURRENCY
+    # ========================================
+
+    def acquire(self, timeout: float) -> bool:
+        if self._sync_slots.acquire(timeout=timeout):
+            with self._lock:
+                self.in_flight += 1
+            return True
+        with self._lock:
+            self.saturated += 1
+        return False
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._sync_slots.release()
+
+    async def aacquire(self, timeout: float) -> bool:
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_concurrency)
+        try:
+            await asyncio.wait_for(self._async_slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.saturated += 1
+            return False
+        with self._lock:
+            self.in_flight += 1
+        return True
+
+    def arelease(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._async_slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "calls": self.calls,
+                "failures": self.failures,
+                "slow_calls": self.slow_calls,
+                "short_circuited": self.short_circuited,
+                "saturated": self.saturated,
+                "trips": self.trips,
+            }
+
+
+class ModelGuardRegistry:
+    """1 ModelGuard cho mỗi model, tạo khi dùng lần đầu"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._guards: Dict[str, ModelGuard] = {}
+        self._limits = _parse_model_limits(settings.llm_model_concurrency)
+
+    def get(self, model: str) -> ModelGuard:
+        guard = self._guards.get(model)
+        if guard is not None:
+            return guard
+        with self._lock:
+            guard = self._guards.get(model)
+            if guard is None:
+                guard = ModelGuard(
+                    model,
+                    max_concurrency=self._limits.get(model, settings.llm_max_concurrency),
+                    window=settings.llm_breaker_window,
+                    min_calls=settings.llm_breaker_min_calls,
+                    failure_rate=settings.llm_breaker_failure_rate,
+                    slow_seconds=settings.llm_breaker_slow_seconds,
+                    slow_rate=settings.llm_breaker_slow_rate,
+                    open_seconds=settings.llm_breaker_open_seconds,
+                )
+                self._guards[model] = guard
+        return guard
+
+    def stats(self) -> Dict[str, Any]:
+        return {model: guard.stats() for model, guard in list(self._guards.items())}
+
+
+# Dùng chung toàn process
+llm_guards = ModelGuardRegistry()
+
+
+def _out_of_budget(deadline: Optional[float]) -> bool:
+    """Còn ít hơn DEADLINE_MIN_NODE_SECONDS -> không thử thêm model nào nữa"""
+    left = remaining(deadline)
+    return left is not None and left < settings.deadline_min_node_seconds
+
+
+def _attempt_timeout(deadline: Optional[float], models_left: int) -> float:
+    """
+    Timeout cho 1 lần gọi model khi có deadline
+
+    Ngân sách còn lại (trừ DEADLINE_MIN_NODE_SECONDS để dành cho bước gửi tin)
+    chia đều cho các model còn lại trong chuỗi, tối đa LLM_REQUEST_TIMEOUT: model
+    chính bị treo chỉ tốn phần của nó, model dự phòng vẫn còn thời gian để chạy.
+    """
+    left = remaining(deadline)
+    share = (left - settings.deadline_min_node_seconds) / max(1, models_left)
+    share = max(settings.deadline_min_node_seconds, share)
+    return max(0.01, min(settings.llm_request_timeout, share, left))
+
+
+def invoke_llm(
+    models: Sequence[str], messages: list, temperature: float = 0, deadline: Optional[float] = None
+) -> Tuple[Any, str]:
+    """
+    Gọi lần lượt các model trong chuỗi cho đến khi 1 model trả lời
+
+    Args:
+        deadline: Deadline của invoice (epoch seconds), None = chỉ dùng LLM_REQUEST_TIMEOUT
+
+    Returns:
+        (response, model đã trả lời)
+
+    Raises:
+        LLMUnavailable nếu không model nào trả lời được
+        DeadlineExceeded nếu hết ngân sách thời gian
+    """
+    errors = []
+    for index, model in enumerate(models):
+        check(deadline)
+        if _out_of_budget(deadline):
+            raise DeadlineExceeded(f"Hết ngân sách thời gian trước khi gọi {model} ({'; '.join(errors)})")
+        guard = llm_guards.get(model)
+        if not guard.allow():
+            errors.append(f"{model}: mạch đang mở")
+            continue
+        if not guard.acquire(timeout_for(deadline, settings.llm_queue_timeout)):
+            guard.cancel()
+            errors.append(f"{model}: hết slot")
+            continue
+
+        kwargs = {}
+        if deadline is None:
+            llm = get_llm(model, temperature=temperature)
+        else:
+            # Retry nội bộ của client (kèm backoff) không biết deadline -> gọi đúng
+            # 1 lần với phần ngân sách của model này, chuỗi model dự phòng thay cho retry
+            llm = get_llm(model, temperature=temperature, max_retries=0)
+            kwargs["timeout"] = _attempt_timeout(deadline, len(models) - index)
+
+        start = time.monotonic()
+        try:
+            response = llm.invoke(messages, **kwargs)
+        except Exception as e:
+            # Timeout cũng là lỗi của model (kể cả khi vừa hết ngân sách): breaker
+            # phải thấy model treo, request thử half-open bị timeout thì mở lại mạch
+            latency = time.monotonic() - start
+            guard.record(False, latency)
+            if _out_of_budget(deadline):
+                record_llm(model, latency, "deadline")
+                raise DeadlineExceeded(f"{model}: hết ngân sách thời gian ({e})") from e
+            logger.warning(f"⚠️ [LLM Guard] {model} lỗi: {e}")
+            errors.append(f"{model}: {e}")
+            record_llm(model, latency, "error")
+            continue
+        finally:
+            guard.release()
+
+        guard.record(True, time.monotonic() - start)
+        record_llm(model, time.monotonic() - start, "ok", response)
+        if model != models[0]:
+            logger.info(f"↪️ [LLM Guard] Đã dùng model dự phòng {model}")
+        return response, model
+
+    raise LLMUnavailable(models, errors)
+
+
+async def ainvoke_llm(
+    models: Sequence[str], messages: list, temperature: float = 0, deadline: Optional[float] = None
+) -> Tuple[Any, str]:
+    """Bản async của invoke_llm (ainvoke, semaphore asyncio), deadline được áp cứng bằng wait_for"""
+    errors = []
+    for index, model in enumerate(models):
+        check(deadline)
+        if _out_of_budget(deadline):
+            raise DeadlineExceeded(f"Hết ngân sách thời gian trước khi gọi {model} ({'; '.join(errors)})")
+        guard = llm_guards.get(model)
+        if not guard.allow():
+            errors.append(f"{model}: mạch đang mở")
+            continue
+        if not await guard.aacquire(timeout_for(deadline, settings.llm_queue_timeout)):
+            guard.cancel()
+            errors.append(f"{model}: hết slot")
+            continue
+
+        if deadline is None:
+            llm = get_llm(model, temperature=temperature)
+        else:
+            # Như bản sync: không retry nội bộ, để model dự phòng còn ngân sách để chạy
+            llm = get_llm(model, temperature=temperature, max_retries=0)
+        start = time.monotonic()
+        try:
+            if deadline is None:
+                response = await llm.ainvoke(messages)
+            else:
+                timeout = _attempt_timeout(deadline, len(models) - index)
+                response = await asyncio.wait_for(llm.ainvoke(messages, timeout=timeout), timeout)
+        except asyncio.CancelledError:
+            guard.cancel()
+            raise
+        except Exception as e:
+            # Timeout cũng là lỗi của model (kể cả khi vừa hết ngân sách): breaker
+            # phải thấy model treo, request thử half-open bị timeout thì mở lại mạch
+            latency = time.monotonic() - start
+            guard.record(False, latency)
+            if _out_of_budget(deadline):
+                record_llm(model, latency, "deadline")
+                raise DeadlineExceeded(f"{model}: hết ngân sách thời gian ({e!r})") from e
+            logger.warning(f"⚠️ [LLM Guard] {model} lỗi: {e!r}")
+            errors.append(f"{model}: {e!r}")
+            record_llm(model, latency, "error")
+            continue
+        finally:
+            guard.arelease()
+
+        guard.record(True, time.monotonic() - start)
+        record_llm(model, time.monotonic() - start, "ok", response)
+        if model != models[0]:
+            logger.info(f"↪️ [LLM Guard] Đã dùng model dự phòng {model}")
+        return response, model
+
+    raise LLMUnavailable(models, errors)
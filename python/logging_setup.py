@@ -0,0 +1,210 @@
+"""
+File: logging_setup.py
+Mục đích: Logging có cấu trúc (JSON), không chặn thread xử lý invoice
+
+Thay cho print() trong các đường nóng (node, webhook, job queue, outbox...):
+print() ghi thẳng stdout trên worker thread, khi Docker log driver nghẽn thì
+cả pipeline chậm theo, và mỗi invoice in nguyên OCR text / AI response.
+
+- logging.getLogger(__name__) ở từng module, setup_logging() gọi 1 lần trong main.py
+- QueueHandler -> QueueListener: thread gọi log chỉ bỏ record vào queue (có giới
+  hạn LOG_QUEUE_SIZE), 1 thread nền ghi ra stdout. Queue đầy thì BỎ record và
+  đếm (dropped) thay vì chặn pipeline
+- Message dài hơn LOG_MAX_CHARS bị cắt ngay khi vào queue (RAM của queue có trần)
+- Payload lớn (OCR text, AI response) đi qua log_payload(): cắt còn
+  LOG_PAYLOAD_MAX_CHARS và chỉ ghi tối đa LOG_PAYLOADS_PER_MINUTE lần/phút
+  -> chi phí log không tăng theo traffic
+- Level theo module: LOG_LEVEL (mặc định) + LOG_LEVELS="nodes=WARNING,llm_guard=DEBUG"
+- LOG_FORMAT=json (1 dòng JSON/record, có trace_id + page_id của invoice đang xử lý)
+  hoặc text (dễ đọc khi chạy local)
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from config import settings
+from metrics import current_page
+from tracing import current_trace
+
+# Thuộc tính chuẩn của LogRecord, phần còn lại (extra=...) được đưa vào JSON
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "trace_id", "page_id"}
+
+
+def _truncate(text: str, limit: int) -> str:
+    if limit > 0 and len(text) > limit:
+        return f"{text[:limit]}… (+{len(text) - limit} ký tự)"
+    return text
+
+
+class JsonFormatter(logging.Formatter):
+    """1 record = 1 dòng JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "trace_id", None):
+            entry["trace_id"] = record.trace_id
+        if getattr(record, "page_id", None):
+            entry["page_id"] = record.page_id
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler chạy trên thread gọi log: gắn context, cắt message, put_nowait.
+    Queue đầy -> bỏ record (đếm dropped), không bao giờ chặn.
+    """
+
+    def __init__(self, log_queue: queue.Queue, max_chars: int):
+        super().__init__(log_queue)
+        self.max_chars = max_chars
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Context của invoice chỉ đọc được trên thread/task gọi log
+        record.trace_id = current_trace.get()
+        record.page_id = current_page.get()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _truncate(logging.Formatter().formatException(record.exc_info), self.max_chars * 4)
+        record.msg = _truncate(record.getMessage(), self.max_chars)
+        record.args = None
+        record.exc_info = None
+        record.stack_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _PayloadLimiter:
+    """Cho phép tối đa `per_minute` payload mỗi phút (cửa sổ cố định)"""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self._lock = threading.Lock()
+        self._window = 0
+        self._count = 0
+        self.skipped = 0
+
+    def allow(self) -> bool:
+        window = int(time.monotonic() // 60)
+        with self._lock:
+            if window != self._window:
+                self._window = window
+                self._count = 0
+            if self._count >= self.per_minute:
+                self.skipped += 1
+                return False
+            self._count += 1
+            return True
+
+
+_payloads = _PayloadLimiter(settings.log_payloads_per_minute)
+_handler: Optional[_NonBlockingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def log_payload(logger: logging.Logger, label: str, payload: Optional[str], level: int = logging.INFO):
+    """
+    Ghi 1 payload lớn (OCR text, AI response...) đã cắt ngắn, có giới hạn số lần/phút.
+    Không tốn gì khi level bị tắt hoặc đã hết lượt trong phút.
+    """
+    if not payload or not logger.isEnabledFor(level) or not _payloads.allow():
+        return
+    logger.log(
+        level,
+        "%s: %s",
+        label,
+        _truncate(payload, settings.log_payload_max_chars),
+        extra={"payload_chars": len(payload)},
+    )
+
+
+def _parse_levels(spec: str) -> Dict[str, str]:
+    """'nodes=WARNING,llm_guard=DEBUG' -> {"nodes": "WARNING", "llm_guard": "DEBUG"}"""
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.strip().partition("=")
+        if name and level:
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """Cấu hình root logger (gọi 1 lần khi khởi động, gọi lại không có tác dụng)"""
+    global _handler, _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if settings.log_format == "json" else TextFormatter())
+
+    log_queue: queue.Queue = queue.Queue(maxsize=settings.log_queue_size)
+    _handler = _NonBlockingQueueHandler(log_queue, settings.log_max_chars)
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=False)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+    root.setLevel(settings.log_level.upper())
+    for name, level in _parse_levels(settings.log_levels).items():
+        logging.getLogger(name).setLevel(level)
+    # Thư viện ồn (mỗi request 1 dòng) chỉ log từ WARNING
+    for noisy in ("httpx", "httpcore", "openai", "urllib3"):
+        if noisy not in settings.log_levels:
+            logging.getLogger(noisy).setLevel(logging.WARNING)
+
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Ghi nốt các record còn trong queue (gọi cuối lifespan shutdown).
+    Log sau đó ghi thẳng ra stdout (đồng bộ) thay vì vào queue không còn ai đọc.
+    """
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    root = logging.getLogger()
+    if _handler in root.handlers:
+        root.removeHandler(_handler)
+        for stream in _listener.handlers:
+            root.addHandler(stream)
+    _listener = None
+
+
+def logging_stats() -> dict:
+    return {
+        "format": settings.log_format,
+        "queued": _handler.queue.qsize() if _handler else 0,
+        "dropped": _handler.dropped if _handler else 0,
+        "payloads_skipped": _payloads.skipped,
+    }
@@ -10,13 +10,35 @@ Multi-tenant: Mỗi Page có config riêng, được xác định qua recipient.
 """
 
 import os
-from typing import Dict, Any
-from fastapi import FastAPI, Request, BackgroundTasks, HTTPException
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional
+from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import PlainTextResponse
 from dotenv import load_dotenv
 
-from graph import app_graph
+from config import settings
+# Cấu hình logging trước khi import các module có log lúc khởi tạo
+from logging_setup import setup_logging, stop_logging, logging_stats
+setup_logging()
+
+from graph import app_graph, app_graph_async
 from state import InvoiceState
+from job_queue import JobQueue, FairScheduler
+from llm_clients import llm_registry
+from llm_guard import llm_guards
+from http_clients import http_pool
+from dedupe import message_deduper
+from stats_aggregator import tenant_stats
+from outbox import outbox
+from services import TenantService
+from deadline import deadlines, new_deadline
+from sender_actions import sender_actions
+from metrics import metrics, dedupe_hits
+from tracing import tracer, trace_id_for, current_trace
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from parent directory
 # (Python runs in python/ but .env is in root)
@@ -24,64 +46,156 @@ load_dotenv(dotenv_path="../.env")
 load_dotenv()  # Also try current directory as fallback
 
 # Import Database to retry creation
-from database import Base, engine
-# Create tables if not exist
-Base.metadata.create_all(bind=engine)
+from database import ensure_schema
+# Create tables if not exist (+ migration schema cũ)
+ensure_schema()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Startup: khởi động worker pool của hàng đợi invoice
+    Shutdown: drain hàng đợi để rolling restart không làm mất job đang chạy
+    """
+    invoice_queue.start()
+    if settings.outbox_enabled:
+        outbox.start()
+    purge_task = asyncio.create_task(message_deduper.run_purge_loop())
+    stats_task = asyncio.create_task(tenant_stats.run_flush_loop())
+    typing_task = asyncio.create_task(sender_actions.run_refresh_loop())
+    yield
+    purge_task.cancel()
+    typing_task.cancel()
+    await invoice_queue.adrain(settings.job_drain_timeout)
+    # Sau khi pipeline dừng mới drain outbox (gửi nốt reply vừa xếp hàng)
+    await outbox.adrain(settings.outbox_drain_timeout)
+    # Flush nốt thống kê của các job vừa drain
+    stats_task.cancel()
+    await asyncio.to_thread(tenant_stats.flush)
+    await llm_registry.aclose()
+    await http_pool.aclose()
+    # Sau cùng: ghi nốt log của các job/tin nhắn vừa drain ở trên
+    stop_logging()
 
-# Deduplication Cache (Simple in-memory)
-# Format: {message_id: timestamp}
-PROCESSED_MESSAGES = {}
-import time
 
 # Khởi tạo FastAPI app
 app = FastAPI(
     title="Facebook Messenger Invoice Bot (Multi-tenant)",
     description="Bot xử lý hóa đơn từ Messenger - Hỗ trợ nhiều Page/cửa hàng",
     version="2.0.0",
+    lifespan=lifespan,
 )
 
 # Lấy verify token từ env
 FB_VERIFY_TOKEN = os.getenv("FB_VERIFY_TOKEN")
 
 
-def process_invoice_async(sender_id: str, page_id: str, image_url: str):
+def _build_initial_state(
+    sender_id: str, page_id: str, image_url: str, trace_id: Optional[str] = None
+) -> InvoiceState:
+    # Khởi tạo state ban đầu - bao gồm page_id để load tenant
+    return {
+        "sender_id": sender_id,
+        "page_id": page_id,
+        "image_url": image_url,
+        # Ngân sách thời gian tính từ lúc worker bắt đầu xử lý job
+        "deadline": new_deadline(),
+        "trace_id": trace_id,
+        "tenant_config": None,
+        "ocr_raw_text": None,
+        "validation_result": None,
+        "final_response": None,
+        "error": None,
+    }
+
+
+def _start_trace(sender_id: str, page_id: str, message_id: Optional[str], job_id: Optional[int]) -> str:
+    # 1 tin nhắn nhiều ảnh = nhiều job cùng mid -> trace ID theo mid + job
+    trace_id = trace_id_for(message_id, job_id)
+    # Log trong lúc xử lý invoice này được gắn trace_id
+    current_trace.set(trace_id)
+    tracer.start(trace_id, attributes={
+        "page_id": page_id,
+        "sender_id": sender_id,
+        "messenger.mid": message_id,
+        "invoice_job.id": job_id,
+    })
+    return trace_id
+
+
+async def process_invoice_async(
+    sender_id: str, page_id: str, image_url: str, message_id: Optional[str] = None, job_id: Optional[int] = None
+):
     """
-    Hàm xử lý invoice trong background task.
-    LƯU Ý: Dùng def thường (không async) để FastAPI chạy trong ThreadPool,
-    tránh block event loop vì app_graph.invoke là blocking.
+    Hàm xử lý 1 invoice job, được JobQueue gọi như 1 asyncio task.
+    Dùng app_graph_async.ainvoke nên không giữ thread trong lúc chờ OCR/LLM/FB,
+    1 process có thể xử lý hàng trăm invoice đồng thời.
+    Raise lại exception để JobQueue thử lại job.
     """
-    print(f"\n{'=' * 60}")
-    print(f"🚀 [Background Task] Bắt đầu xử lý invoice")
-    print(f"   User: {sender_id}")
-    print(f"   Page: {page_id}")
-    print(f"{'=' * 60}\n")
+    trace_id = _start_trace(sender_id, page_id, message_id, job_id)
+    logger.info(f"🚀 [Background Task] Bắt đầu xử lý invoice: user={sender_id} page={page_id} trace={trace_id}")
 
     try:
-        # Khởi tạo state ban đầu - bao gồm page_id để load tenant
-        initial_state: InvoiceState = {
-            "sender_id": sender_id,
-            "page_id": page_id,
-            "image_url": image_url,
-            "tenant_config": None,
-            "ocr_raw_text": None,
-            "validation_result": None,
-            "final_response": None,
-            "error": None,
-        }
+        # Invoke LangGraph workflow (async)
+        await app_graph_async.ainvoke(_build_initial_state(sender_id, page_id, image_url, trace_id))
+        await asyncio.to_thread(tracer.finish, trace_id)
+
+        logger.info(f"✅ [Background Task] Hoàn thành xử lý cho user: {sender_id}")
+
+    except Exception as e:
+        logger.exception(f"❌ [Background Task] Lỗi CRITICAL khi xử lý: {str(e)}")
+        await asyncio.to_thread(tracer.finish, trace_id, f"{type(e).__name__}: {e}")
+        raise
 
+
+def process_invoice_sync(
+    sender_id: str, page_id: str, image_url: str, message_id: Optional[str] = None, job_id: Optional[int] = None
+):
+    """
+    Bản sync (PIPELINE_ASYNC=false): mỗi worker thread của JobQueue
+    chạy app_graph.invoke cho 1 invoice tại 1 thời điểm.
+    """
+    trace_id = _start_trace(sender_id, page_id, message_id, job_id)
+    logger.info(f"🚀 [Background Task] Bắt đầu xử lý invoice: user={sender_id} page={page_id} trace={trace_id}")
+
+    try:
         # Invoke LangGraph workflow
-        final_state = app_graph.invoke(initial_state)
+        app_graph.invoke(_build_initial_state(sender_id, page_id, image_url, trace_id))
+        tracer.finish(trace_id)
 
-        print(f"\n{'=' * 60}")
-        print(f"✅ [Background Task] Hoàn thành xử lý cho user: {sender_id}")
-        print(f"{'=' * 60}\n")
+        logger.info(f"✅ [Background Task] Hoàn thành xử lý cho user: {sender_id}")
 
     except Exception as e:
-        print(f"\n{'=' * 60}")
-        print(f"❌ [Background Task] Lỗi CRITICAL khi xử lý: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        print(f"{'=' * 60}\n")
+        logger.exception(f"❌ [Background Task] Lỗi CRITICAL khi xử lý: {str(e)}")
+        tracer.finish(trace_id, error=f"{type(e).__name__}: {e}")
+        raise
+
+
+# Hàng đợi invoice bền vững (SQLite) + worker pool giới hạn song song
+invoice_queue = JobQueue(
+    handler=process_invoice_async if settings.pipeline_async else process_invoice_sync,
+    num_workers=settings.invoice_async_workers if settings.pipeline_async else settings.invoice_workers,
+    poll_interval=settings.job_poll_interval,
+    max_attempts=settings.job_max_attempts,
+    lease_seconds=settings.job_lease_seconds,
+    retry_backoff_base=settings.job_retry_backoff_base,
+    retry_backoff_max=settings.job_retry_backoff_max,
+    scheduler=FairScheduler(
+        limits=TenantService.job_limits,
+        default_weight=settings.job_tenant_weight,
+        default_max_concurrency=settings.job_tenant_max_concurrency,
+    ),
+)
+
+# Độ sâu hàng đợi tính lúc scrape /metrics
+metrics.gauge(
+    "invoice_queue_depth", "Số invoice job theo trạng thái", ("page_id", "status"),
+    lambda: metrics.group_by_page(invoice_queue.depth_by_page()),
+)
+metrics.gauge(
+    "outbox_depth", "Số tin Messenger trong outbox theo trạng thái", ("page_id", "status"),
+    lambda: metrics.group_by_page(outbox.depth_by_page()),
+)
 
 
 @app.get("/webhook")
@@ -97,28 +211,79 @@ async def verify_webhook(request: Request):
     Returns:
         hub.challenge nếu verify_token khớp
     """
-    print(f"📞 [GET /webhook] Nhận request verify từ Facebook")
+    logger.info(f"📞 [GET /webhook] Nhận request verify từ Facebook")
 
     # Lấy các query params
     mode = request.query_params.get("hub.mode")
     token = request.query_params.get("hub.verify_token")
     challenge = request.query_params.get("hub.challenge")
 
-    print(f"  Mode: {mode}")
-    print(f"  Token: {token}")
-    print(f"  Challenge: {challenge}")
+    logger.info(f"  Mode: {mode}")
+    logger.info(f"  Token: {token}")
+    logger.info(f"  Challenge: {challenge}")
 
     # Kiểm tra mode và token
     if mode == "subscribe" and token == FB_VERIFY_TOKEN:
-        print("✅ [GET /webhook] Webhook verified thành công!")
+        logger.info("✅ [GET /webhook] Webhook verified thành công!")
         return PlainTextResponse(content=challenge)
     else:
-        print("❌ [GET /webhook] Verify token không khớp!")
+        logger.error("❌ [GET /webhook] Verify token không khớp!")
         raise HTTPException(status_code=403, detail="Verification failed")
 
 
+def parse_webhook_messages(body: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Tách các tin nhắn có ảnh ra khỏi payload webhook (thuần, không I/O)
+
+    Bỏ qua echo (tin do chính bot gửi, nếu xử lý sẽ thành vòng lặp vô hạn),
+    tin chỉ có text, và attachment không phải ảnh.
+
+    Returns:
+        [{"page_id", "sender_id", "message_id", "image_urls"}] theo thứ tự trong payload
+    """
+    messages = []
+    for entry in body.get("entry", []):
+        page_id_entry = entry.get("id")
+
+        for messaging_event in entry.get("messaging", []):
+            sender_id = messaging_event.get("sender", {}).get("id")
+
+            # Determine Page ID
+            tenant_page_id = page_id_entry or messaging_event.get("recipient", {}).get("id")
+
+            # Get message
+            message = messaging_event.get("message", {})
+
+            # ⚠️ QUAN TRỌNG: Bỏ qua tin nhắn echo (từ chính bot gửi đi)
+            if message.get("is_echo"):
+                logger.info(f"  ⏭️  Bỏ qua echo message từ bot")
+                continue
+
+            # Bỏ qua tin nhắn text (chỉ xử lý ảnh)
+            if "text" in message and "attachments" not in message:
+                logger.info(f"  ⏭️  Bỏ qua text message (không có ảnh)")
+                continue
+
+            if not sender_id or not tenant_page_id:
+                continue
+
+            image_urls = [
+                attachment.get("payload", {}).get("url")
+                for attachment in message.get("attachments", [])
+                if attachment.get("type") == "image" and attachment.get("payload", {}).get("url")
+            ]
+            if image_urls:
+                messages.append({
+                    "page_id": tenant_page_id,
+                    "sender_id": sender_id,
+                    "message_id": message.get("mid"),
+                    "image_urls": image_urls,
+                })
+    return messages
+
+
 @app.post("/webhook")
-async def receive_message(request: Request, background_tasks: BackgroundTasks):
+async def receive_message(request: Request):
     """
     Endpoint nhận tin nhắn từ Facebook Messenger
 
@@ -149,7 +314,7 @@ async def receive_message(request: Request, background_tasks: BackgroundTasks):
     Returns:
         200 OK ngay lập tức (Facebook yêu cầu phải trả về trong 20s)
     """
-    print(f"\n📨 [POST /webhook] Nhận tin nhắn từ Facebook")
+    logger.info(f"📨 [POST /webhook] Nhận tin nhắn từ Facebook")
 
     try:
         # Parse JSON body
@@ -159,77 +324,42 @@ async def receive_message(request: Request, background_tasks: BackgroundTasks):
         if body.get("object") != "page":
             return {"status": "ignored - not a page event"}
 
-        # Duyệt qua các entries
-        for entry in body.get("entry", []):
-            page_id_entry = entry.get("id")
-            
-            for messaging_event in entry.get("messaging", []):
-                sender_id = messaging_event.get("sender", {}).get("id")
-                
-                # Determine Page ID
-                tenant_page_id = page_id_entry or messaging_event.get("recipient", {}).get("id")
-
-                # Get message
-                message = messaging_event.get("message", {})
-                message_id = message.get("mid")
-                
-                # ========================================================
-                # 1. DEDUPLICATION CHECK (Chống spam/retry)
-                # ========================================================
-                if message_id:
-                    current_time = time.time()
-                    
-                    # Clean old cache (keep only last 10 mins)
-                    # (Simple cleanup to avoid memory leak)
-                    if len(PROCESSED_MESSAGES) > 1000:
-                         keys_to_remove = [k for k, v in PROCESSED_MESSAGES.items() if current_time - v > 600]
-                         for k in keys_to_remove:
-                             del PROCESSED_MESSAGES[k]
-
-                    if message_id in PROCESSED_MESSAGES:
-                        print(f"  ⏭️  Bỏ qua Duplicate Message ID: {message_id}")
-                        continue
-                    
-                    # Mark as processed
-                    PROCESSED_MESSAGES[message_id] = current_time
-
-                # ⚠️ QUAN TRỌNG: Bỏ qua tin nhắn echo (từ chính bot gửi đi)
-                # Nếu không check này, bot sẽ xử lý lại tin nhắn của chính nó → vòng lặp vô hạn!
-                if message.get("is_echo"):
-                    print(f"  ⏭️  Bỏ qua echo message từ bot")
-                    continue
-                
-                # Bỏ qua tin nhắn text (chỉ xử lý ảnh)
-                if "text" in message and "attachments" not in message:
-                    print(f"  ⏭️  Bỏ qua text message (không có ảnh)")
-                    continue
-
-                # Get attachments
-                attachments = message.get("attachments", [])
-
-                for attachment in attachments:
-                    if attachment.get("type") == "image":
-                        image_url = attachment.get("payload", {}).get("url")
-
-                        if sender_id and tenant_page_id and image_url:
-                            print(f"  📸 Ảnh từ user {sender_id} -> Page {tenant_page_id}")
-                            print(f"     URL: {image_url[:50]}...")
-
-                            # Thêm vào background tasks để xử lý ngầm
-                            background_tasks.add_task(
-                                process_invoice_async,
-                                sender_id=sender_id,
-                                page_id=tenant_page_id,
-                                image_url=image_url,
-                            )
-
-                            print(f"  ✅ Đã thêm vào background task queue")
+        for msg in parse_webhook_messages(body):
+            page_id, sender_id, message_id = msg["page_id"], msg["sender_id"], msg["message_id"]
+
+            # ========================================================
+            # DEDUPLICATION CHECK (Chống Facebook retry, dùng chung mọi worker)
+            # ========================================================
+            if message_id and await asyncio.to_thread(message_deduper.seen, message_id):
+                dedupe_hits.inc(metrics.page_label(page_id))
+                logger.info(f"  ⏭️  Bỏ qua Duplicate Message ID: {message_id}")
+                continue
+
+            job_ids = []
+            for image_url in msg["image_urls"]:
+                logger.info(f"  📸 Ảnh từ user {sender_id} -> Page {page_id}: {image_url[:50]}...")
+
+                # Ghi vào hàng đợi bền vững để worker xử lý ngầm
+                job_id = await asyncio.to_thread(
+                    invoice_queue.enqueue,
+                    sender_id=sender_id,
+                    page_id=page_id,
+                    image_url=image_url,
+                    message_id=message_id,
+                )
+
+                job_ids.append(job_id)
+                logger.info(f"  ✅ Đã thêm vào hàng đợi (job #{job_id})")
+
+            # Báo "đã xem" + "đang soạn tin" ngay, gửi ngầm không chặn response
+            if job_ids:
+                sender_actions.acknowledge(page_id, sender_id, job_ids)
 
         # Trả về 200 OK ngay lập tức
         return {"status": "ok"}
 
     except Exception as e:
-        print(f"❌ [POST /webhook] Lỗi: {str(e)}")
+        logger.error(f"❌ [POST /webhook] Lỗi: {str(e)}")
         # Vẫn trả về 200 để tránh Facebook retry liên tục
         return {"status": "error", "message": str(e)}
 
@@ -247,6 +377,10 @@ async def root():
             "verify": "GET /webhook",
             "receive": "POST /webhook",
             "health": "GET /health",
+            "pools": "GET /debug/pools",
+            "caches": "GET /debug/caches",
+            "scheduler": "GET /debug/scheduler",
+            "metrics": "GET /metrics",
         },
     }
 
@@ -276,9 +410,79 @@ async def health_check():
 
     all_ok = all(env_checks.values())
 
+    # Độ sâu hàng đợi invoice
+    try:
+        queue_depth = await asyncio.to_thread(invoice_queue.depth)
+    except Exception as e:
+        queue_depth = {"error": str(e)}
+
+    try:
+        outbox_depth = await asyncio.to_thread(outbox.depth)
+    except Exception as e:
+        outbox_depth = {"error": str(e)}
+
     return {
         "status": "healthy" if all_ok else "warning",
         "environment_variables": env_checks,
+        "queue": queue_depth,
+        "outbox": outbox_depth,
+        "deadline": deadlines.stats(),
+        "tracing": tracer.stats(),
+        "logging": logging_stats(),
+        # resend_rate: tỉ lệ ảnh gửi lại, so sánh khi bật/tắt SENDER_ACTIONS_ENABLED
+        "sender_actions": sender_actions.stats(),
+    }
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Metrics dạng text Prometheus: thời gian từng node, latency/token LLM,
+    độ sâu hàng đợi, dedupe, hóa đơn trùng, status code Graph API (theo page_id)
+    """
+    body = await asyncio.to_thread(metrics.render)
+    return PlainTextResponse(content=body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/debug/pools")
+async def connection_pools():
+    """
+    Thống kê connection pool (số client, request, connection idle/active)
+    để tinh chỉnh các biến LLM_POOL_* và HTTP_*
+    """
+    return {
+        "llm": llm_registry.stats(),
+        "llm_guard": llm_guards.stats(),
+        "http": http_pool.stats(),
+        "outbox": outbox.stats(),
+    }
+
+
+@app.get("/debug/scheduler")
+async def scheduler_stats():
+    """
+    Lập lịch job theo Page: số Page đang có job chờ, thời gian chờ
+    (trung bình / p95 / max) của từng Page
+    """
+    return invoice_queue.scheduler.stats()
+
+
+@app.get("/debug/caches")
+async def caches():
+    """
+    Thống kê cache (hit/miss, kích thước)
+    """
+    from services import tenant_cache
+    from ocr_cache import ocr_cache
+    from prize_sampler import prize_samplers
+    from prize_inventory import prize_inventory
+    return {
+        "tenant": tenant_cache.stats(),
+        "ocr": ocr_cache.stats(),
+        "dedupe": message_deduper.stats(),
+        "tenant_stats": tenant_stats.stats(),
+        "prize_samplers": prize_samplers.stats(),
+        "prize_inventory": prize_inventory.stats(),
     }
 
 
@@ -321,9 +525,8 @@ async def update_page_token(request: Request):
 
 if __name__ == "__main__":
     import uvicorn
-    from config import settings
 
-    print(f"\n{'=' * 60}")
+    print(f"{'=' * 60}")
     print(f"🚀 Starting FastAPI server on port {settings.port}")
     print(f"   Multi-tenant mode: ENABLED")
     print(f"   Reload Mode: {'ENABLED' if settings.reload else 'DISABLED'}")
@@ -0,0 +1,313 @@
+"""
+File: metrics.py
+Mục đích: Metrics kiểu Prometheus (GET /metrics) thay cho việc đọc log emoji
+
+Không phụ thuộc prometheus_client: tự render text format 0.0.4.
+Ghi metric phải đủ rẻ để bật thường trực trên production:
+- Mỗi thread (worker sync, thread của asyncio.to_thread, event loop) ghi vào
+  shard riêng (threading.local) -> không lock, không tranh chấp khi inc/observe
+- Lock chỉ dùng 1 lần khi thread tạo shard mới, và khi /metrics gom các shard
+- Gauge (độ sâu hàng đợi...) không ghi liên tục mà tính lúc scrape qua callback
+
+Mọi metric có label page_id. Để tránh bùng nổ số series, chỉ METRICS_MAX_PAGES
+Page đầu tiên có label riêng, các Page sau gộp vào page_id="other".
+Page hiện tại của invoice được đặt vào contextvar bởi node wrapper trong
+graph.py (current_page), nên llm_guard không cần truyền page_id xuống.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Page đang xử lý trong node hiện tại (đặt bởi instrument_node)
+current_page: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_page", default=None)
+
+# Bucket thời gian (giây) cho node và LLM: từ cache hit vài ms đến LLM chậm
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+LabelKey = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: LabelKey, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Sharded:
+    """Dict riêng cho từng thread, gom lại lúc scrape"""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str]):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _snapshots(self) -> List[dict]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        # dict.copy() là 1 thao tác C (giữ GIL) nên an toàn khi thread chủ đang ghi
+        return [shard.copy() for shard in shards]
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, *labels: str, value: float = 1):
+        if not settings.metrics_enabled:
+            return
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + value
+
+    def collect(self) -> Dict[LabelKey, float]:
+        totals: Dict[LabelKey, float] = {}
+        for snapshot in self._snapshots():
+            for key, value in snapshot.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self) -> Iterable[str]:
+        for key, value in sorted(self.collect().items()):
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Histogram(_Sharded):
+    """
+    Mỗi series trong shard là list [count của từng bucket..., count +Inf, sum].
+    Count theo bucket lưu không cộng dồn, cộng dồn lúc render.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str], buckets: Sequence[float] = DURATION_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str):
+        if not settings.metrics_enabled:
+            return
+        shard = self._shard()
+        series = shard.get(labels)
+        if series is None:
+            series = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def collect(self) -> Dict[LabelKey, list]:
+        totals: Dict[LabelKey, list] = {}
+        for snapshot in self._snapshots():
+            for key, series in snapshot.items():
+                series = list(series)
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = series
+                else:
+                    for i, value in enumerate(series):
+                        total[i] += value
+        return totals
+
+    def render(self) -> Iterable[str]:
+        for key, series in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(series[-1])}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}"
+
+
+class Gauge:
+    """Gauge tính lúc scrape: callback trả về {label values: value}"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str], callback: Callable[[], Dict[LabelKey, float]]):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.callback = callback
+
+    def render(self) -> Iterable[str]:
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.warning(f"⚠️ [Metrics] Lỗi đọc gauge {self.name}: {e}")
+            return
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class MetricsRegistry:
+    """
+    Args:
+        max_pages: Số page_id tối đa có label riêng, còn lại gộp thành "other"
+    """
+
+    def __init__(self, max_pages: int = 1000):
+        self.max_pages = max_pages
+        self._metrics: list = []
+        self._pages: set = set()
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS
+    ) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(
+        self, name: str, help_text: str, labels: Sequence[str], callback: Callable[[], Dict[LabelKey, float]]
+    ) -> Gauge:
+        metric = Gauge(name, help_text, labels, callback)
+        self._metrics.append(metric)
+        return metric
+
+    def page_label(self, page_id: Optional[str] = None) -> str:
+        """Label page_id (mặc định: Page của invoice đang xử lý), giới hạn số series"""
+        page_id = page_id or current_page.get() or "unknown"
+        if page_id in self._pages:
+            return page_id
+        if len(self._pages) >= self.max_pages:
+            return "other"
+        # Kiểm tra rồi add không atomic: cùng lắm vượt max_pages vài Page
+        self._pages.add(page_id)
+        return page_id
+
+    def group_by_page(self, counts: Dict[Tuple[str, str], float]) -> Dict[LabelKey, float]:
+        """{(page_id, x): n} -> gộp các Page vượt max_pages vào "other" (cho gauge)"""
+        grouped: Dict[LabelKey, float] = {}
+        for (page_id, label), value in counts.items():
+            key = (self.page_label(page_id), label)
+            grouped[key] = grouped.get(key, 0) + value
+        return grouped
+
+    def render(self) -> str:
+        """Text format Prometheus. Gauge có thể đọc DB -> gọi ngoài event loop"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# ========================================
+# METRICS CỦA PIPELINE
+# ========================================
+
+metrics = MetricsRegistry(max_pages=settings.metrics_max_pages)
+
+node_duration = metrics.histogram(
+    "invoice_node_duration_seconds", "Thời gian chạy từng node của pipeline invoice", ("node", "page_id")
+)
+node_errors = metrics.counter(
+    "invoice_node_errors_total", "Số lần node raise exception", ("node", "page_id")
+)
+llm_duration = metrics.histogram(
+    "llm_request_duration_seconds", "Thời gian 1 lần gọi LLM", ("model", "page_id", "outcome")
+)
+llm_tokens = metrics.counter(
+    "llm_tokens_total", "Số token LLM theo model (type=input|output)", ("model", "page_id", "type")
+)
+dedupe_hits = metrics.counter(
+    "webhook_dedupe_hits_total", "Số tin nhắn webhook bị bỏ qua vì trùng message_id", ("page_id",)
+)
+claim_conflicts = metrics.counter(
+    "invoice_claim_conflicts_total", "Số hóa đơn bị từ chối vì đã được dùng", ("page_id",)
+)
+graph_api_responses = metrics.counter(
+    "graph_api_responses_total",
+    "Response của Graph API Send theo HTTP status (status=error: lỗi mạng)",
+    ("page_id", "kind", "status"),
+)
+
+
+def instrument_node(name: str, fn: Callable) -> Callable:
+    """
+    Bọc 1 node LangGraph: đặt current_page theo state["page_id"], đo thời gian
+    vào invoice_node_duration_seconds, đếm exception. Giữ nguyên sync/async.
+    """
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(state, *args, **kwargs):
+            page = metrics.page_label(state.get("page_id"))
+            token = current_page.set(page)
+            start = time.perf_counter()
+            try:
+                return await fn(state, *args, **kwargs)
+            except Exception:
+                node_errors.inc(name, page)
+                raise
+            finally:
+                node_duration.observe(time.perf_counter() - start, name, page)
+                current_page.reset(token)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(state, *args, **kwargs):
+        page = metrics.page_label(state.get("page_id"))
+        token = current_page.set(page)
+        start = time.perf_counter()
+        try:
+            return fn(state, *args, **kwargs)
+        except Exception:
+            node_errors.inc(name, page)
+            raise
+        finally:
+            node_duration.observe(time.perf_counter() - start, name, page)
+            current_page.reset(token)
+
+    return wrapper
+
+
+def record_llm(model: str, duration: float, outcome: str, response=None):
+    """Ghi latency + token (usage_metadata của AIMessage) cho 1 lần gọi LLM"""
+    page = metrics.page_label()
+    llm_duration.observe(duration, model, page, outcome)
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage.get("input_tokens"):
+        llm_tokens.inc(model, page, "input", value=usage["input_tokens"])
+    if usage.get("output_tokens"):
+        llm_tokens.inc(model, page, "output", value=usage["output_tokens"])
+
+
+def record_graph_api(page_id: Optional[str], kind: str, status) -> None:
+    """status: HTTP status code của Send API, hoặc "error" nếu lỗi mạng"""
+    graph_api_responses.inc(metrics.page_label(page_id), kind, str(status))
@@ -7,21 +7,43 @@ Pipeline xử lý hóa đơn (Multi-tenant):
 2. OCR Node: Tải ảnh và trích xuất text
 3. Validate Invoice Node: Gọi DeepSeek AI validate theo tenant patterns
 4. Lucky Draw Node: Kiểm tra trùng (Firebase) + quay thưởng theo tenant config
-5. Send Message Node: Gửi tin nhắn bằng token của tenant
+5. Send Message Node: Ghi reply vào outbox (outbox.py gửi bằng token của tenant)
+
+Tenant có pipeline_mode = "single_call": OCR+Validate Node thay cho bước 2-3
+(1 request multimodal), lỗi thì quay về OCR Node -> Validate Node.
 """
 
 import os
 import json
-import random
-from typing import Dict, Any
+import base64
+import asyncio
+import logging
+from typing import Dict, Any, Optional, Tuple
 import requests
+import httpx
 
 # Import LangChain components
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
 
 from state import InvoiceState
 from services import TenantService, InvoiceService
+from llm_guard import invoke_llm, ainvoke_llm, model_chain, LLMUnavailable
+from deadline import deadlines, timeout_for, DeadlineExceeded, DEADLINE_MESSAGE
+from http_clients import http_pool
+from ocr_cache import ocr_cache, image_hash
+from shop_matcher import match_shop, record_validation_sample, ShopMatch
+from invoice_extractor import extract_invoice_fields, InvoiceFields
+from prize_sampler import prize_samplers
+from prize_inventory import prize_inventory
+from outbox import outbox, FB_SEND_API_URL
+from metrics import metrics, claim_conflicts, record_graph_api
+from logging_setup import log_payload
+from image_preprocess import (
+    download_image, adownload_image, prepare_image, PreparedImage, ImageTooLarge,
+)
+from config import settings
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -41,7 +63,7 @@ def load_tenant_node(state: InvoiceState) -> Dict[str, Any]:
     Returns:
         Dict với key 'tenant_config' chứa config của tenant
     """
-    print(f"🏪 [Load Tenant Node] Đang load config cho page: {state['page_id']}")
+    logger.info(f"🏪 [Load Tenant Node] Đang load config cho page: {state['page_id']}")
     
     page_id = state.get("page_id")
     
@@ -66,15 +88,102 @@ def load_tenant_node(state: InvoiceState) -> Dict[str, Any]:
             "error": f"Page {page_id} đã bị vô hiệu hóa"
         }
     
-    print(f"✅ [Load Tenant Node] Loaded: {tenant_config.get('shop_name')}")
+    # Build sẵn sampler quay thưởng cho config này (cache theo version)
+    if tenant_config.get("prizes"):
+        prize_samplers.for_tenant(tenant_config, tenant_config["prizes"])
+    
+    logger.info(f"✅ [Load Tenant Node] Loaded: {tenant_config.get('shop_name')}")
     
     return {"tenant_config": tenant_config, "error": None}
 
 
+async def load_tenant_node_async(state: InvoiceState) -> Dict[str, Any]:
+    """
+    Bản async của load_tenant_node.
+    Truy vấn SQLite là blocking nên được đẩy sang thread để không chặn event loop.
+    """
+    return await asyncio.to_thread(load_tenant_node, state)
+
+
 # ============================================================================
 # NODE 1: OCR NODE
 # ============================================================================
 
+# Prompt OCR dùng chung cho bản sync và async
+OCR_PROMPT = """Bạn là một OCR expert. Hãy trích xuất TẤT CẢ text từ ảnh hóa đơn này.
+
+Yêu cầu:
+- Giữ nguyên format và layout của hóa đơn
+- Bao gồm: tên cửa hàng, địa chỉ, số hóa đơn, danh sách món, giá tiền
+- Đọc chính xác các số tiền (quan trọng!)
+- Không bỏ sót bất kỳ thông tin nào
+- CHỈ trả về text đã OCR, KHÔNG giải thích thêm"""
+
+OCR_MODEL = "gemini-3-pro-image-preview"
+VALIDATE_MODEL = "gemini-3-pro-preview"
+
+# Chuỗi model: model chính -> model dự phòng (OCR/VALIDATE_FALLBACK_MODELS), xem llm_guard.py
+OCR_MODELS = model_chain(OCR_MODEL, settings.ocr_fallback_models)
+VALIDATE_MODELS = model_chain(VALIDATE_MODEL, settings.validate_fallback_models)
+
+
+def _image_data_url(image: PreparedImage) -> str:
+    img_base64 = base64.b64encode(image.data).decode('utf-8')
+    return f"data:{image.mime};base64,{img_base64}"
+
+
+def _build_ocr_message(image: PreparedImage) -> HumanMessage:
+    """Tạo message gồm prompt OCR + ảnh (base64 data URL)"""
+    return HumanMessage(
+        content=[
+            {"type": "text", "text": OCR_PROMPT},
+            {
+                "type": "image_url",
+                "image_url": _image_data_url(image)
+            }
+        ]
+    )
+
+
+def _ocr_success(ocr_text: str, from_cache: bool = False) -> Dict[str, Any]:
+    """Kiểm tra kết quả OCR và trả về update cho state"""
+    # Validate response
+    if not ocr_text or len(ocr_text) < 20:
+        raise ValueError("API returned empty or invalid OCR result")
+
+    if from_cache:
+        logger.info(f"⚡ [OCR Node] Ảnh đã được OCR trước đó -> dùng kết quả từ cache")
+    else:
+        logger.info(f"✅ [OCR Node] OCR thành công với Gemini 3 Pro Image Preview")
+    log_payload(logger, "📝 [OCR Node] Raw OCR text", ocr_text)
+
+    return {"ocr_raw_text": ocr_text.strip(), "error": None}
+
+
+def _ocr_failure(e: Exception) -> Dict[str, Any]:
+    # Technical error for logs
+    error_msg = f"Lỗi OCR với Gemini 3 Pro Image Preview: {str(e)}"
+    logger.error(f"❌ [OCR Node] {error_msg}")
+
+    # Friendly message for user
+    if isinstance(e, DeadlineExceeded):
+        deadlines.record("ocr")
+        friendly_msg = DEADLINE_MESSAGE
+    elif isinstance(e, LLMUnavailable):
+        # Lỗi phía hệ thống, không phải do ảnh
+        friendly_msg = "Hệ thống đang bận xử lý, bạn vui lòng thử lại sau ít phút nhé!"
+    else:
+        friendly_msg = "Không thể đọc được ảnh hóa đơn. Bạn vui lòng chụp lại rõ nét hơn (đủ ánh sáng, không bị mờ) và gửi lại nhé!"
+    return {"ocr_raw_text": None, "error": friendly_msg}
+
+
+def _ocr_budget_exhausted(state: InvoiceState) -> Optional[Dict[str, Any]]:
+    """Không đủ thời gian tải ảnh + OCR -> trả lời user ngay thay vì chạy quá deadline"""
+    if deadlines.exhausted(state.get("deadline"), "ocr"):
+        return {"ocr_raw_text": None, "error": DEADLINE_MESSAGE}
+    return None
+
+
 def download_and_ocr_node(state: InvoiceState) -> Dict[str, Any]:
     """
     Node 1: Sử dụng Anthropic Claude 3.5 Sonnet (qua Proxy v98store) để OCR
@@ -85,168 +194,98 @@ def download_and_ocr_node(state: InvoiceState) -> Dict[str, Any]:
     Returns:
         Dict với key 'ocr_raw_text' chứa kết quả OCR
     """
-    print(f"📥 [OCR Node] Đang xử lý ảnh từ: {state['image_url']}")
+    logger.info(f"📥 [OCR Node] Đang xử lý ảnh từ: {state['image_url']}")
     
     # Kiểm tra có lỗi từ bước trước không
     if state.get("error"):
         return {"ocr_raw_text": None}
+
+    exhausted = _ocr_budget_exhausted(state)
+    if exhausted is not None:
+        return exhausted
     
     try:
-        # Sử dụng ChatOpenAI để gọi Anthropic qua Proxy (OpenAI format)
-        from langchain_openai import ChatOpenAI
-        from langchain_core.messages import HumanMessage
-        import base64
-        
-        # Get Proxy Config
-        base_url = os.getenv("ANTHROPIC_BASE_URL")
-        api_key = os.getenv("ANTHROPIC_AUTH_TOKEN")
-        
-        if not base_url or not api_key:
-            raise ValueError("Thiếu ANTHROPIC_BASE_URL hoặc ANTHROPIC_AUTH_TOKEN")
-            
-        # Ensure base_url ends with /v1 for OpenAI compatibility
-        if not base_url.endswith("/v1"):
-            base_url = f"{base_url.rstrip('/')}/v1"
-            
         # Download and encode image (An toàn hơn gửi raw URL cho proxy)
-        img_response = requests.get(state["image_url"], timeout=10)
-        img_response.raise_for_status()
-        img_base64 = base64.b64encode(img_response.content).decode('utf-8')
+        # Session keep-alive dùng chung theo host CDN, giới hạn IMAGE_MAX_BYTES
+        image_bytes = download_image(state["image_url"], deadline=state.get("deadline"))
         
-        # Initialize Client pointing to Proxy
-        # Model: gemini-3-pro-image-preview (Upgraded for better OCR)
-        llm = ChatOpenAI(
-            model="gemini-3-pro-image-preview",
-            openai_api_key=api_key,
-            base_url=base_url,
-            temperature=0
-        )
+        # Ảnh gửi lại (cùng nội dung) -> lấy OCR text từ cache
+        digest = image_hash(image_bytes)
+        cached_text = ocr_cache.get(digest)
+        if cached_text:
+            return _ocr_success(cached_text, from_cache=True)
         
-        # Create message with image
-        message = HumanMessage(
-            content=[
-                {
-                    "type": "text",
-                    "text": """Bạn là một OCR expert. Hãy trích xuất TẤT CẢ text từ ảnh hóa đơn này.
-
-Yêu cầu:
-- Giữ nguyên format và layout của hóa đơn
-- Bao gồm: tên cửa hàng, địa chỉ, số hóa đơn, danh sách món, giá tiền
-- Đọc chính xác các số tiền (quan trọng!)
-- Không bỏ sót bất kỳ thông tin nào
-- CHỈ trả về text đã OCR, KHÔNG giải thích thêm"""
-                },
-                {
-                    "type": "image_url",
-                    "image_url": f"data:image/jpeg;base64,{img_base64}"
-                }
-            ]
-        )
-        
-        # Call API
-        response = llm.invoke([message])
-        ocr_text = response.content
-        
-        # Validate response
-        if not ocr_text or len(ocr_text) < 20:
-            raise ValueError("API returned empty or invalid OCR result")
-        
-        print(f"✅ [OCR Node] OCR thành công với Gemini 3 Pro Image Preview")
-        print(f"📝 [OCR Node] === RAW OCR TEXT ===")
-        print(ocr_text[:500] if len(ocr_text) > 500 else ocr_text)
-        print(f"📝 [OCR Node] === END OCR TEXT ===")
+        # Xoay EXIF + thu nhỏ + nén lại trước khi base64
+        image = prepare_image(image_bytes)
         
-        return {"ocr_raw_text": ocr_text.strip(), "error": None}
+        # ChatOpenAI dùng chung (qua Proxy OpenAI format, keep-alive)
+        # Model: gemini-3-pro-image-preview (Upgraded for better OCR), lỗi -> model dự phòng
+        response, _ = invoke_llm(
+            OCR_MODELS, [_build_ocr_message(image)], temperature=0, deadline=state.get("deadline")
+        )
+        result = _ocr_success(response.content)
+        ocr_cache.put(digest, result["ocr_raw_text"], len(image_bytes))
+        return result
         
     except Exception as e:
-        # Technical error for logs
-        error_msg = f"Lỗi OCR với Gemini 3 Pro Image Preview: {str(e)}"
-        print(f"❌ [OCR Node] {error_msg}")
-        
-        # Friendly message for user
-        friendly_msg = "Không thể đọc được ảnh hóa đơn. Bạn vui lòng chụp lại rõ nét hơn (đủ ánh sáng, không bị mờ) và gửi lại nhé!"
-        return {"ocr_raw_text": None, "error": friendly_msg}
+        return _ocr_failure(e)
 
 
+async def download_and_ocr_node_async(state: InvoiceState) -> Dict[str, Any]:
+    """
+    Bản async của download_and_ocr_node: tải ảnh bằng httpx.AsyncClient dùng chung
+    và gọi LLM bằng ainvoke, không giữ thread trong lúc chờ mạng.
+    """
+    logger.info(f"📥 [OCR Node] Đang xử lý ảnh từ: {state['image_url']}")
 
+    if state.get("error"):
+        return {"ocr_raw_text": None}
 
+    exhausted = _ocr_budget_exhausted(state)
+    if exhausted is not None:
+        return exhausted
 
+    try:
+        image_bytes = await adownload_image(state["image_url"], deadline=state.get("deadline"))
 
-# ============================================================================
-# NODE 2: VALIDATE INVOICE NODE (Dynamic theo tenant)
-# ============================================================================
+        digest = image_hash(image_bytes)
+        cached_text = await asyncio.to_thread(ocr_cache.get, digest)
+        if cached_text:
+            return _ocr_success(cached_text, from_cache=True)
 
-def validate_invoice_node(state: InvoiceState) -> Dict[str, Any]:
-    """
-    Node 2: Gọi AI (Gemini 3 Pro) để validate hóa đơn theo patterns của tenant
+        # Decode/encode ảnh tốn CPU -> chạy trong thread
+        image = await asyncio.to_thread(prepare_image, image_bytes)
 
-    Args:
-        state: InvoiceState chứa ocr_raw_text và tenant_config
+        response, _ = await ainvoke_llm(
+            OCR_MODELS, [_build_ocr_message(image)], temperature=0, deadline=state.get("deadline")
+        )
+        result = _ocr_success(response.content)
+        await asyncio.to_thread(ocr_cache.put, digest, result["ocr_raw_text"], len(image_bytes))
+        return result
 
-    Returns:
-        Dict với key 'validation_result' chứa kết quả từ AI
-    """
-    print(f"🤖 [Validate Node] Đang gọi Gemini 3 Pro Preview để validate...")
+    except Exception as e:
+        return _ocr_failure(e)
 
-    # Kiểm tra có lỗi từ bước trước không
-    if state.get("error"):
-        return {
-            "validation_result": {
-                "valid": False,
-                "reason": state.get("error", "Lỗi hệ thống"),
-                "data": {"invoice_id": None, "shop_name": None}
-            }
-        }
 
-    # Kiểm tra có tenant config không
-    tenant = state.get("tenant_config")
-    if not tenant:
-        return {
-            "validation_result": {
-                "valid": False,
-                "reason": "Không tìm thấy cấu hình cửa hàng",
-                "data": {"invoice_id": None, "shop_name": None}
-            }
-        }
 
-    # Kiểm tra có ocr_raw_text không
-    ocr_text = state.get("ocr_raw_text")
-    if not ocr_text:
-        return {
-            "validation_result": {
-                "valid": False,
-                "reason": "Không thể đọc được nội dung ảnh. Vui lòng gửi ảnh rõ hơn.",
-                "data": {"invoice_id": None, "shop_name": None}
-            }
-        }
 
-    try:
-        # Sử dụng Proxy (Anthropic Key) giống node OCR để đồng bộ
-        base_url = os.getenv("ANTHROPIC_BASE_URL")
-        api_key = os.getenv("ANTHROPIC_AUTH_TOKEN")
-        
-        if not base_url or not api_key:
-            raise ValueError("Thiếu ANTHROPIC_BASE_URL hoặc ANTHROPIC_AUTH_TOKEN")
-
-        # Ensure base_url ends with /v1
-        if not base_url.endswith("/v1"):
-            base_url = f"{base_url.rstrip('/')}/v1"
-
-        # Model: gemini-3-pro-preview (Mô hình mạnh nhất, logic cực tốt)
-        llm = ChatOpenAI(
-            model="gemini-3-pro-preview",
-            openai_api_key=api_key,
-            base_url=base_url,
-            temperature=0.1,
-        )
 
-        # Lấy thông tin tenant để tạo prompt động
-        shop_name = tenant.get("shop_name", "Cửa hàng")
-        shop_patterns = tenant.get("shop_patterns", [shop_name])
-        patterns_str = ", ".join([f'"{p}"' for p in shop_patterns])
 
-        # System prompt ĐỘNG theo tenant
-        system_prompt = f"""Bạn là AI kiểm duyệt hóa đơn cho chương trình khuyến mãi của "{shop_name}".
+# ============================================================================
+# NODE 2: VALIDATE INVOICE NODE (Dynamic theo tenant)
+# ============================================================================
+
+def _build_validation_prompt(tenant: dict) -> str:
+    """
+    Tạo system prompt ĐỘNG theo tenant (tên quán + shop_patterns)
+    """
+    # Lấy thông tin tenant để tạo prompt động
+    shop_name = tenant.get("shop_name", "Cửa hàng")
+    shop_patterns = tenant.get("shop_patterns", [shop_name])
+    patterns_str = ", ".join([f'"{p}"' for p in shop_patterns])
+
+    # System prompt ĐỘNG theo tenant
+    system_prompt = f"""Bạn là AI kiểm duyệt hóa đơn cho chương trình khuyến mãi của "{shop_name}".
 
 NHIỆM VỤ:
 
@@ -325,70 +364,460 @@ OUTPUT FORMAT:
     }}
 }}"""
 
-        # User message chứa OCR text
-        user_message = f"Kiểm tra hóa đơn sau:\n\n{ocr_text}"
+    return system_prompt
 
-        # Gọi DeepSeek
-        messages = [
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=user_message),
-        ]
 
-        response = llm.invoke(messages)
-        response_text = response.content.strip()
+def _empty_validation(reason: str) -> dict:
+    return {
+        "valid": False,
+        "reason": reason,
+        "data": {"invoice_id": None, "shop_name": None}
+    }
+
+
+def _validation_precheck(state: InvoiceState) -> Optional[Dict[str, Any]]:
+    """
+    Các kiểm tra trước khi gọi AI. Trả về update cho state nếu không cần gọi AI,
+    ngược lại trả về None.
+    """
+    # Kiểm tra có lỗi từ bước trước không
+    if state.get("error"):
+        return {"validation_result": _empty_validation(state.get("error", "Lỗi hệ thống"))}
+
+    # Kiểm tra có tenant config không
+    if not state.get("tenant_config"):
+        return {"validation_result": _empty_validation("Không tìm thấy cấu hình cửa hàng")}
+
+    # Kiểm tra có ocr_raw_text không
+    if not state.get("ocr_raw_text"):
+        return {
+            "validation_result": _empty_validation(
+                "Không thể đọc được nội dung ảnh. Vui lòng gửi ảnh rõ hơn."
+            )
+        }
+
+    return None
+
+
+def _local_shop_match(tenant: dict, ocr_text: str) -> Optional[ShopMatch]:
+    """
+    Fast path: so khớp tên quán bằng matcher local (shop_matcher.py)
+    trước khi gọi LLM. Trả về None nếu tắt tính năng.
+    """
+    if not settings.shop_match_enabled:
+        return None
+
+    patterns = tenant.get("shop_patterns") or [tenant.get("shop_name", "")]
+    match = match_shop(
+        ocr_text,
+        patterns,
+        accept_threshold=settings.shop_match_accept,
+        reject_threshold=settings.shop_match_reject,
+    )
+    logger.info(f"🔎 [Validate Node] Matcher local: {match.decision} (score={match.score:.2f})")
+    return match
+
+
+def _local_rejection(tenant: dict, match: ShopMatch) -> Dict[str, Any]:
+    """Tên quán khác hẳn -> từ chối luôn, không cần gọi LLM"""
+    shop_name = tenant.get("shop_name", "Cửa hàng")
+    result = {
+        "valid": False,
+        "reason": f"Tên quán trên hóa đơn không khớp với {shop_name}",
+        "data": {"invoice_id": None, "shop_name": match.matched_line},
+        "source": "local",
+    }
+    logger.info(f"✅ [Validate Node] Kết quả (local): valid=False")
+    return {"validation_result": result, "error": None}
+
+
+def _local_acceptance(match: ShopMatch, fields: InvoiceFields) -> Dict[str, Any]:
+    """Tên quán khớp rõ ràng + trích được mã hóa đơn -> hợp lệ, không cần gọi LLM"""
+    result = {
+        "valid": True,
+        "reason": "Hóa đơn hợp lệ",
+        "data": {"invoice_id": fields.invoice_id, "shop_name": match.matched_line},
+        "source": "local",
+    }
+    logger.info(f"✅ [Validate Node] Kết quả (local): valid=True, invoice_id={fields.invoice_id}")
+    return {"validation_result": result, "error": None}
+
+
+def _matcher_verdict(
+    tenant: dict, match: Optional[ShopMatch], fields: InvoiceFields
+) -> Optional[Dict[str, Any]]:
+    """Kết quả của matcher local nếu nó chắc chắn, None nếu cần LLM"""
+    if match is None:
+        return None
+    if match.decision == "reject":
+        return _local_rejection(tenant, match)
+    # Mã từ nhãn yếu ("#", "Số:") không đủ chắc để bỏ qua LLM
+    if match.decision == "accept" and fields.certain:
+        return _local_acceptance(match, fields)
+    return None
+
+
+def _local_decision(
+    tenant: dict, match: Optional[ShopMatch], fields: InvoiceFields
+) -> Optional[Dict[str, Any]]:
+    """
+    Quyết định không cần mạng nếu matcher chắc chắn. Trả về None để gọi LLM.
+    Chế độ shadow: luôn gọi LLM để ghi corpus so sánh với matcher.
+    """
+    if settings.shop_match_shadow:
+        return None
+    return _matcher_verdict(tenant, match, fields)
+
+
+def _local_fallback(
+    tenant: dict, match: Optional[ShopMatch], fields: InvoiceFields
+) -> Optional[Dict[str, Any]]:
+    """
+    Mắt xích cuối của chuỗi model: mọi LLM đều không khả dụng -> dùng kết quả
+    matcher local nếu nó chắc chắn (kể cả khi đang bật chế độ shadow).
+    Không chắc chắn -> None (báo user thử lại sau).
+    """
+    verdict = _matcher_verdict(tenant, match, fields)
+    if verdict is not None:
+        logger.info(f"↪️ [Validate Node] LLM không khả dụng -> dùng kết quả matcher local")
+    return verdict
+
+
+def _fill_invoice_id(result: Dict[str, Any], fields: InvoiceFields) -> Dict[str, Any]:
+    """LLM chấp nhận nhưng không trả về mã -> dùng mã trích xuất local (thay vì mã AUTO)"""
+    validation = result.get("validation_result") or {}
+    data = validation.get("data") or {}
+    if validation.get("valid") and not data.get("invoice_id") and fields.invoice_id:
+        data["invoice_id"] = fields.invoice_id
+        validation["data"] = data
+    return result
+
+
+def _record_sample(
+    state: InvoiceState, match: Optional[ShopMatch], fields: InvoiceFields, result: Dict[str, Any]
+):
+    if match is None or not settings.validation_corpus_path:
+        return
+    record_validation_sample(
+        settings.validation_corpus_path,
+        state["ocr_raw_text"],
+        state["tenant_config"],
+        match,
+        result.get("validation_result") or {},
+        local_invoice_id=fields.invoice_id,
+    )
+
+
+def _build_validation_messages(tenant: dict, ocr_text: str) -> list:
+    # User message chứa OCR text
+    user_message = f"Kiểm tra hóa đơn sau:\n\n{ocr_text}"
+
+    return [
+        SystemMessage(content=_build_validation_prompt(tenant)),
+        HumanMessage(content=user_message),
+    ]
+
+
+def _extract_json_text(response_text: str) -> str:
+    """Bóc JSON ra khỏi markdown code fence (```json ... ```) nếu có"""
+    json_text = response_text
+    if "```json" in json_text:
+        json_text = json_text.split("```json")[1].split("```")[0].strip()
+    elif "```" in json_text:
+        json_text = json_text.split("```")[1].split("```")[0].strip()
+    return json_text
+
+
+def _parse_validation_response(response_text: str) -> Dict[str, Any]:
+    """
+    Parse JSON từ AI và bổ sung các field còn thiếu
+
+    Raises:
+        json.JSONDecodeError nếu AI không trả về JSON hợp lệ
+    """
+    log_payload(logger, "📝 [Validate Node] AI response", response_text)
+
+    return _finalize_validation(json.loads(_extract_json_text(response_text)))
+
 
-        print(f"📝 [Validate Node] === AI RESPONSE ===")
-        print(response_text)
-        print(f"📝 [Validate Node] === END AI RESPONSE ===")
+def _finalize_validation(validation_result: dict) -> Dict[str, Any]:
+    """Bổ sung các field còn thiếu cho JSON validate và trả về update cho state"""
+    # Đảm bảo có đủ các field cần thiết
+    if "valid" not in validation_result:
+        validation_result["valid"] = False
+    if "reason" not in validation_result:
+        validation_result["reason"] = "Không xác định"
+    if "data" not in validation_result:
+        validation_result["data"] = {"invoice_id": None, "shop_name": None}
 
-        # Parse JSON response
-        json_text = response_text
-        if "```json" in json_text:
-            json_text = json_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in json_text:
-            json_text = json_text.split("```")[1].split("```")[0].strip()
+    logger.info(f"✅ [Validate Node] Kết quả: valid={validation_result['valid']}")
 
-        validation_result = json.loads(json_text)
+    return {"validation_result": validation_result, "error": None}
 
-        # Đảm bảo có đủ các field cần thiết
-        if "valid" not in validation_result:
-            validation_result["valid"] = False
-        if "reason" not in validation_result:
-            validation_result["reason"] = "Không xác định"
-        if "data" not in validation_result:
-            validation_result["data"] = {"invoice_id": None, "shop_name": None}
 
-        print(f"✅ [Validate Node] Kết quả: valid={validation_result['valid']}")
+def _deadline_validation() -> Dict[str, Any]:
+    """Hết ngân sách thời gian trước khi validate xong"""
+    return {"validation_result": _empty_validation(DEADLINE_MESSAGE), "error": DEADLINE_MESSAGE}
 
-        return {"validation_result": validation_result, "error": None}
 
-    except json.JSONDecodeError as e:
+def _validation_failure(e: Exception) -> Dict[str, Any]:
+    if isinstance(e, json.JSONDecodeError):
         error_msg = f"Không thể parse JSON từ AI: {str(e)}"
-        print(f"❌ [Validate Node] {error_msg}")
+        logger.error(f"❌ [Validate Node] {error_msg}")
         return {
-            "validation_result": {
-                "valid": False,
-                "reason": "Hệ thống đang bận, vui lòng thử lại sau.",
-                "data": {"invoice_id": None, "shop_name": None}
-            },
+            "validation_result": _empty_validation("Hệ thống đang bận, vui lòng thử lại sau."),
             "error": error_msg,
         }
+
+    # Technical error for logs
+    error_msg = f"Lỗi khi gọi AI Provider: {str(e)}"
+    logger.error(f"❌ [Validate Node] {error_msg}")
+
+    # Friendly message
+    friendly_msg = "Hệ thống đang bận xử lý, bạn vui lòng thử lại sau ít phút nhé!"
+
+    return {
+        "validation_result": _empty_validation(friendly_msg),
+        "error": friendly_msg,
+    }
+
+
+def validate_invoice_node(state: InvoiceState) -> Dict[str, Any]:
+    """
+    Node 2: Gọi AI (Gemini 3 Pro) để validate hóa đơn theo patterns của tenant
+
+    Args:
+        state: InvoiceState chứa ocr_raw_text và tenant_config
+
+    Returns:
+        Dict với key 'validation_result' chứa kết quả từ AI
+    """
+    logger.info(f"🤖 [Validate Node] Đang gọi Gemini 3 Pro Preview để validate...")
+
+    precheck = _validation_precheck(state)
+    if precheck is not None:
+        return precheck
+
+    match = _local_shop_match(state["tenant_config"], state["ocr_raw_text"])
+    fields = extract_invoice_fields(state["ocr_raw_text"])
+    local = _local_decision(state["tenant_config"], match, fields)
+    if local is not None:
+        return local
+    if deadlines.exhausted(state.get("deadline"), "validate"):
+        return _local_fallback(state["tenant_config"], match, fields) or _deadline_validation()
+
+    try:
+        # Dùng chung Proxy + connection pool với node OCR
+        # Model: gemini-3-pro-preview (Mô hình mạnh nhất, logic cực tốt), lỗi -> model dự phòng
+        messages = _build_validation_messages(state["tenant_config"], state["ocr_raw_text"])
+        response, _ = invoke_llm(VALIDATE_MODELS, messages, temperature=0.1, deadline=state.get("deadline"))
+        result = _parse_validation_response(response.content.strip())
+        _record_sample(state, match, fields, result)
+        return _fill_invoice_id(result, fields)
+
+    except LLMUnavailable as e:
+        return _local_fallback(state["tenant_config"], match, fields) or _validation_failure(e)
+
+    except DeadlineExceeded:
+        deadlines.record("validate")
+        return _local_fallback(state["tenant_config"], match, fields) or _deadline_validation()
+
     except Exception as e:
-        # Technical error for logs
-        error_msg = f"Lỗi khi gọi AI Provider: {str(e)}"
-        print(f"❌ [Validate Node] {error_msg}")
-        
-        # Friendly message
-        friendly_msg = "Hệ thống đang bận xử lý, bạn vui lòng thử lại sau ít phút nhé!"
-        
-        return {
-            "validation_result": {
-                "valid": False,
-                "reason": friendly_msg,
-                "data": {"invoice_id": None, "shop_name": None}
-            },
-            "error": friendly_msg,
-        }
+        return _validation_failure(e)
+
+
+async def validate_invoice_node_async(state: InvoiceState) -> Dict[str, Any]:
+    """
+    Bản async của validate_invoice_node (dùng ainvoke)
+    """
+    logger.info(f"🤖 [Validate Node] Đang gọi Gemini 3 Pro Preview để validate...")
+
+    precheck = _validation_precheck(state)
+    if precheck is not None:
+        return precheck
+
+    match = _local_shop_match(state["tenant_config"], state["ocr_raw_text"])
+    fields = extract_invoice_fields(state["ocr_raw_text"])
+    local = _local_decision(state["tenant_config"], match, fields)
+    if local is not None:
+        return local
+    if deadlines.exhausted(state.get("deadline"), "validate"):
+        return _local_fallback(state["tenant_config"], match, fields) or _deadline_validation()
+
+    try:
+        messages = _build_validation_messages(state["tenant_config"], state["ocr_raw_text"])
+        response, _ = await ainvoke_llm(VALIDATE_MODELS, messages, temperature=0.1, deadline=state.get("deadline"))
+        result = _parse_validation_response(response.content.strip())
+        await asyncio.to_thread(_record_sample, state, match, fields, result)
+        return _fill_invoice_id(result, fields)
+
+    except LLMUnavailable as e:
+        return _local_fallback(state["tenant_config"], match, fields) or _validation_failure(e)
+
+    except DeadlineExceeded:
+        deadlines.record("validate")
+        return _local_fallback(state["tenant_config"], match, fields) or _deadline_validation()
+
+    except Exception as e:
+        return _validation_failure(e)
+
+
+# ============================================================================
+# NODE 1+2: OCR + VALIDATE TRONG 1 REQUEST (pipeline_mode = "single_call")
+# ============================================================================
+#
+# Gửi ảnh kèm prompt validate của tenant trong 1 lần gọi model multimodal,
+# model trả về cả OCR text lẫn JSON validate -> bớt 1 round-trip và không phải
+# gửi lại OCR text làm input cho lần gọi thứ 2.
+#
+# Node chỉ cập nhật state khi thành công. Nếu lỗi / JSON thiếu ocr_text,
+# graph quay về luồng 2 bước cũ (OCR -> Validate), xem route_after_ocr_validate.
+
+SINGLE_CALL_INSTRUCTIONS = """
+
+CHẾ ĐỘ 1 BƯỚC (đầu vào là ẢNH hóa đơn, không phải text):
+- Trước tiên OCR TẤT CẢ text trong ảnh: giữ nguyên format và layout, đọc chính xác
+  các số tiền, không bỏ sót thông tin
+- Sau đó kiểm tra hóa đơn theo đúng các bước ở trên dựa trên text vừa OCR
+- Thêm field "ocr_text" (string) vào JSON output, chứa toàn bộ text đã OCR"""
+
+
+def _build_single_call_messages(tenant: dict, image: PreparedImage) -> list:
+    """System prompt validate của tenant + ảnh hóa đơn"""
+    return [
+        SystemMessage(content=_build_validation_prompt(tenant) + SINGLE_CALL_INSTRUCTIONS),
+        HumanMessage(
+            content=[
+                {"type": "text", "text": "Kiểm tra hóa đơn trong ảnh sau:"},
+                {"type": "image_url", "image_url": _image_data_url(image)},
+            ]
+        ),
+    ]
+
+
+def _parse_single_call_response(response_text: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Tách OCR text và kết quả validate từ response của chế độ 1 bước
+
+    Raises:
+        ValueError / json.JSONDecodeError nếu response không dùng được
+    """
+    payload = json.loads(_extract_json_text(response_text))
+    if not isinstance(payload, dict):
+        raise ValueError("Single-call response is not a JSON object")
+
+    ocr_text = payload.pop("ocr_text", None)
+    if not isinstance(ocr_text, str) or len(ocr_text.strip()) < 20:
+        raise ValueError("Single-call response has no usable ocr_text")
+
+    log_payload(logger, "📝 [OCR+Validate Node] Raw OCR text", ocr_text)
+
+    ocr_text = ocr_text.strip()
+    result = _fill_invoice_id(_finalize_validation(payload), extract_invoice_fields(ocr_text))
+    result["ocr_raw_text"] = ocr_text
+    return ocr_text, result
+
+
+def _single_call_fallback(e: Exception) -> Dict[str, Any]:
+    if isinstance(e, ImageTooLarge):
+        # Luồng 2 bước cũng sẽ từ chối ảnh này -> báo lỗi luôn
+        return _ocr_failure(e)
+    if isinstance(e, DeadlineExceeded):
+        # Node OCR của luồng 2 bước sẽ thấy hết ngân sách và trả lời user
+        deadlines.record("ocr_validate")
+        return {}
+    # Không set error: graph sẽ chạy lại theo luồng OCR -> Validate
+    logger.warning(f"⚠️ [OCR+Validate Node] Chế độ 1 bước thất bại ({e}) -> quay về OCR + Validate")
+    return {}
+
+
+def ocr_validate_node(state: InvoiceState) -> Dict[str, Any]:
+    """
+    Node 1+2: Tải ảnh, OCR và validate trong 1 lần gọi LLM
+
+    Returns:
+        - {ocr_raw_text, validation_result}: thành công
+        - {ocr_raw_text}: ảnh đã có trong OCR cache -> chỉ còn bước validate (text)
+        - {}: thất bại -> graph chạy luồng 2 bước
+    """
+    logger.info(f"📥 [OCR+Validate Node] Đang xử lý ảnh từ: {state['image_url']}")
+
+    if deadlines.exhausted(state.get("deadline"), "ocr_validate"):
+        return {}
+
+    try:
+        image_bytes = download_image(state["image_url"], deadline=state.get("deadline"))
+
+        # Đã có OCR text -> validate bằng text rẻ hơn gửi lại ảnh
+        digest = image_hash(image_bytes)
+        cached_text = ocr_cache.get(digest)
+        if cached_text:
+            return _ocr_success(cached_text, from_cache=True)
+
+        image = prepare_image(image_bytes)
+        # Không có model dự phòng: lỗi / mạch mở -> quay về luồng 2 bước
+        response, _ = invoke_llm(
+            [settings.single_call_model],
+            _build_single_call_messages(state["tenant_config"], image),
+            temperature=0.1,
+            deadline=state.get("deadline"),
+        )
+        ocr_text, result = _parse_single_call_response(response.content.strip())
+        ocr_cache.put(digest, ocr_text, len(image_bytes))
+        return result
+
+    except Exception as e:
+        return _single_call_fallback(e)
+
+
+async def ocr_validate_node_async(state: InvoiceState) -> Dict[str, Any]:
+    """
+    Bản async của ocr_validate_node (httpx.AsyncClient + ainvoke)
+    """
+    logger.info(f"📥 [OCR+Validate Node] Đang xử lý ảnh từ: {state['image_url']}")
+
+    if deadlines.exhausted(state.get("deadline"), "ocr_validate"):
+        return {}
+
+    try:
+        image_bytes = await adownload_image(state["image_url"], deadline=state.get("deadline"))
+
+        digest = image_hash(image_bytes)
+        cached_text = await asyncio.to_thread(ocr_cache.get, digest)
+        if cached_text:
+            return _ocr_success(cached_text, from_cache=True)
+
+        image = await asyncio.to_thread(prepare_image, image_bytes)
+        response, _ = await ainvoke_llm(
+            [settings.single_call_model],
+            _build_single_call_messages(state["tenant_config"], image),
+            temperature=0.1,
+            deadline=state.get("deadline"),
+        )
+        ocr_text, result = _parse_single_call_response(response.content.strip())
+        await asyncio.to_thread(ocr_cache.put, digest, ocr_text, len(image_bytes))
+        return result
+
+    except Exception as e:
+        return _single_call_fallback(e)
+
+
+def route_after_load_tenant(state: InvoiceState) -> str:
+    """Chọn luồng theo pipeline_mode của tenant"""
+    tenant = state.get("tenant_config")
+    if not state.get("error") and tenant and tenant.get("pipeline_mode") == "single_call":
+        return "ocr_validate"
+    return "ocr"
+
+
+def route_after_ocr_validate(state: InvoiceState) -> str:
+    if state.get("validation_result"):
+        return "lucky_draw"
+    if state.get("ocr_raw_text"):
+        # OCR cache hit -> chỉ cần validate
+        return "validate_invoice"
+    # Fallback: luồng 2 bước
+    return "ocr"
 
 
 # ============================================================================
@@ -397,7 +826,7 @@ OUTPUT FORMAT:
 
 def lucky_draw_node(state: InvoiceState) -> Dict[str, Any]:
     """
-    Node 3: Kiểm tra trùng lặp (Firebase) và quay thưởng theo config của tenant
+    Node 3: Giữ chỗ hóa đơn (chống trùng) và quay thưởng theo config của tenant
 
     Args:
         state: InvoiceState chứa validation_result và tenant_config
@@ -405,7 +834,7 @@ def lucky_draw_node(state: InvoiceState) -> Dict[str, Any]:
     Returns:
         Dict với key 'final_response' chứa tin nhắn kết quả
     """
-    print(f"🎰 [Lucky Draw Node] Đang xử lý quay thưởng...")
+    logger.info(f"🎰 [Lucky Draw Node] Đang xử lý quay thưởng...")
 
     validation_result = state.get("validation_result", {})
     tenant = state.get("tenant_config") or {}
@@ -417,6 +846,10 @@ def lucky_draw_node(state: InvoiceState) -> Dict[str, Any]:
     # ========================================
     # BƯỚC 1: Kiểm tra validation có hợp lệ không
     # ========================================
+    if state.get("error") == DEADLINE_MESSAGE:
+        # Hết ngân sách thời gian: không phải hóa đơn sai, chỉ báo user gửi lại
+        return {"final_response": DEADLINE_MESSAGE}
+
     if not validation_result.get("valid", False):
         reason = validation_result.get("reason", "Hóa đơn không hợp lệ")
         detected_shop = validation_result.get("data", {}).get("shop_name")
@@ -442,11 +875,11 @@ def lucky_draw_node(state: InvoiceState) -> Dict[str, Any]:
 
 {invalid_template.format(shop_name=shop_name)}"""
 
-        print(f"⛔ [Lucky Draw Node] Từ chối: {reason}")
+        logger.warning(f"⛔ [Lucky Draw Node] Từ chối: {reason}")
         return {"final_response": final_response}
 
     # ========================================
-    # BƯỚC 2: Kiểm tra trùng lặp (Firebase)
+    # BƯỚC 2: Xác định mã hóa đơn
     # ========================================
     invoice_id = validation_result.get("data", {}).get("invoice_id")
     
@@ -458,29 +891,10 @@ def lucky_draw_node(state: InvoiceState) -> Dict[str, Any]:
         timestamp = datetime.now().strftime("%d%m%y-%H%M%S")
         hash_suffix = hashlib.md5(f"{sender_id}{timestamp}".encode()).hexdigest()[:6].upper()
         invoice_id = f"AUTO-{timestamp}-{hash_suffix}"
-        print(f"⚠️ [Lucky Draw Node] Tạo invoice_id tự động: {invoice_id}")
-
-    if invoice_id:
-        # Kiểm tra trong Firebase
-        if InvoiceService.is_invoice_used(invoice_id, page_id):
-            messages = tenant.get("messages", {})
-            duplicate_msg = messages.get(
-                "duplicate",
-                "Hãy quay lại {shop_name} để nhận hóa đơn mới nhé!"
-            )
-            
-            final_response = f"""⚠️ Hóa đơn này đã được sử dụng rồi!
-
-🔢 Mã HĐ: {invoice_id}
-
-Mỗi hóa đơn chỉ được quay thưởng 1 lần.
-{duplicate_msg.format(shop_name=shop_name)}"""
-
-            print(f"🔄 [Lucky Draw Node] Trùng lặp: {invoice_id}")
-            return {"final_response": final_response}
+        logger.warning(f"⚠️ [Lucky Draw Node] Tạo invoice_id tự động: {invoice_id}")
 
     # ========================================
-    # BƯỚC 3: Quay thưởng random theo config của tenant
+    # BƯỚC 3: Giữ chỗ hóa đơn + quay thưởng random theo config của tenant
     # ========================================
     prizes = tenant.get("prizes", [])
     
@@ -490,16 +904,35 @@ Mỗi hóa đơn chỉ được quay thưởng 1 lần.
             {"name": "Chúc may mắn lần sau", "rate": 1.0, "emoji": "🍀", "instruction": "Quay lại lần sau nhé!"}
         ]
     
-    prize = _spin_lucky_wheel(prizes)
-
-    # Lưu vào Firebase
     if invoice_id:
-        InvoiceService.mark_invoice_used(
+        # 1 câu lệnh INSERT ... ON CONFLICT DO NOTHING quyết định mới/trùng,
+        # chỉ quay thưởng (và trừ suất giải có giới hạn) khi giữ chỗ thành công,
+        # tất cả trong cùng transaction
+        prize = InvoiceService.claim_and_draw(
             invoice_id=invoice_id,
             page_id=page_id,
             sender_id=sender_id,
-            prize_won=prize["name"]
+            draw=lambda db: _spin_lucky_wheel(tenant, prizes, db),
         )
+        if prize is None:
+            messages = tenant.get("messages", {})
+            duplicate_msg = messages.get(
+                "duplicate",
+                "Hãy quay lại {shop_name} để nhận hóa đơn mới nhé!"
+            )
+            
+            final_response = f"""⚠️ Hóa đơn này đã được sử dụng rồi!
+
+🔢 Mã HĐ: {invoice_id}
+
+Mỗi hóa đơn chỉ được quay thưởng 1 lần.
+{duplicate_msg.format(shop_name=shop_name)}"""
+
+            claim_conflicts.inc(metrics.page_label(page_id))
+            logger.info(f"🔄 [Lucky Draw Node] Trùng lặp: {invoice_id}")
+            return {"final_response": final_response}
+    else:
+        prize = _spin_lucky_wheel(tenant, prizes)
 
     # Lấy message cảm ơn
     messages = tenant.get("messages", {})
@@ -516,50 +949,44 @@ Mỗi hóa đơn chỉ được quay thưởng 1 lần.
 
 {thank_you_msg.format(shop_name=shop_name)} 💚"""
 
-    print(f"🎁 [Lucky Draw Node] Kết quả: {prize['name']}")
+    logger.info(f"🎁 [Lucky Draw Node] Kết quả: {prize['name']}")
     return {"final_response": final_response}
 
 
-def _spin_lucky_wheel(prizes: list) -> dict:
+async def lucky_draw_node_async(state: InvoiceState) -> Dict[str, Any]:
     """
-    Quay vòng quay may mắn theo tỉ lệ từ config
+    Bản async của lucky_draw_node.
+    Giữ chỗ hóa đơn + quay thưởng là transaction SQLite blocking nên chạy trong thread.
+    """
+    return await asyncio.to_thread(lucky_draw_node, state)
+
+
+def _spin_lucky_wheel(tenant: dict, prizes: list, db=None) -> dict:
+    """
+    Quay vòng quay may mắn theo tỉ lệ từ config (alias method, O(1)),
+    giải có "limit" được trừ suất qua prize_inventory
 
     Args:
+        tenant: Tenant config (id + version để lấy sampler đã build sẵn)
         prizes: List các giải thưởng với rate
+        db: Session của transaction giữ chỗ hóa đơn (None = transaction riêng)
         
     Returns:
         Dict chứa thông tin giải thưởng
     """
-    rand = random.random()
-
-    cumulative = 0.0
-    for prize in prizes:
-        cumulative += prize.get("rate", 0)
-        if rand < cumulative:
-            return prize
+    if not prizes:
+        return {"name": "Không có giải", "emoji": "❌", "instruction": ""}
 
-    # Fallback - trả về giải cuối cùng
-    return prizes[-1] if prizes else {"name": "Không có giải", "emoji": "❌", "instruction": ""}
+    sampler = prize_samplers.for_tenant(tenant, prizes)
+    return prize_inventory.draw(sampler, tenant.get("id") or "", db)
 
 
 # ============================================================================
 # NODE 4: SEND MESSAGE NODE (Dùng token của tenant)
 # ============================================================================
 
-def send_message_node(state: InvoiceState) -> Dict[str, Any]:
-    """
-    Node 4: Gửi tin nhắn trả về cho user qua Facebook Messenger
-    Sử dụng Page Access Token của tenant
-
-    Args:
-        state: InvoiceState chứa sender_id, tenant_config và final_response
-
-    Returns:
-        Dict rỗng (kết thúc workflow)
-    """
-    print(f"📤 [Send Message Node] Đang gửi tin nhắn về Messenger...")
-
-    sender_id = state["sender_id"]
+def _resolve_message_text(state: InvoiceState) -> str:
+    """Chọn nội dung gửi user: final_response, thông báo lỗi (đã che), hoặc mặc định"""
     message_text = state.get("final_response")
     
     # Nếu có lỗi và không có final_response
@@ -568,67 +995,166 @@ def send_message_node(state: InvoiceState) -> Dict[str, Any]:
         # Safety net: Nếu vẫn còn lộ technical error (chứa từ khóa nhạy cảm)
         if "Traceback" in error_content or "Error" in error_content or "Exception" in error_content:
              message_text = "Hệ thống đang gặp sự cố nhỏ. Bạn vui lòng thử lại sau nhé! 👇"
-             print(f"⚠️ [Send Message Node] Masked error: {error_content}")
+             logger.warning(f"⚠️ [Send Message Node] Masked error: {error_content}")
         else:
              message_text = f"❌ {error_content}"
              
     elif not message_text:
         message_text = "Đã nhận được ảnh của bạn! Hệ thống đang xử lý..."
 
+    return message_text
+
+
+def _build_send_request(state: InvoiceState) -> Tuple[Optional[dict], Optional[dict], Optional[str]]:
+    """
+    Chuẩn bị request cho Facebook Send API
+
+    Returns:
+        (payload, params, error_msg) - error_msg khác None nếu thiếu token
+    """
+    sender_id = state["sender_id"]
+    message_text = _resolve_message_text(state)
+
     # Lấy Page Access Token từ tenant config (database)
-    tenant = state.get("tenant_config", {})
+    tenant = state.get("tenant_config") or {}
     page_access_token = tenant.get("access_token")
 
     if not page_access_token:
         page_id = state.get("page_id", "unknown")
         error_msg = f"Không tìm thấy Access Token cho Page ID: {page_id}"
-        print(f"❌ [Send Message Node] {error_msg}")
-        print(f"   Vui lòng cập nhật token bằng: python python/update_token.py")
-        return {"error": error_msg}
+        logger.error(f"❌ [Send Message Node] {error_msg}")
+        logger.info(f"   Vui lòng cập nhật token bằng: python python/update_token.py")
+        return None, None, error_msg
+
+    # Payload
+    payload = {
+        "recipient": {"id": sender_id},
+        "message": {"text": message_text},
+        "messaging_type": "RESPONSE",
+    }
+
+    # Params
+    params = {"access_token": page_access_token}
+
+    return payload, params, None
+
 
+def _log_fb_error_body(response) -> None:
+    """Log chi tiết FB error body nếu có"""
+    if response is None:
+        return
     try:
-        # URL của Facebook Send API
-        url = "https://graph.facebook.com/v18.0/me/messages"
-
-        # Payload
-        payload = {
-            "recipient": {"id": sender_id},
-            "message": {"text": message_text},
-            "messaging_type": "RESPONSE",
-        }
+        fb_error = response.json()
+        logger.error(f"❌ [Send Message Node] FB Error Body: {json.dumps(fb_error, indent=2)}")
+    except Exception:
+        logger.error(f"❌ [Send Message Node] FB Error Text: {response.text}")
+
+
+def _send_timeout(state: InvoiceState) -> float:
+    """Gửi thẳng: bám theo deadline nhưng luôn chừa tối thiểu DEADLINE_MIN_NODE_SECONDS để user nhận được trả lời"""
+    return max(settings.deadline_min_node_seconds, timeout_for(state.get("deadline"), settings.http_read_timeout))
+
+
+def _queue_reply(state: InvoiceState, payload: dict) -> Optional[int]:
+    """
+    Ghi reply vào outbox để sender async gửi (retry + rate limit theo Page)
+
+    Returns:
+        ID tin trong outbox, None nếu outbox tắt/không chạy trong process này
+        hoặc ghi DB lỗi -> caller gửi thẳng như trước
+    """
+    if not (settings.outbox_enabled and outbox.accepting()):
+        return None
+    try:
+        outbox_id = outbox.enqueue(state.get("page_id"), state["sender_id"], payload)
+    except Exception as e:
+        logger.warning(f"⚠️ [Send Message Node] Không ghi được outbox ({e}) -> gửi trực tiếp")
+        return None
+    logger.info(f"📮 [Send Message Node] Đã xếp tin {outbox_id} vào outbox cho {state['sender_id']}")
+    return outbox_id
+
 
-        # Headers
-        headers = {"Content-Type": "application/json"}
+def send_message_node(state: InvoiceState) -> Dict[str, Any]:
+    """
+    Node 4: Gửi tin nhắn trả về cho user qua Facebook Messenger
+    Sử dụng Page Access Token của tenant. Khi outbox đang chạy (server FastAPI)
+    chỉ xếp tin vào outbox rồi kết thúc, việc gửi do outbox.py đảm nhiệm.
 
-        # Params
-        params = {"access_token": page_access_token}
+    Args:
+        state: InvoiceState chứa sender_id, tenant_config và final_response
+
+    Returns:
+        Dict rỗng (kết thúc workflow)
+    """
+    logger.info(f"📤 [Send Message Node] Đang gửi tin nhắn về Messenger...")
 
+    payload, params, error_msg = _build_send_request(state)
+    if error_msg:
+        return {"error": error_msg}
+
+    if _queue_reply(state, payload) is not None:
+        return {}
+
+    try:
         # Gửi request
-        response = requests.post(
-            url, json=payload, headers=headers, params=params, timeout=10
-        )
+        response = http_pool.post(FB_SEND_API_URL, json=payload, params=params, timeout=_send_timeout(state))
+        record_graph_api(state.get("page_id"), "message", response.status_code)
 
         response.raise_for_status()
 
-        print(f"✅ [Send Message Node] Gửi tin nhắn thành công đến {sender_id}")
+        logger.info(f"✅ [Send Message Node] Gửi tin nhắn thành công đến {state['sender_id']}")
 
         return {}
 
     except requests.exceptions.RequestException as e:
         error_msg = f"Lỗi khi gửi tin nhắn Facebook: {str(e)}"
-        
-        # Log chi tiết FB error body nếu có
-        if e.response is not None:
-             try:
-                 fb_error = e.response.json()
-                 print(f"❌ [Send Message Node] FB Error Body: {json.dumps(fb_error, indent=2)}")
-             except:
-                 print(f"❌ [Send Message Node] FB Error Text: {e.response.text}")
-                 
-        print(f"❌ [Send Message Node] {error_msg}")
+        if e.response is None:
+            record_graph_api(state.get("page_id"), "message", "error")
+        _log_fb_error_body(e.response)
+        logger.error(f"❌ [Send Message Node] {error_msg}")
         return {"error": error_msg}
         
     except Exception as e:
         error_msg = f"Lỗi không xác định: {str(e)}"
-        print(f"❌ [Send Message Node] {error_msg}")
+        logger.error(f"❌ [Send Message Node] {error_msg}")
+        return {"error": error_msg}
+
+
+async def send_message_node_async(state: InvoiceState) -> Dict[str, Any]:
+    """
+    Bản async của send_message_node (httpx.AsyncClient dùng chung theo host)
+    """
+    logger.info(f"📤 [Send Message Node] Đang gửi tin nhắn về Messenger...")
+
+    payload, params, error_msg = _build_send_request(state)
+    if error_msg:
+        return {"error": error_msg}
+
+    if await asyncio.to_thread(_queue_reply, state, payload) is not None:
+        return {}
+
+    try:
+        response = await http_pool.apost(FB_SEND_API_URL, json=payload, params=params, timeout=_send_timeout(state))
+        record_graph_api(state.get("page_id"), "message", response.status_code)
+        response.raise_for_status()
+
+        logger.info(f"✅ [Send Message Node] Gửi tin nhắn thành công đến {state['sender_id']}")
+
+        return {}
+
+    except httpx.HTTPStatusError as e:
+        error_msg = f"Lỗi khi gửi tin nhắn Facebook: {str(e)}"
+        _log_fb_error_body(e.response)
+        logger.error(f"❌ [Send Message Node] {error_msg}")
+        return {"error": error_msg}
+
+    except httpx.HTTPError as e:
+        error_msg = f"Lỗi khi gửi tin nhắn Facebook: {str(e)}"
+        record_graph_api(state.get("page_id"), "message", "error")
+        logger.error(f"❌ [Send Message Node] {error_msg}")
+        return {"error": error_msg}
+
+    except Exception as e:
+        error_msg = f"Lỗi không xác định: {str(e)}"
+        logger.error(f"❌ [Send Message Node] {error_msg}")
         return {"error": error_msg}
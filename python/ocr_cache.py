@@ -0,0 +1,182 @@
+"""
+File: ocr_cache.py
+Mục đích: Cache kết quả OCR theo nội dung ảnh (SHA-256)
+
+User hay gửi lại cùng 1 ảnh hóa đơn (forward, gửi lại sau khi bị từ chối...).
+Thay vì gọi lại model vision, node OCR tra cache theo hash của bytes ảnh
+và trả về ocr_raw_text trong vài mili-giây.
+
+- Lưu trong bảng `ocr_cache` (SQLite) nên dùng chung giữa các worker và restart
+- Eviction theo tuổi (OCR_CACHE_MAX_AGE) và kích thước (OCR_CACHE_MAX_ENTRIES,
+  bỏ các entry ít dùng gần đây nhất)
+- Đếm hit/miss trong process để theo dõi (xem /debug/caches)
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import text
+
+from config import settings
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def image_hash(image_bytes: bytes) -> str:
+    """SHA-256 hex của bytes ảnh gốc"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class OcrResultCache:
+    """
+    Cache OCR text lưu trong SQLite
+
+    Args:
+        max_entries: Số entry tối đa giữ lại
+        max_age: Tuổi tối đa của 1 entry (giây)
+        evict_every: Chạy eviction sau mỗi N lần ghi
+    """
+
+    def __init__(self, max_entries: int = 5000, max_age: float = 7 * 86400, evict_every: int = 50):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.enabled = max_entries > 0
+
+        self._lock = threading.Lock()
+        self._puts_since_evict = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, digest: str) -> Optional[str]:
+        """Trả về OCR text nếu ảnh đã được OCR trước đó (và chưa quá hạn)"""
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        db = SessionLocal()
+        try:
+            row = db.execute(
+                text("""
+                    UPDATE ocr_cache
+                    SET hits = hits + 1, last_used_at = :now
+                    WHERE image_hash = :hash AND created_at >= :min_created
+                    RETURNING ocr_text
+                """),
+                {"hash": digest, "now": now, "min_created": now - self.max_age},
+            ).first()
+            db.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ [OCR Cache] Lỗi đọc cache: {e}")
+            db.rollback()
+            row = None
+        finally:
+            db.close()
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def put(self, digest: str, ocr_text: str, image_size: int = 0):
+        """Lưu OCR text cho ảnh (ghi đè nếu đã có)"""
+        if not self.enabled:
+            return
+
+        now = time.time()
+        db = SessionLocal()
+        try:
+            db.execute(
+                text("""
+                    INSERT INTO ocr_cache (image_hash, ocr_text, image_size, hits, created_at, last_used_at)
+                    VALUES (:hash, :ocr_text, :image_size, 0, :now, :now)
+                    ON CONFLICT(image_hash) DO UPDATE SET
+                        ocr_text = excluded.ocr_text,
+                        created_at = excluded.created_at,
+                        last_used_at = excluded.last_used_at
+                """),
+                {"hash": digest, "ocr_text": ocr_text, "image_size": image_size, "now": now},
+            )
+            db.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ [OCR Cache] Lỗi ghi cache: {e}")
+            db.rollback()
+            return
+        finally:
+            db.close()
+
+        with self._lock:
+            self._puts_since_evict += 1
+            should_evict = self._puts_since_evict >= self.evict_every
+            if should_evict:
+                self._puts_since_evict = 0
+        if should_evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Xóa entry quá hạn, sau đó cắt bớt các entry ít dùng gần đây nhất
+        nếu vượt max_entries.
+
+        Returns:
+            Số entry đã xóa
+        """
+        now = time.time()
+        db = SessionLocal()
+        try:
+            removed = db.execute(
+                text("DELETE FROM ocr_cache WHERE created_at < :min_created"),
+                {"min_created": now - self.max_age},
+            ).rowcount or 0
+
+            count = db.execute(text("SELECT COUNT(*) FROM ocr_cache")).scalar() or 0
+            excess = count - self.max_entries
+            if excess > 0:
+                removed += db.execute(
+                    text("""
+                        DELETE FROM ocr_cache WHERE image_hash IN (
+                            SELECT image_hash FROM ocr_cache
+                            ORDER BY last_used_at ASC
+                            LIMIT :excess
+                        )
+                    """),
+                    {"excess": excess},
+                ).rowcount or 0
+            db.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ [OCR Cache] Lỗi eviction: {e}")
+            db.rollback()
+            return 0
+        finally:
+            db.close()
+
+        with self._lock:
+            self.evicted += removed
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evicted": self.evicted,
+                "max_entries": self.max_entries,
+                "max_age": self.max_age,
+            }
+
+
+# Cache dùng chung toàn process
+ocr_cache = OcrResultCache(
+    max_entries=settings.ocr_cache_max_entries,
+    max_age=settings.ocr_cache_max_age,
+)
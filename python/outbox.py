@@ -0,0 +1,527 @@
+"""
+File: outbox.py
+Mục đích: Outbox bền vững (SQLite) + sender async cho tin nhắn Messenger
+
+Trước đây send_message_node POST thẳng lên Send API bên trong pipeline:
+không retry, không tôn trọng rate limit của Graph API, lỗi thì chỉ log rồi mất.
+
+Giờ pipeline chỉ ghi reply vào bảng `outbound_message` (enqueue) rồi kết thúc.
+1 dispatcher async chạy trên event loop của server sẽ:
+- Claim lô tin đến hạn bằng 1 câu UPDATE ... RETURNING (có lease, process chết
+  giữa chừng thì tin được gửi lại sau khi lease hết hạn)
+- Giới hạn tốc độ theo từng Page bằng token bucket (OUTBOX_PAGE_RATE/BURST)
+- Gửi qua httpx.AsyncClient dùng chung (http_pool) nên giữ được keep-alive
+- Lỗi throttling của Graph API (code 4, 17, 32, 613, 80006 hoặc HTTP 429):
+  lùi lịch theo exponential backoff và tạm dừng cả Page đó
+- Lỗi tạm thời (5xx, mạng, is_transient): backoff rồi thử lại
+- Lỗi vĩnh viễn (token sai, user chặn Page...): đánh dấu failed, không thử lại
+
+Access token KHÔNG lưu trong outbox: lấy từ tenant (cache) lúc gửi, nên tin
+đang chờ retry sẽ dùng token mới nếu Page vừa cập nhật token.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from sqlalchemy import text
+
+from config import settings
+from database import SessionLocal, OutboundMessage
+from http_clients import http_pool
+from metrics import record_graph_api
+from services import TenantService, tenant_cache
+
+logger = logging.getLogger(__name__)
+
+# Facebook Send API
+FB_SEND_API_URL = "https://graph.facebook.com/v18.0/me/messages"
+
+# Mã lỗi rate limit của Graph API / Messenger Platform
+THROTTLE_ERROR_CODES = {4, 17, 32, 613, 80006}
+
+# Claim tối đa :limit tin đến hạn (hoặc đang gửi nhưng lease đã hết hạn)
+_CLAIM_SQL = text("""
+    UPDATE outbound_message
+    SET status = 'sending',
+        attempts = attempts + 1,
+        lease_expires_at = :lease_expires_at
+    WHERE id IN (
+        SELECT id FROM outbound_message
+        WHERE (status = 'pending' AND next_attempt_at <= :now)
+           OR (status = 'sending' AND lease_expires_at < :now)
+        ORDER BY id
+        LIMIT :limit
+    )
+    RETURNING id, page_id, recipient_id, payload, attempts
+""")
+
+
+class TokenBucket:
+    """
+    Token bucket cho 1 Page: `rate` tin/giây, cho phép dồn tối đa `burst` tin.
+    Chỉ dùng trên event loop của dispatcher nên không cần lock.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = max(rate, 0.001)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, max_wait: float) -> Tuple[bool, float]:
+        """
+        Giữ 1 token.
+
+        Returns:
+            (True, số giây phải chờ trước khi gửi) nếu giữ được trong max_wait,
+            (False, số giây đến khi Page gửi lại được) nếu phải chờ lâu hơn
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False, self.paused_until - now
+
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        if wait > max_wait:
+            return False, wait
+        # Cho tokens âm = đặt chỗ trước, người đến sau chờ lâu hơn
+        self.tokens -= 1
+        return True, wait
+
+    def pause(self, seconds: float):
+        """Graph API báo throttling -> tạm dừng cả Page"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+
+def classify_send_error(response: httpx.Response) -> Tuple[str, Optional[float], str]:
+    """
+    Phân loại response lỗi của Send API
+
+    Returns:
+        (kind, retry_after, error) với kind là "throttle" | "retry" | "fail"
+    """
+    try:
+        error = response.json().get("error") or {}
+    except Exception:
+        error = {}
+    code = error.get("code")
+    message = f"HTTP {response.status_code} code={code} {error.get('message') or response.text[:200]}"
+
+    retry_after = None
+    header = response.headers.get("Retry-After")
+    if header:
+        try:
+            retry_after = float(header)
+        except ValueError:
+            pass
+
+    if response.status_code == 429 or code in THROTTLE_ERROR_CODES:
+        return "throttle", retry_after, message
+    if response.status_code >= 500 or error.get("is_transient"):
+        return "retry", retry_after, message
+    return "fail", None, message
+
+
+class OutboxDispatcher:
+    """
+    Args:
+        concurrency: Số request Send API đang bay tối đa
+        page_rate: Số tin/giây cho mỗi Page
+        page_burst: Số tin dồn tối đa của 1 Page
+        max_attempts: Số lần gửi tối đa trước khi đánh dấu failed
+        backoff_base: Thời gian chờ (giây) cho lần retry đầu, nhân đôi mỗi lần
+        backoff_max: Thời gian chờ tối đa giữa 2 lần thử
+        poll_interval: Chu kỳ kiểm tra tin đến hạn khi không có tin mới
+        lease_seconds: Thời gian giữ tin đang gửi trước khi được claim lại
+        max_wait: Chờ token bucket tối đa (giây) trước khi lùi lịch tin
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 50,
+        page_rate: float = 20.0,
+        page_burst: int = 40,
+        max_attempts: int = 8,
+        backoff_base: float = 1.0,
+        backoff_max: float = 300.0,
+        poll_interval: float = 0.5,
+        lease_seconds: float = 60.0,
+        max_wait: float = 1.0,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.page_rate = page_rate
+        self.page_burst = page_burst
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_wait = max_wait
+
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+        # id của tin đang gửi, trả về pending khi drain không kịp
+        self._inflight: set = set()
+        self._stopping = False
+
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.sent = 0
+        self.retried = 0
+        self.throttled = 0
+        self.deferred = 0
+        self.failed = 0
+
+    # ========================================
+    # PRODUCER (gọi từ pipeline, thread nào cũng được)
+    # ========================================
+
+    def accepting(self) -> bool:
+        """Dispatcher đang chạy trong process này (script chạy ngoài FastAPI thì không)"""
+        return self._dispatcher is not None and not self._stopping
+
+    def enqueue(self, page_id: str, recipient_id: str, payload: dict) -> int:
+        """
+        Ghi 1 tin vào outbox và đánh thức dispatcher.
+
+        Returns:
+            ID của tin vừa tạo
+        """
+        now = time.time()
+        db = SessionLocal()
+        try:
+            message = OutboundMessage(
+                page_id=page_id,
+                recipient_id=recipient_id,
+                payload=json.dumps(payload, ensure_ascii=False),
+                status="pending",
+                attempts=0,
+                next_attempt_at=now,
+                created_at=now,
+            )
+            db.add(message)
+            db.commit()
+            message_id = message.id
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        with self._lock:
+            self.enqueued += 1
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return message_id
+
+    # ========================================
+    # DISPATCHER
+    # ========================================
+
+    def start(self):
+        """Khởi động dispatcher (gọi trong lifespan, từ bên trong event loop)"""
+        if self._dispatcher is not None:
+            return
+        self._stopping = False
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = self._loop.create_task(self._dispatch_loop())
+        logger.info(f"✅ [Outbox] Đã khởi động sender ({self.concurrency} request đồng thời, "
+                    f"{self.page_rate:g} tin/giây/Page)")
+
+    async def adrain(self, timeout: float = 10.0) -> bool:
+        """
+        Dừng claim tin mới, chờ các tin đang gửi xong.
+        Tin chưa gửi kịp được trả về pending cho lần khởi động sau.
+        """
+        logger.info(f"⏳ [Outbox] Đang drain (đợi tối đa {timeout}s)...")
+        self._stopping = True
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            if pending:
+                unsent = list(self._inflight)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                await asyncio.to_thread(self._release, unsent)
+                logger.warning(f"⚠️ [Outbox] {len(pending)} tin chưa gửi kịp, đã trả về outbox")
+                return False
+
+        logger.info(f"✅ [Outbox] Drain hoàn tất")
+        return True
+
+    async def _dispatch_loop(self):
+        while not self._stopping:
+            free = self.concurrency - len(self._tasks)
+            if free <= 0:
+                await asyncio.wait(set(self._tasks), return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            try:
+                rows = await asyncio.to_thread(self._claim, free)
+            except Exception as e:
+                logger.error(f"❌ [Outbox] Lỗi khi claim tin: {e}")
+                rows = []
+
+            if not rows:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for row in rows:
+                self._inflight.add(row["id"])
+                task = asyncio.create_task(self._send(row))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    def _bucket(self, page_id: str) -> TokenBucket:
+        bucket = self._buckets.get(page_id)
+        if bucket is None:
+            bucket = self._buckets[page_id] = TokenBucket(self.page_rate, self.page_burst)
+        return bucket
+
+    def try_reserve(self, page_id: str) -> bool:
+        """
+        Lấy 1 lượt gửi của Page nếu còn sẵn (không chờ), dùng cho tin best-effort
+        như sender_action. Phải gọi trên event loop của dispatcher.
+        """
+        granted, _ = self._bucket(page_id).reserve(0)
+        return granted
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** max(0, attempts - 1)))
+        # Jitter để các tin cùng bị throttle không dội lại cùng lúc
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _send(self, row: Dict[str, Any]):
+        page_id = row["page_id"]
+        try:
+            bucket = self._bucket(page_id)
+            granted, wait = bucket.reserve(self.max_wait)
+            if not granted:
+                # Page đang hết lượt: lùi lịch, không tính là 1 lần thử
+                with self._lock:
+                    self.deferred += 1
+                await asyncio.to_thread(self._reschedule, row, wait, None, False)
+                return
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            token = await page_access_token(page_id)
+            if not token:
+                await asyncio.to_thread(self._mark_failed, row, f"Không tìm thấy Access Token cho Page ID: {page_id}")
+                return
+
+            try:
+                response = await http_pool.apost(
+                    FB_SEND_API_URL,
+                    json=json.loads(row["payload"]),
+                    params={"access_token": token},
+                )
+            except httpx.HTTPError as e:
+                record_graph_api(page_id, "message", "error")
+                await asyncio.to_thread(self._retry, row, "retry", None, f"{type(e).__name__}: {e}")
+                return
+
+            record_graph_api(page_id, "message", response.status_code)
+            if response.is_success:
+                await asyncio.to_thread(self._delete, row["id"])
+                with self._lock:
+                    self.sent += 1
+                logger.info(f"✅ [Outbox] Đã gửi tin {row['id']} đến {row['recipient_id']}")
+                return
+
+            kind, retry_after, error = classify_send_error(response)
+            if kind == "fail":
+                await asyncio.to_thread(self._mark_failed, row, error)
+                return
+            if kind == "throttle":
+                bucket.pause(retry_after or self._backoff(row["attempts"]))
+            await asyncio.to_thread(self._retry, row, kind, retry_after, error)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ [Outbox] Lỗi không xác định khi gửi tin {row['id']}: {e}")
+            await asyncio.to_thread(self._retry, row, "retry", None, str(e))
+        finally:
+            self._inflight.discard(row["id"])
+
+    def _retry(self, row: Dict[str, Any], kind: str, retry_after: Optional[float], error: str):
+        if row["attempts"] >= self.max_attempts:
+            self._mark_failed(row, f"hết {self.max_attempts} lần thử: {error}")
+            return
+        delay = retry_after if retry_after is not None else self._backoff(row["attempts"])
+        with self._lock:
+            if kind == "throttle":
+                self.throttled += 1
+            else:
+                self.retried += 1
+        logger.warning(f"⚠️ [Outbox] Tin {row['id']} lỗi ({kind}, lần {row['attempts']}), thử lại sau {delay:.1f}s: {error}")
+        self._reschedule(row, delay, error, True)
+
+    # ========================================
+    # DB OPERATIONS
+    # ========================================
+
+    def _claim(self, limit: int) -> List[Dict[str, Any]]:
+        now = time.time()
+        db = SessionLocal()
+        try:
+            rows = db.execute(_CLAIM_SQL, {
+                "now": now,
+                "lease_expires_at": now + self.lease_seconds,
+                "limit": limit,
+            }).mappings().all()
+            db.commit()
+            # RETURNING không đảm bảo thứ tự -> gửi theo thứ tự enqueue
+            return sorted((dict(r) for r in rows), key=lambda r: r["id"])
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _execute(self, sql: str, params: Dict[str, Any]):
+        db = SessionLocal()
+        try:
+            db.execute(text(sql), params)
+            db.commit()
+        except Exception as e:
+            logger.error(f"❌ [Outbox] Không thể cập nhật outbox: {e}")
+            db.rollback()
+        finally:
+            db.close()
+
+    def _delete(self, message_id: int):
+        """Gửi xong -> xóa khỏi bảng để outbox luôn nhỏ"""
+        self._execute("DELETE FROM outbound_message WHERE id = :id", {"id": message_id})
+
+    def _reschedule(self, row: Dict[str, Any], delay: float, error: Optional[str], count_attempt: bool):
+        self._execute(
+            """
+            UPDATE outbound_message
+            SET status = 'pending', next_attempt_at = :next_attempt_at,
+                lease_expires_at = NULL,
+                attempts = CASE WHEN :count_attempt THEN attempts ELSE MAX(attempts - 1, 0) END,
+                last_error = COALESCE(:error, last_error)
+            WHERE id = :id
+            """,
+            {
+                "id": row["id"],
+                "next_attempt_at": time.time() + delay,
+                "count_attempt": count_attempt,
+                "error": error[:500] if error else None,
+            },
+        )
+
+    def _mark_failed(self, row: Dict[str, Any], error: str):
+        with self._lock:
+            self.failed += 1
+        logger.error(f"❌ [Outbox] Tin {row['id']} gửi thất bại vĩnh viễn: {error}")
+        self._execute(
+            """
+            UPDATE outbound_message
+            SET status = 'failed', last_error = :error, lease_expires_at = NULL
+            WHERE id = :id
+            """,
+            {"id": row["id"], "error": error[:500]},
+        )
+
+    def _release(self, ids: List[int]):
+        for message_id in ids:
+            self._execute(
+                """
+                UPDATE outbound_message
+                SET status = 'pending', attempts = MAX(attempts - 1, 0), lease_expires_at = NULL
+                WHERE id = :id AND status = 'sending'
+                """,
+                {"id": message_id},
+            )
+
+    def depth(self) -> Dict[str, int]:
+        """Số tin theo trạng thái (dùng cho /health)"""
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                text("SELECT status, COUNT(*) FROM outbound_message GROUP BY status")
+            ).fetchall()
+            counts = {"pending": 0, "sending": 0, "failed": 0}
+            counts.update({status: count for status, count in rows})
+            return counts
+        finally:
+            db.close()
+
+    def depth_by_page(self) -> Dict[Tuple[str, str], int]:
+        """Số tin theo (page_id, trạng thái), dùng cho /metrics"""
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                text("SELECT page_id, status, COUNT(*) FROM outbound_message GROUP BY page_id, status")
+            ).fetchall()
+            return {(page_id, status): count for page_id, status, count in rows}
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self.accepting(),
+                "in_flight": len(self._inflight),
+                "pages": len(self._buckets),
+                "enqueued": self.enqueued,
+                "sent": self.sent,
+                "retried": self.retried,
+                "throttled": self.throttled,
+                "deferred": self.deferred,
+                "failed": self.failed,
+            }
+
+
+async def page_access_token(page_id: str) -> Optional[str]:
+    """
+    Token của Page: lấy từ tenant_cache, hết hạn thì đọc lại DB trong thread.
+    Chỉ đọc: Page chưa có tenant -> None (việc tạo tenant mặc định là của node
+    load_tenant, tạo song song ở đây sẽ đụng UNIQUE constraint với pipeline).
+    """
+    cached, _, is_fresh = tenant_cache.get(page_id)
+    if cached is not None and is_fresh:
+        return cached.get("access_token")
+    tenant = await asyncio.to_thread(TenantService.get_tenant_by_page_id, page_id)
+    return (tenant or {}).get("access_token")
+
+
+# Dùng chung toàn process
+outbox = OutboxDispatcher(
+    concurrency=settings.outbox_concurrency,
+    page_rate=settings.outbox_page_rate,
+    page_burst=settings.outbox_page_burst,
+    max_attempts=settings.outbox_max_attempts,
+    backoff_base=settings.outbox_backoff_base,
+    backoff_max=settings.outbox_backoff_max,
+    poll_interval=settings.outbox_poll_interval,
+    lease_seconds=settings.outbox_lease_seconds,
+)
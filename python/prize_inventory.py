@@ -0,0 +1,186 @@
+"""
+File: prize_inventory.py
+Mục đích: Giới hạn số lượng giải theo kỳ (VD: "chỉ 50 Voucher 50k mỗi ngày")
+
+Cấu hình trong Tenant.config["prizes"], thêm 2 field tùy chọn cho từng giải:
+    {"name": "Voucher 50k", "rate": 0.1, "limit": 50, "period": "day"}
+    period: "day" | "week" | "month" | "total" (mặc định "day")
+Giải không có "limit" = không giới hạn (như trước).
+
+Số đã phát lưu ở bảng `prize_inventory` (page_id, prize_key, period_key).
+Giữ 1 suất = 1 câu UPSERT có điều kiện, chạy trong CÙNG transaction với việc
+giữ chỗ hóa đơn (InvoiceService.claim_and_draw):
+    INSERT ... ON CONFLICT DO UPDATE SET used = used + 1 WHERE used < cap RETURNING used
+Không có dòng trả về = giải đã hết -> quay lại trên các giải còn lại (rate
+chuẩn hóa lại). Giải đã hết được nhớ trong RAM theo kỳ để các lượt sau không
+phải thử lại DB.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import text
+
+from config import settings
+from database import SessionLocal
+from prize_sampler import AliasSampler
+
+logger = logging.getLogger(__name__)
+
+# Trả về khi mọi giải đều đã hết suất
+SOLD_OUT_PRIZE = {
+    "name": "Chúc may mắn lần sau",
+    "emoji": "🍀",
+    "instruction": "Quà của đợt này đã được phát hết, hẹn bạn lần sau nhé!",
+}
+
+_RESERVE_SQL = text("""
+    INSERT INTO prize_inventory (page_id, prize_key, period_key, used, updated_at)
+    VALUES (:page_id, :prize_key, :period_key, 1, :now)
+    ON CONFLICT (page_id, prize_key, period_key) DO UPDATE SET
+        used = used + 1,
+        updated_at = excluded.updated_at
+    WHERE prize_inventory.used < :cap
+    RETURNING used
+""")
+
+
+def prize_key(prize: dict) -> str:
+    return str(prize.get("id") or prize.get("name") or "")
+
+
+def prize_limit(prize: dict) -> Optional[int]:
+    """Số suất tối đa mỗi kỳ, None = không giới hạn"""
+    limit = prize.get("limit")
+    if limit is None or limit == "":
+        return None
+    try:
+        return max(0, int(limit))
+    except (TypeError, ValueError):
+        logger.warning(f"⚠️ [Prize Inventory] limit không hợp lệ cho giải '{prize.get('name')}' -> bỏ qua giới hạn")
+        return None
+
+
+def period_key(period: Optional[str], now: Optional[float] = None) -> str:
+    """Khóa kỳ theo giờ địa phương (PRIZE_PERIOD_UTC_OFFSET)"""
+    tz = timezone(timedelta(hours=settings.prize_period_utc_offset))
+    moment = datetime.fromtimestamp(time.time() if now is None else now, tz)
+    period = (period or "day").lower()
+    if period == "total":
+        return "all"
+    if period == "month":
+        return moment.strftime("%Y-%m")
+    if period == "week":
+        year, week, _ = moment.isocalendar()
+        return f"{year}-W{week:02d}"
+    return moment.strftime("%Y-%m-%d")
+
+
+class PrizeInventory:
+    def __init__(self, max_memo: int = 10000):
+        self._lock = threading.Lock()
+        # (page_id, prize_key, period_key, cap) đã hết suất
+        self._exhausted = set()
+        self.max_memo = max_memo
+        self.reserved = 0
+        self.sold_out = 0
+        self.resamples = 0
+
+    def _memo_key(self, page_id: str, prize: dict, cap: int, now: float):
+        return (page_id, prize_key(prize), period_key(prize.get("period"), now), cap)
+
+    def _mark_exhausted(self, key):
+        with self._lock:
+            if len(self._exhausted) >= self.max_memo:
+                self._exhausted.clear()
+            self._exhausted.add(key)
+
+    def reserve(self, db, page_id: str, prize: dict, cap: int, now: float) -> bool:
+        """Giữ 1 suất của giải (trong transaction của db). False nếu đã hết."""
+        if cap <= 0:
+            return False
+        row = db.execute(
+            _RESERVE_SQL,
+            {
+                "page_id": page_id,
+                "prize_key": prize_key(prize),
+                "period_key": period_key(prize.get("period"), now),
+                "cap": cap,
+                "now": now,
+            },
+        ).first()
+        return row is not None
+
+    def draw(self, sampler: AliasSampler, page_id: str, db=None) -> dict:
+        """
+        Quay 1 giải có xét giới hạn số lượng
+
+        Args:
+            sampler: Sampler của tenant (prize_samplers)
+            db: Session đang giữ transaction của hóa đơn. None -> tự mở
+                transaction riêng (chỉ khi có giải giới hạn)
+        """
+        limited = any(prize_limit(p) is not None for p in sampler.prizes)
+        if not limited:
+            return sampler.draw()
+
+        if db is None:
+            own_db = SessionLocal()
+            try:
+                prize = self.draw(sampler, page_id, own_db)
+                own_db.commit()
+                return prize
+            except Exception:
+                own_db.rollback()
+                raise
+            finally:
+                own_db.close()
+
+        now = time.time()
+        excluded = set()
+        with self._lock:
+            for index, prize in enumerate(sampler.prizes):
+                cap = prize_limit(prize)
+                if cap is not None and (cap <= 0 or self._memo_key(page_id, prize, cap, now) in self._exhausted):
+                    excluded.add(index)
+
+        while True:
+            current = sampler.excluding(frozenset(excluded))
+            if current is None:
+                with self._lock:
+                    self.sold_out += 1
+                logger.warning(f"⚠️ [Prize Inventory] Page {page_id}: mọi giải đã hết suất")
+                return SOLD_OUT_PRIZE
+
+            index = current.draw_index()
+            original_index = current.source_indices[index]
+            prize = current.prizes[index]
+            cap = prize_limit(prize)
+            if cap is None or self.reserve(db, page_id, prize, cap, now):
+                if cap is not None:
+                    with self._lock:
+                        self.reserved += 1
+                return prize
+
+            # Hết suất -> loại giải này và quay lại trên các giải còn lại
+            logger.warning(f"⚠️ [Prize Inventory] Giải '{prize.get('name')}' đã hết {cap} suất -> quay lại")
+            self._mark_exhausted(self._memo_key(page_id, prize, cap, now))
+            excluded.add(original_index)
+            with self._lock:
+                self.resamples += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "reserved": self.reserved,
+                "resamples": self.resamples,
+                "sold_out": self.sold_out,
+                "exhausted_known": len(self._exhausted),
+            }
+
+
+# Dùng chung toàn process
+prize_inventory = PrizeInventory()
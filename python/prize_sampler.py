@@ -0,0 +1,208 @@
+"""
+File: prize_sampler.py
+Mục đích: Quay thưởng O(1) bằng alias method (Vose), build sẵn theo từng tenant
+
+Thay cho vòng lặp cộng dồn rate trong _spin_lucky_wheel:
+- Cũ: O(n) mỗi lượt quay, và nếu tổng rate != 1 thì phần thiếu âm thầm rơi
+  vào giải cuối cùng
+- Mới: chuẩn hóa rate 1 lần khi load config (cảnh báo nếu tổng != 1 hoặc có
+  rate không hợp lệ), mỗi lượt quay chỉ cần 1 số ngẫu nhiên + 1 phép so sánh
+
+Sampler được cache theo (page_id, version config) nên tự build lại khi tenant
+đổi config. RNG seed được (PRIZE_RNG_SEED) để kiểm định phân phối bằng thống kê
+(xem benchmarks/bench_prize_sampler.py).
+"""
+
+import json
+import logging
+import math
+import random
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize_rates(prizes: List[dict], label: str = "") -> List[float]:
+    """Đọc rate của từng giải (chấp nhận số dạng chuỗi), rate lỗi/âm -> 0"""
+    rates = []
+    for prize in prizes:
+        try:
+            rate = float(prize.get("rate", 0))
+        except (TypeError, ValueError):
+            logger.warning(f"⚠️ [Prize Sampler] {label} rate không hợp lệ cho giải '{prize.get('name')}' -> 0")
+            rate = 0.0
+        if not math.isfinite(rate) or rate < 0:
+            logger.warning(f"⚠️ [Prize Sampler] {label} rate âm/không hợp lệ cho giải '{prize.get('name')}' -> 0")
+            rate = 0.0
+        rates.append(rate)
+
+    total = sum(rates)
+    if total > 0 and abs(total - 1.0) > 1e-6:
+        logger.warning(f"⚠️ [Prize Sampler] {label} tổng rate = {total:.4f} != 1 -> chuẩn hóa theo tỉ lệ")
+    return rates
+
+
+class AliasSampler:
+    """
+    Vose's alias method: build O(n), mỗi lần draw O(1)
+
+    Args:
+        prizes: List giải thưởng [{name, rate, emoji, instruction}]
+        rng: random.Random dùng để quay (mặc định: RNG dùng chung của module)
+        weights: Trọng số đã kiểm tra (dùng nội bộ bởi excluding()), None = đọc "rate"
+        source_indices: Vị trí của từng giải trong sampler gốc (dùng bởi excluding())
+    """
+
+    def __init__(
+        self,
+        prizes: List[dict],
+        rng: Optional[random.Random] = None,
+        label: str = "",
+        weights: Optional[List[float]] = None,
+        source_indices: Optional[List[int]] = None,
+    ):
+        if not prizes:
+            raise ValueError("Prize list is empty")
+
+        self.prizes = list(prizes)
+        self.rng = rng or _default_rng
+        self.source_indices = source_indices or list(range(len(self.prizes)))
+        self._excluding_cache = {}
+        n = len(self.prizes)
+
+        rates = list(weights) if weights is not None else _normalize_rates(self.prizes, label)
+        total = sum(rates)
+        if total <= 0:
+            # Giữ hành vi cũ: không giải nào có rate -> luôn ra giải cuối
+            logger.warning(f"⚠️ [Prize Sampler] {label} không có giải nào có rate > 0 -> luôn trả giải cuối")
+            rates = [0.0] * (n - 1) + [1.0]
+            total = 1.0
+
+        self.probabilities = [r / total for r in rates]
+
+        # Vose: chia các cột có xác suất (nhân n) < 1 và >= 1
+        scaled = [p * n for p in self.probabilities]
+        self._prob = [0.0] * n
+        self._alias = [0] * n
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+
+        # Phần dư do sai số float -> xác suất 1
+        for i in large + small:
+            self._prob[i] = 1.0
+            self._alias[i] = i
+
+        self._n = n
+        self._random = self.rng.random
+
+    def draw_index(self) -> int:
+        """1 số ngẫu nhiên: phần nguyên chọn cột, phần lẻ chọn cột đó hay alias"""
+        u = self._random() * self._n
+        i = int(u)
+        return i if (u - i) < self._prob[i] else self._alias[i]
+
+    def draw(self) -> dict:
+        u = self._random() * self._n
+        i = int(u)
+        return self.prizes[i if (u - i) < self._prob[i] else self._alias[i]]
+
+    def excluding(self, indices: frozenset) -> Optional["AliasSampler"]:
+        """
+        Sampler trên các giải còn lại (bỏ các vị trí trong indices), xác suất
+        chuẩn hóa lại. None nếu không còn giải nào có xác suất > 0.
+        Kết quả được cache theo tập indices.
+        """
+        if not indices:
+            return self
+        if indices in self._excluding_cache:
+            return self._excluding_cache[indices]
+
+        remaining = [
+            i for i, p in enumerate(self.probabilities)
+            if i not in indices and p > 0
+        ]
+        sampler = None
+        if remaining:
+            sampler = AliasSampler(
+                [self.prizes[i] for i in remaining],
+                rng=self.rng,
+                weights=[self.probabilities[i] for i in remaining],
+                source_indices=[self.source_indices[i] for i in remaining],
+            )
+        self._excluding_cache[indices] = sampler
+        return sampler
+
+
+def _new_rng() -> random.Random:
+    seed = settings.prize_rng_seed
+    return random.Random(int(seed)) if seed else random.Random()
+
+
+# RNG dùng chung (random.Random.random thread-safe trong CPython)
+_default_rng = _new_rng()
+
+
+class PrizeSamplerCache:
+    """
+    Cache AliasSampler theo page_id, build lại khi version config của tenant đổi
+    (hoặc khi danh sách giải đổi, với tenant không có version)
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._samplers: "OrderedDict[str, tuple]" = OrderedDict()
+        self.builds = 0
+
+    @staticmethod
+    def _version_key(version: Any, prizes: List[dict]) -> str:
+        if version is not None:
+            return str(version)
+        return json.dumps(prizes, sort_keys=True, ensure_ascii=False, default=str)
+
+    def get(self, page_id: str, version: Any, prizes: List[dict]) -> AliasSampler:
+        key = self._version_key(version, prizes)
+        with self._lock:
+            entry = self._samplers.get(page_id)
+            if entry is not None and entry[0] == key:
+                self._samplers.move_to_end(page_id)
+                return entry[1]
+
+        sampler = AliasSampler(prizes, label=f"[{page_id}]")
+        with self._lock:
+            self._samplers[page_id] = (key, sampler)
+            self._samplers.move_to_end(page_id)
+            while len(self._samplers) > self.max_size:
+                self._samplers.popitem(last=False)
+            self.builds += 1
+        return sampler
+
+    def for_tenant(self, tenant: dict, prizes: List[dict]) -> AliasSampler:
+        return self.get(tenant.get("id") or "", tenant.get("version"), prizes)
+
+    def invalidate(self, page_id: Optional[str] = None):
+        with self._lock:
+            if page_id is None:
+                self._samplers.clear()
+            else:
+                self._samplers.pop(page_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._samplers), "builds": self.builds}
+
+
+# Cache dùng chung toàn process
+prize_samplers = PrizeSamplerCache(max_size=settings.tenant_cache_max_size)
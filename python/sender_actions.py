@@ -0,0 +1,246 @@
+"""
+File: sender_actions.py
+Mục đích: Báo cho user biết ảnh đã được nhận ngay từ webhook (mark_seen + typing_on)
+
+OCR + validate mất 10-30s, trong lúc đó user không thấy phản hồi gì nên nhiều
+người gửi lại ảnh -> nhân đôi tải. Webhook giờ gọi acknowledge() ngay sau khi
+ghi job vào hàng đợi:
+- Gửi sender_action `mark_seen` rồi `typing_on` bằng 1 asyncio task riêng,
+  không chặn response 200 cho Facebook
+- Token lấy từ tenant_cache (như outbox), gửi qua httpx.AsyncClient dùng chung.
+  Chỉ đọc tenant: Page chưa có tenant/token thì bỏ qua mark_seen/typing_on
+- Best-effort: không retry, không lưu DB. Page đang hết lượt gửi (token bucket
+  của outbox) hoặc bị throttle thì bỏ qua, để dành quota cho tin trả lời thật
+- Messenger tự tắt typing sau ~20s: vòng refresh gửi lại typing_on mỗi
+  TYPING_REFRESH_SECONDS cho các job vẫn còn pending/running trong invoice_job
+  (đọc DB nên đúng cả khi job chạy ở worker process khác), tối đa TYPING_MAX_SECONDS
+
+Đo hiệu quả: mọi ảnh nhận được đều được đếm, ảnh đến trong RESEND_WINDOW_SECONDS
+sau ảnh trước của cùng user tính là "gửi lại" (đếm cả khi SENDER_ACTIONS_ENABLED=false).
+So sánh resend_rate ở /health giữa 2 chế độ để thấy mức giảm.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+
+from config import settings
+from database import SessionLocal
+from http_clients import http_pool
+from metrics import record_graph_api
+from outbox import outbox, page_access_token, FB_SEND_API_URL
+
+logger = logging.getLogger(__name__)
+
+# Các job trong danh sách vẫn chưa xong
+_ACTIVE_JOBS_SQL = text("""
+    SELECT id FROM invoice_job
+    WHERE id IN :ids AND status IN ('pending', 'running')
+""").bindparams(bindparam("ids", expanding=True))
+
+
+class SenderActions:
+    """
+    Args:
+        refresh_seconds: Chu kỳ gửi lại typing_on
+        max_seconds: Ngừng refresh typing sau khoảng này kể từ lúc nhận ảnh
+        resend_window: Ảnh mới của cùng user trong khoảng này tính là gửi lại
+        max_inflight: Số task gửi sender_action đồng thời tối đa (quá thì bỏ qua)
+        max_tracked: Số user tối đa được nhớ để đếm gửi lại
+    """
+
+    def __init__(
+        self,
+        refresh_seconds: float = 15,
+        max_seconds: float = 120,
+        resend_window: float = 120,
+        max_inflight: int = 200,
+        max_tracked: int = 10000,
+    ):
+        self.refresh_seconds = refresh_seconds
+        self.max_seconds = max_seconds
+        self.resend_window = resend_window
+        self.max_inflight = max_inflight
+        self.max_tracked = max_tracked
+
+        self._lock = threading.Lock()
+        self._tasks: set = set()
+        # job_id -> (page_id, sender_id, thời điểm nhận ảnh)
+        self._typing: Dict[int, Tuple[str, str, float]] = {}
+        # (page_id, sender_id) -> thời điểm nhận ảnh gần nhất
+        self._last_image: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+
+        self.images = 0
+        self.resends = 0
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+        self.refreshes = 0
+
+    # ========================================
+    # WEBHOOK
+    # ========================================
+
+    def acknowledge(self, page_id: str, sender_id: str, job_ids: List[int], now: Optional[float] = None):
+        """
+        Gọi từ webhook (trên event loop) sau khi đã enqueue các job của 1 tin nhắn.
+        Không chờ gửi xong.
+        """
+        now = time.time() if now is None else now
+        self._count_image(page_id, sender_id, now)
+
+        if not settings.sender_actions_enabled:
+            return
+        for job_id in job_ids:
+            self._typing[job_id] = (page_id, sender_id, now)
+        self._spawn(page_id, sender_id, ("mark_seen", "typing_on"))
+
+    def _count_image(self, page_id: str, sender_id: str, now: float):
+        key = (page_id, sender_id)
+        with self._lock:
+            self.images += 1
+            last = self._last_image.pop(key, None)
+            if last is not None and now - last <= self.resend_window:
+                self.resends += 1
+            self._last_image[key] = now
+            while len(self._last_image) > self.max_tracked:
+                self._last_image.popitem(last=False)
+
+    def _spawn(self, page_id: str, sender_id: str, actions: Tuple[str, ...]):
+        if len(self._tasks) >= self.max_inflight:
+            with self._lock:
+                self.skipped += len(actions)
+            return
+        task = asyncio.create_task(self._send_actions(page_id, sender_id, actions))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # ========================================
+    # GỬI
+    # ========================================
+
+    async def _send_actions(self, page_id: str, sender_id: str, actions: Tuple[str, ...]):
+        for action in actions:
+            if not await self._send(page_id, sender_id, action):
+                # mark_seen lỗi thì typing_on cũng sẽ lỗi, bỏ luôn
+                return
+
+    async def _send(self, page_id: str, sender_id: str, action: str) -> bool:
+        try:
+            # Chỉ đọc tenant: Page mới chưa có tenant thì bỏ qua, để node
+            # load_tenant của pipeline tự tạo (không tạo song song ở đây)
+            token = await page_access_token(page_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ [Sender Action] Lỗi đọc token Page {page_id}: {e}")
+            token = None
+        if not token or not outbox.try_reserve(page_id):
+            with self._lock:
+                self.skipped += 1
+            return False
+
+        try:
+            response = await http_pool.apost(
+                FB_SEND_API_URL,
+                json={"recipient": {"id": sender_id}, "sender_action": action},
+                params={"access_token": token},
+                timeout=settings.sender_action_timeout,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            record_graph_api(page_id, "sender_action", "error")
+            logger.warning(f"⚠️ [Sender Action] {action} -> {sender_id} lỗi: {type(e).__name__}: {e}")
+            with self._lock:
+                self.failed += 1
+            return False
+
+        record_graph_api(page_id, "sender_action", response.status_code)
+        if not response.is_success:
+            logger.warning(f"⚠️ [Sender Action] {action} -> {sender_id} lỗi: {response.status_code} {response.text[:200]}")
+            with self._lock:
+                self.failed += 1
+            return False
+
+        with self._lock:
+            self.sent += 1
+        return True
+
+    # ========================================
+    # REFRESH TYPING
+    # ========================================
+
+    def _active_jobs(self, job_ids: List[int]) -> set:
+        db = SessionLocal()
+        try:
+            rows = db.execute(_ACTIVE_JOBS_SQL, {"ids": job_ids}).fetchall()
+            return {row[0] for row in rows}
+        finally:
+            db.close()
+
+    async def refresh_once(self, now: Optional[float] = None) -> int:
+        """Gửi lại typing_on cho các job chưa xong, bỏ theo dõi job đã xong/quá lâu"""
+        now = time.time() if now is None else now
+        for job_id, (_, _, started) in list(self._typing.items()):
+            if now - started > self.max_seconds:
+                self._typing.pop(job_id, None)
+        if not self._typing:
+            return 0
+
+        checked = list(self._typing)
+        active = await asyncio.to_thread(self._active_jobs, checked)
+        recipients = set()
+        # Chỉ xét các job vừa kiểm tra (job mới thêm trong lúc chờ DB để lượt sau)
+        for job_id in checked:
+            entry = self._typing.get(job_id)
+            if entry is None:
+                continue
+            if job_id in active:
+                recipients.add(entry[:2])
+            else:
+                self._typing.pop(job_id, None)
+
+        for page_id, sender_id in recipients:
+            self._spawn(page_id, sender_id, ("typing_on",))
+        with self._lock:
+            self.refreshes += len(recipients)
+        return len(recipients)
+
+    async def run_refresh_loop(self):
+        """Vòng refresh typing chạy nền trên event loop của server"""
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh_once()
+            except Exception as e:
+                logger.warning(f"⚠️ [Sender Action] Lỗi refresh typing: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": settings.sender_actions_enabled,
+                "images": self.images,
+                "resends": self.resends,
+                "resend_rate": round(self.resends / self.images, 4) if self.images else 0.0,
+                "typing_jobs": len(self._typing),
+                "in_flight": len(self._tasks),
+                "sent": self.sent,
+                "refreshes": self.refreshes,
+                "skipped": self.skipped,
+                "failed": self.failed,
+            }
+
+
+# Dùng chung toàn process
+sender_actions = SenderActions(
+    refresh_seconds=settings.typing_refresh_seconds,
+    max_seconds=settings.typing_max_seconds,
+    resend_window=settings.resend_window_seconds,
+    max_inflight=settings.sender_actions_max_inflight,
+)
@@ -1,6 +1,153 @@
+import hashlib
 import json
+import logging
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
+from typing import Any, Callable, Optional, Tuple
+
+from sqlalchemy import text
+
+from config import settings
 from database import SessionLocal, Tenant, Invoice
+from stats_aggregator import tenant_stats
+
+logger = logging.getLogger(__name__)
+
+
+class TenantCache:
+    """
+    Cache LRU + TTL cho tenant dict, key = page_id.
+
+    - Entry hết hạn hẳn sau `ttl` giây.
+    - Sau `revalidate_interval` giây, entry được kiểm tra lại bằng 1 truy vấn
+      nhẹ theo khóa chính, so sánh hash các cột config/token (version). Dashboard
+      NestJS và các worker khác ghi vào cùng file SQLite nên mọi process đều
+      thấy thay đổi trong vòng vài giây, kể cả 2 lần lưu trong cùng 1 giây.
+    - invalidate() xóa ngay entry (dùng khi update token trong process này).
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300, revalidate_interval: float = 2):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.revalidate_interval = revalidate_interval
+        self._lock = threading.Lock()
+        # page_id -> (tenant_dict, version, loaded_at, checked_at)
+        self._entries: "OrderedDict[str, Tuple[dict, Any, float, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def get(self, page_id: str) -> Tuple[Optional[dict], Any, bool]:
+        """
+        Returns:
+            (tenant_dict, version, is_fresh) - is_fresh=False nghĩa là cần kiểm tra version
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(page_id)
+            if entry is None:
+                self.misses += 1
+                return None, None, False
+
+            tenant, version, loaded_at, checked_at = entry
+            if now - loaded_at > self.ttl:
+                del self._entries[page_id]
+                self.misses += 1
+                return None, None, False
+
+            self._entries.move_to_end(page_id)
+            if now - checked_at <= self.revalidate_interval:
+                self.hits += 1
+                return tenant, version, True
+            return tenant, version, False
+
+    def peek(self, page_id: str) -> Optional[dict]:
+        """Tenant đang cache (có thể đã cũ), không tính hit/miss, không đọc DB"""
+        with self._lock:
+            entry = self._entries.get(page_id)
+            return entry[0] if entry is not None else None
+
+    def mark_checked(self, page_id: str):
+        """Version không đổi -> gia hạn thời điểm kiểm tra"""
+        with self._lock:
+            entry = self._entries.get(page_id)
+            if entry is not None:
+                self._entries[page_id] = (entry[0], entry[1], entry[2], time.time())
+                self.hits += 1
+                self.revalidations += 1
+
+    def put(self, page_id: str, tenant: dict, version: Any):
+        now = time.time()
+        with self._lock:
+            self._entries[page_id] = (tenant, version, now, now)
+            self._entries.move_to_end(page_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, page_id: Optional[str] = None):
+        """Xóa 1 page (hoặc toàn bộ cache nếu page_id=None)"""
+        with self._lock:
+            if page_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(page_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+            }
+
+
+tenant_cache = TenantCache(
+    max_size=settings.tenant_cache_max_size,
+    ttl=settings.tenant_cache_ttl,
+    revalidate_interval=settings.tenant_cache_revalidate,
+)
+
+
+def _read_tenant_version(db, page_id: str) -> Optional[str]:
+    """
+    Version của tenant = hash các cột thô mà _tenant_to_dict dùng (do Python hoặc NestJS ghi)
+
+    Không dùng riêng updated_at: NestJS/TypeORM ghi updated_at theo giây nên 2 lần
+    lưu trên dashboard trong cùng 1 giây có cùng updated_at, lần thứ 2 bị bỏ lỡ
+    tới khi hết TTL. Hash nội dung thì đổi ngay khi config/token đổi.
+    """
+    row = db.execute(
+        text("SELECT shop_name, access_token, is_active, config FROM tenant WHERE id = :id"),
+        {"id": page_id},
+    ).first()
+    if row is None:
+        return None
+    raw = json.dumps(list(row), ensure_ascii=False, default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _tenant_to_dict(tenant: Tenant, version: Any = None) -> dict:
+    # Convert SQLAlchemy object to dict
+    return {
+        "id": tenant.id,
+        "shop_name": tenant.shop_name,
+        "access_token": tenant.access_token,
+        "is_active": tenant.is_active,
+        # JSON config fields
+        "prizes": tenant.config.get("prizes", []) if tenant.config else [],
+        "messages": tenant.config.get("messages", {}) if tenant.config else {},
+        "shop_patterns": tenant.config.get("shop_patterns", []) if tenant.config else [],
+        "pipeline_mode": (tenant.config or {}).get("pipeline_mode") or settings.pipeline_mode,
+        # Lập lịch công bằng giữa các Page (xem job_queue.FairScheduler)
+        "job_weight": (tenant.config or {}).get("job_weight"),
+        "job_max_concurrency": (tenant.config or {}).get("job_max_concurrency"),
+        "version": version,
+    }
+
 
 class TenantService:
     @staticmethod
@@ -11,32 +158,43 @@ class TenantService:
             if not tenant:
                 return None
             
-            # Convert SQLAlchemy object to dict
-            tenant_dict = {
-                "id": tenant.id,
-                "shop_name": tenant.shop_name,
-                "access_token": tenant.access_token,
-                "is_active": tenant.is_active,
-                # JSON config fields
-                "prizes": tenant.config.get("prizes", []) if tenant.config else [],
-                "messages": tenant.config.get("messages", {}) if tenant.config else {},
-                "shop_patterns": tenant.config.get("shop_patterns", []) if tenant.config else [],
-            }
-            return tenant_dict
-            print(f"Error getting tenant: {e}")
+            return _tenant_to_dict(tenant)
+            logger.error(f"Error getting tenant: {e}")
             return None
         finally:
             db.close()
 
+    @staticmethod
+    def job_limits(page_id: str) -> Tuple[Optional[int], Optional[int]]:
+        """
+        (job_weight, job_max_concurrency) của Page cho JobQueue.
+        Chỉ đọc tenant_cache (mỗi lần claim job đều gọi), None = dùng mặc định.
+        """
+        tenant = tenant_cache.peek(page_id) or {}
+        return tenant.get("job_weight"), tenant.get("job_max_concurrency")
+
     @staticmethod
     def get_or_create_tenant(page_id: str):
-        """Tự động tạo tenant mặc định nếu chưa có (cho mục đích test)"""
+        """
+        Tự động tạo tenant mặc định nếu chưa có (cho mục đích test).
+        Kết quả được cache theo page_id (xem TenantCache).
+        """
+        cached, cached_version, is_fresh = tenant_cache.get(page_id)
+        if cached is not None and is_fresh:
+            return dict(cached)
+
         db = SessionLocal()
         try:
+            # Đọc version TRƯỚC khi đọc row: nếu có ghi xen giữa, lần sau sẽ reload
+            version = _read_tenant_version(db, page_id)
+            if cached is not None and version is not None and version == cached_version:
+                tenant_cache.mark_checked(page_id)
+                return dict(cached)
+
             tenant = db.query(Tenant).filter(Tenant.id == page_id).first()
             if not tenant:
                 # Create Default Tenant
-                print(f"⚠️ [TenantService] Page {page_id} chưa có config. Đang tạo Default...")
+                logger.warning(f"⚠️ [TenantService] Page {page_id} chưa có config. Đang tạo Default...")
                 default_config = {
                     "prizes": [
                         {"name": "Voucher 10k", "rate": 0.5},
@@ -62,21 +220,15 @@ class TenantService:
                 db.add(tenant)
                 db.commit()
                 db.refresh(tenant)
-                print(f"✅ [TenantService] Đã tạo Default Tenant cho Page {page_id}")
+                version = _read_tenant_version(db, page_id)
+                logger.info(f"✅ [TenantService] Đã tạo Default Tenant cho Page {page_id}")
 
             # Return as dict
-            tenant_dict = {
-                "id": tenant.id,
-                "shop_name": tenant.shop_name,
-                "access_token": tenant.access_token,
-                "is_active": tenant.is_active,
-                "prizes": tenant.config.get("prizes", []) if tenant.config else [],
-                "messages": tenant.config.get("messages", {}) if tenant.config else {},
-                "shop_patterns": tenant.config.get("shop_patterns", []) if tenant.config else [],
-            }
-            return tenant_dict
+            tenant_dict = _tenant_to_dict(tenant, version)
+            tenant_cache.put(page_id, tenant_dict, version)
+            return dict(tenant_dict)
         except Exception as e:
-            print(f"Error creating tenant: {e}")
+            logger.error(f"Error creating tenant: {e}")
             db.rollback()
             return None
         finally:
@@ -92,9 +244,11 @@ class TenantService:
             
             tenant.access_token = new_token
             db.commit()
+            # Xóa cache ngay để invoice tiếp theo dùng token mới
+            tenant_cache.invalidate(page_id)
             return True
         except Exception as e:
-            print(f"Error updating token: {e}")
+            logger.error(f"Error updating token: {e}")
             db.rollback()
             return False
         finally:
@@ -112,36 +266,68 @@ class InvoiceService:
             ).first()
             return exists is not None
         except Exception as e:
-            print(f"Error checking invoice: {e}")
+            logger.error(f"Error checking invoice: {e}")
             return False
         finally:
             db.close()
 
     @staticmethod
-    def mark_invoice_used(invoice_id: str, page_id: str, sender_id: str, prize_won: str):
+    def claim_and_draw(
+        invoice_id: str, page_id: str, sender_id: str, draw: Callable[[Any], dict]
+    ) -> Optional[dict]:
+        """
+        Giữ chỗ hóa đơn và quay thưởng trong CÙNG 1 transaction.
+
+        INSERT ... ON CONFLICT DO NOTHING RETURNING quyết định "mới" hay "trùng"
+        trong 1 câu lệnh (khóa (page_id, id)), nên 2 bản gửi đồng thời của cùng
+        1 hóa đơn chỉ có 1 bản được quay. draw(db) chỉ chạy khi giữ chỗ thành công
+        và nhận session đang mở để trừ suất giải (prize_inventory) trong cùng
+        transaction; nếu draw() lỗi thì rollback, hóa đơn chưa bị tính là đã dùng.
+        Thống kê tenant được cộng qua tenant_stats sau khi commit.
+
+        Args:
+            draw: Hàm quay thưởng draw(db), trả về dict giải thưởng (có key "name")
+
+        Returns:
+            Giải thưởng nếu hóa đơn mới, None nếu hóa đơn đã được dùng
+
+        Raises:
+            Exception của DB để JobQueue thử lại job
+        """
         db = SessionLocal()
         try:
-            new_invoice = Invoice(
-                id=invoice_id,
-                page_id=page_id,
-                sender_id=sender_id,
-                prize_won=prize_won,
-                created_at=datetime.utcnow()
+            claimed = db.execute(
+                text("""
+                    INSERT INTO invoice (id, page_id, sender_id, prize_won, created_at)
+                    VALUES (:id, :page_id, :sender_id, NULL, :created_at)
+                    ON CONFLICT (page_id, id) DO NOTHING
+                    RETURNING id
+                """),
+                {
+                    "id": invoice_id,
+                    "page_id": page_id,
+                    "sender_id": sender_id,
+                    "created_at": datetime.utcnow(),
+                },
+            ).first()
+            if claimed is None:
+                db.rollback()
+                return None
+
+            prize = draw(db)
+
+            db.execute(
+                text("UPDATE invoice SET prize_won = :prize WHERE page_id = :page_id AND id = :id"),
+                {"prize": prize.get("name"), "page_id": page_id, "id": invoice_id},
             )
-            db.add(new_invoice)
-            
-            # Update stats
-            tenant = db.query(Tenant).filter(Tenant.id == page_id).first()
-            if tenant:
-                tenant.totalSpins = (tenant.totalSpins or 0) + 1
-                tenant.totalPrizes = (tenant.totalPrizes or 0) + 1
-                tenant.totalUsers = (tenant.totalUsers or 0) + 1 # Simplified logic
-            
             db.commit()
-            return True
         except Exception as e:
-            print(f"Error saving invoice: {e}")
+            logger.error(f"Error claiming invoice: {e}")
             db.rollback()
-            return False
+            raise
         finally:
             db.close()
+
+        # Update stats: gom trong RAM, ghi theo lô (không khóa dòng tenant ở đây)
+        tenant_stats.record(page_id)
+        return prize
@@ -0,0 +1,191 @@
+"""
+File: shop_matcher.py
+Mục đích: So khớp tên quán trên hóa đơn với shop_patterns của tenant (chạy local)
+
+Cài đặt đúng các quy tắc đang mô tả trong prompt của validate_invoice_node:
+1. Chuyển về lowercase, bỏ dấu tiếng Việt (OCR hay sai dấu: "tĩnh" ~ "tinh")
+2. Bỏ tiền tố ("nhà hàng", "quán", "cửa hàng", "tiệm", "shop", "restaurant",
+   "cafe", "coffee") và hậu tố ("store", "house", "kitchen", "bistro")
+3. Bỏ ký tự đặc biệt, khoảng trắng thừa
+4. Tính độ tương đồng (0..1) giữa tên trên hóa đơn và pattern
+
+Kết quả chia 3 nhóm:
+- accept: chắc chắn khớp (score >= SHOP_MATCH_ACCEPT) -> không cần hỏi LLM về tên quán
+- reject: chắc chắn không khớp (score < SHOP_MATCH_REJECT trên toàn bộ hóa đơn)
+  -> từ chối luôn, không gọi LLM
+- uncertain: vùng giữa -> chuyển cho LLM quyết định như cũ
+"""
+
+import json
+import logging
+import re
+import threading
+import unicodedata
+from difflib import SequenceMatcher
+from typing import Iterable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Tiền tố/hậu tố cần bỏ (đã bỏ dấu). Tiền tố dài đặt trước để khớp trước.
+SHOP_PREFIXES = (
+    "nha hang", "cua hang", "restaurant", "coffee", "quan", "tiem", "shop", "cafe",
+)
+SHOP_SUFFIXES = ("kitchen", "bistro", "store", "house")
+
+# Số dòng đầu hóa đơn được xem là vị trí của tên quán
+HEADER_LINES = 3
+
+_NON_WORD = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACES = re.compile(r"\s+")
+
+
+class ShopMatch(NamedTuple):
+    decision: str             # "accept" | "reject" | "uncertain"
+    score: float              # Độ tương đồng cao nhất (0..1)
+    matched_line: Optional[str]
+    pattern: Optional[str]
+
+
+def fold(text: str) -> str:
+    """
+    Lowercase + bỏ dấu tiếng Việt + bỏ ký tự đặc biệt + gộp khoảng trắng
+    VD: "NHÀ HÀNG Em-An Tĩnh Nghịch." -> "nha hang em an tinh nghich"
+    """
+    text = text.lower().replace("đ", "d")
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    text = _NON_WORD.sub(" ", text).replace("_", " ")
+    return _SPACES.sub(" ", text).strip()
+
+
+def normalize_shop_name(name: str) -> str:
+    """fold() rồi bỏ tiền tố/hậu tố loại hình cửa hàng"""
+    name = fold(name)
+    changed = True
+    while changed and name:
+        changed = False
+        for prefix in SHOP_PREFIXES:
+            if name.startswith(prefix + " "):
+                name = name[len(prefix) + 1:]
+                changed = True
+                break
+        for suffix in SHOP_SUFFIXES:
+            if name.endswith(" " + suffix):
+                name = name[: -len(suffix) - 1]
+                changed = True
+                break
+    return name.strip()
+
+
+def similarity(line: str, pattern: str) -> float:
+    """
+    Độ tương đồng giữa 1 dòng hóa đơn và 1 pattern (cả 2 đã normalize).
+    Dòng hóa đơn hay có thêm chữ (địa chỉ, chi nhánh...), nên ngoài so sánh
+    cả dòng còn so với các cửa sổ từ có độ dài gần bằng pattern.
+    """
+    if not line or not pattern:
+        return 0.0
+    if line == pattern:
+        return 1.0
+    if f" {pattern} " in f" {line} ":
+        return 1.0
+
+    best = SequenceMatcher(None, line, pattern).ratio()
+    words = line.split()
+    size = len(pattern.split())
+    for width in (size - 1, size, size + 1):
+        if width <= 0 or width >= len(words):
+            continue
+        for i in range(len(words) - width + 1):
+            window = " ".join(words[i:i + width])
+            score = SequenceMatcher(None, window, pattern).ratio()
+            if score > best:
+                best = score
+    return best
+
+
+def _best_score(lines: Iterable[str], patterns: List[str]):
+    best = (0.0, None, None)
+    for raw_line in lines:
+        line = normalize_shop_name(raw_line)
+        for raw_pattern, pattern in patterns:
+            score = similarity(line, pattern)
+            if score > best[0]:
+                best = (score, raw_line.strip(), raw_pattern)
+    return best
+
+
+def match_shop(
+    ocr_text: str,
+    shop_patterns: List[str],
+    accept_threshold: float = 0.9,
+    reject_threshold: float = 0.5,
+) -> ShopMatch:
+    """
+    So khớp tên quán trong OCR text với các pattern của tenant
+
+    Args:
+        ocr_text: Text thô từ OCR
+        shop_patterns: Các tên cần tìm (thường lấy từ tenant["shop_patterns"])
+        accept_threshold: score tối thiểu ở các dòng đầu để chấp nhận luôn
+        reject_threshold: score tối đa trên toàn hóa đơn để từ chối luôn
+
+    Returns:
+        ShopMatch với decision accept / reject / uncertain
+    """
+    patterns = [(p, normalize_shop_name(p)) for p in shop_patterns if p and p.strip()]
+    lines = [l for l in (ocr_text or "").splitlines() if l.strip()]
+    if not patterns or not lines:
+        return ShopMatch("uncertain", 0.0, None, None)
+
+    # Tên quán theo quy tắc nằm ở các dòng đầu
+    header_score, header_line, header_pattern = _best_score(lines[:HEADER_LINES], patterns)
+    if header_score >= accept_threshold:
+        return ShopMatch("accept", header_score, header_line, header_pattern)
+
+    # Chỉ từ chối khi KHÔNG dòng nào của hóa đơn gần giống pattern
+    score, line, pattern = _best_score(lines[HEADER_LINES:], patterns)
+    if header_score >= score:
+        score, line, pattern = header_score, header_line, header_pattern
+    if score < reject_threshold:
+        return ShopMatch("reject", score, lines[0].strip(), pattern)
+
+    return ShopMatch("uncertain", score, line, pattern)
+
+
+# ============================================================================
+# GHI CORPUS (để đo tỉ lệ đồng thuận giữa matcher và LLM)
+# ============================================================================
+
+_corpus_lock = threading.Lock()
+
+
+def record_validation_sample(
+    path: str,
+    ocr_text: str,
+    tenant: dict,
+    match: ShopMatch,
+    llm_result: dict,
+    local_invoice_id: Optional[str] = None,
+):
+    """
+    Ghi 1 mẫu (OCR text, patterns, kết quả matcher/extractor, kết quả LLM) vào file JSONL.
+    Dùng bởi benchmarks/bench_shop_matcher.py.
+    """
+    sample = {
+        "ocr_text": ocr_text,
+        "shop_name": tenant.get("shop_name"),
+        "shop_patterns": tenant.get("shop_patterns") or [],
+        "matcher_decision": match.decision,
+        "matcher_score": round(match.score, 4),
+        "llm_valid": bool(llm_result.get("valid")),
+        "llm_shop_name": (llm_result.get("data") or {}).get("shop_name"),
+        "llm_invoice_id": (llm_result.get("data") or {}).get("invoice_id"),
+        "local_invoice_id": local_invoice_id,
+    }
+    try:
+        with _corpus_lock:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(sample, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logger.warning(f"⚠️ [Shop Matcher] Không ghi được corpus: {e}")
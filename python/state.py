@@ -28,6 +28,13 @@ class TenantConfig(TypedDict):
     
     # Tin nhắn tùy chỉnh (optional)
     messages: Optional[dict]  # {invalid, duplicate, thank_you}
+    
+    # "two_step" (OCR -> Validate) hoặc "single_call" (OCR + Validate trong 1 request)
+    pipeline_mode: Optional[str]
+
+    # Lập lịch job giữa các Page: trọng số DRR và số invoice chạy đồng thời tối đa
+    job_weight: Optional[int]
+    job_max_concurrency: Optional[int]
 
 
 class InvoiceState(TypedDict):
@@ -39,6 +46,10 @@ class InvoiceState(TypedDict):
         sender_id: Facebook User ID của người gửi
         page_id: Facebook Page ID (để xác định tenant)
         image_url: URL của ảnh hóa đơn cần xử lý
+        deadline: Hạn chót xử lý invoice (epoch seconds), các node tính timeout
+            còn lại từ đây (xem deadline.py). None = không giới hạn
+        trace_id: Trace ID của invoice (suy ra từ message mid), các node ghi
+            span dưới trace này (xem tracing.py)
         
         # Tenant config (load từ Firebase)
         tenant_config: Config của cửa hàng tương ứng với page_id
@@ -57,6 +68,8 @@ class InvoiceState(TypedDict):
     sender_id: str
     page_id: str
     image_url: str
+    deadline: Optional[float]
+    trace_id: Optional[str]
     
     # Tenant config
     tenant_config: Optional[TenantConfig]
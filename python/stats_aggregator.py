@@ -0,0 +1,123 @@
+"""
+File: stats_aggregator.py
+Mục đích: Gom thống kê tenant (totalSpins, totalPrizes, totalUsers) trong RAM
+và ghi xuống DB theo lô
+
+Trước đây mỗi lượt quay cập nhật thẳng dòng `tenant` trong transaction của
+hóa đơn -> mọi lượt thắng của 1 Page phải xếp hàng trên cùng 1 dòng (và chung
+khóa ghi với dashboard NestJS đang đọc các cột này).
+
+Giờ transaction hóa đơn chỉ ghi bảng invoice, còn delta thống kê được cộng
+trong RAM và flush mỗi TENANT_STATS_FLUSH_INTERVAL giây bằng 1 UPDATE cộng dồn
+cho mỗi tenant (tất cả trong 1 transaction). Dashboard thấy số liệu trễ tối đa
+vài giây; delta còn trong RAM được flush nốt khi shutdown.
+"""
+
+import asyncio
+import atexit
+import logging
+import threading
+from typing import Dict, List
+
+from sqlalchemy import text
+
+from config import settings
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+_FLUSH_SQL = text("""
+    UPDATE tenant SET
+        totalSpins = COALESCE(totalSpins, 0) + :spins,
+        totalPrizes = COALESCE(totalPrizes, 0) + :prizes,
+        totalUsers = COALESCE(totalUsers, 0) + :users
+    WHERE id = :page_id
+""")
+
+
+class TenantStatsAggregator:
+    """
+    Args:
+        flush_interval: Chu kỳ flush xuống DB (giây)
+    """
+
+    def __init__(self, flush_interval: float = 2.0):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # page_id -> [spins, prizes, users]
+        self._pending: Dict[str, List[int]] = {}
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.errors = 0
+
+    def record(self, page_id: str, spins: int = 1, prizes: int = 1, users: int = 1):
+        """Cộng delta cho tenant (O(1), không chạm DB)"""
+        with self._lock:
+            delta = self._pending.get(page_id)
+            if delta is None:
+                self._pending[page_id] = [spins, prizes, users]
+            else:
+                delta[0] += spins
+                delta[1] += prizes
+                delta[2] += users
+
+    def flush(self) -> int:
+        """
+        Ghi toàn bộ delta đang chờ trong 1 transaction.
+        Lỗi thì trả delta về hàng chờ để lần sau ghi lại.
+
+        Returns:
+            Số tenant đã cập nhật
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        params = [
+            {"page_id": page_id, "spins": d[0], "prizes": d[1], "users": d[2]}
+            for page_id, d in pending.items()
+        ]
+        db = SessionLocal()
+        try:
+            db.execute(_FLUSH_SQL, params)
+            db.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ [Tenant Stats] Lỗi flush thống kê ({len(params)} tenant): {e}")
+            db.rollback()
+            with self._lock:
+                self.errors += 1
+                for page_id, d in pending.items():
+                    current = self._pending.setdefault(page_id, [0, 0, 0])
+                    for i in range(3):
+                        current[i] += d[i]
+            return 0
+        finally:
+            db.close()
+
+        with self._lock:
+            self.flushes += 1
+            self.rows_flushed += len(params)
+        return len(params)
+
+    async def run_flush_loop(self):
+        """Vòng flush chạy nền (khởi động trong lifespan của FastAPI)"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.to_thread(self.flush)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "flush_interval": self.flush_interval,
+                "pending_tenants": len(self._pending),
+                "flushes": self.flushes,
+                "rows_flushed": self.rows_flushed,
+                "errors": self.errors,
+            }
+
+
+# Dùng chung toàn process
+tenant_stats = TenantStatsAggregator(flush_interval=settings.tenant_stats_flush_interval)
+# Script chạy ngoài FastAPI (test_webhook.py...) không có vòng flush -> flush khi thoát
+atexit.register(tenant_stats.flush)
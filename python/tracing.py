@@ -0,0 +1,399 @@
+"""
+File: tracing.py
+Mục đích: Trace từng invoice qua LangGraph workflow để biết bước nào chậm
+
+Shop phàn nàn "bot trả lời mất 2 phút" -> tra theo message mid:
+    python tracing.py view --mid m_AbCdEf...
+    python tracing.py view --slowest 5
+
+- Trace ID suy ra từ Messenger mid + id của invoice job (sha256 -> 32 ký tự
+  hex, đúng định dạng OTLP): 1 tin nhắn nhiều ảnh là nhiều job -> mỗi ảnh 1
+  trace riêng; lần JobQueue thử lại cùng job thì cùng trace ID. mid được giữ
+  trong attribute "messenger.mid" (view --mid lọc theo attribute này).
+  Tin không có mid thì dùng ID ngẫu nhiên.
+- process_invoice_* mở span gốc "invoice", mỗi node đăng ký trong
+  create_invoice_graph được bọc bởi trace_node() ghi span con: start, end,
+  outcome (error nếu node raise hoặc trả về state có "error").
+- Span được gom trong RAM theo trace (vài span/invoice, rất rẻ), đến khi
+  invoice xong mới quyết định ghi hay bỏ:
+  * Ghi theo tỉ lệ TRACE_SAMPLE_RATE (quyết định theo trace ID, ổn định giữa các lần thử lại)
+  * Luôn ghi trace lỗi và trace chậm hơn TRACE_SLOW_SECONDS (tail sampling),
+    nên các ca khách phàn nàn hầu như luôn có trace
+- Sink: file JSONL, mỗi dòng là 1 ExportTraceServiceRequest dạng OTLP/JSON
+  (đọc được bằng receiver otlpjsonfile của OpenTelemetry Collector)
+
+File vượt TRACE_MAX_BYTES thì được đổi tên thành <file>.1 (chỉ giữ 1 bản cũ).
+Mặc định TẮT (TRACE_PATH rỗng). Trong Docker đặt TRACE_PATH trên volume data
+(VD /app/data/traces.jsonl); TRACE_SAMPLE_RATE=0 và TRACE_SLOW_SECONDS=0 cũng tắt hẳn.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Trace của invoice đang xử lý (đặt bởi process_invoice_*), để log gắn trace_id
+current_trace: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_trace", default=None)
+
+# Status code của span theo OTLP
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def trace_id_for(message_id: Optional[str] = None, job_id: Optional[int] = None) -> str:
+    """Trace ID 32 ký tự hex: suy ra từ mid (+ job id) nếu có, ngẫu nhiên nếu không"""
+    if message_id:
+        key = message_id if job_id is None else f"{message_id}:{job_id}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+    return uuid.uuid4().hex
+
+
+def _span_id() -> str:
+    return os.urandom(8).hex()
+
+
+def _attributes(values: Dict[str, Any]) -> List[dict]:
+    return [
+        {"key": key, "value": {"stringValue": str(value)}}
+        for key, value in values.items()
+        if value is not None
+    ]
+
+
+class _Trace:
+    """Trace đang mở: span gốc + các span con đã xong"""
+
+    __slots__ = ("trace_id", "root_span_id", "name", "attributes", "start_ns", "spans")
+
+    def __init__(self, trace_id: str, name: str, attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.root_span_id = _span_id()
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.spans: List[dict] = []
+
+
+class Tracer:
+    """
+    Args:
+        path: File JSONL nhận trace, rỗng = tắt
+        sample_rate: Tỉ lệ trace bình thường được ghi (0..1)
+        slow_seconds: Trace lâu hơn ngưỡng này luôn được ghi (0 = tắt)
+        max_bytes: Kích thước file tối đa trước khi xoay vòng sang <path>.1
+        max_active: Số trace đang mở tối đa (trace bị bỏ dở do crash không làm rò RAM)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float = 0.1,
+        slow_seconds: float = 30,
+        max_bytes: int = 100 * 1024 * 1024,
+        max_active: int = 10000,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        self.slow_seconds = slow_seconds
+        self.max_active = max_active
+        self.enabled = bool(path) and (self.sample_rate > 0 or slow_seconds > 0)
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._active: "OrderedDict[str, _Trace]" = OrderedDict()
+        self.started = 0
+        self.written = 0
+        self.dropped = 0
+
+    def sampled(self, trace_id: str) -> bool:
+        """Quyết định head sampling theo trace ID (ổn định giữa các lần thử lại)"""
+        return int(trace_id[:8], 16) / 0xFFFFFFFF < self.sample_rate
+
+    # ========================================
+    # GHI SPAN
+    # ========================================
+
+    def start(self, trace_id: str, name: str = "invoice", attributes: Optional[Dict[str, Any]] = None):
+        """Mở span gốc cho 1 lần xử lý invoice"""
+        if not self.enabled or not trace_id:
+            return
+        trace = _Trace(trace_id, name, attributes or {})
+        with self._lock:
+            self._active[trace_id] = trace
+            self._active.move_to_end(trace_id)
+            while len(self._active) > self.max_active:
+                self._active.popitem(last=False)
+                self.dropped += 1
+            self.started += 1
+
+    def record_span(
+        self,
+        trace_id: Optional[str],
+        name: str,
+        start_ns: int,
+        end_ns: int,
+        error: Optional[str] = None,
+        **attributes,
+    ):
+        """Ghi 1 span con đã xong vào trace đang mở (bỏ qua nếu trace không mở)"""
+        if not trace_id:
+            return
+        trace = self._active.get(trace_id)
+        if trace is None:
+            return
+        span = {
+            "traceId": trace_id,
+            "spanId": _span_id(),
+            "parentSpanId": trace.root_span_id,
+            "name": name,
+            "kind": 1,
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(end_ns),
+            "attributes": _attributes(attributes),
+            "status": {"code": STATUS_ERROR, "message": error[:300]} if error else {"code": STATUS_OK},
+        }
+        # list.append là atomic, không cần lock
+        trace.spans.append(span)
+
+    def finish(self, trace_id: Optional[str], error: Optional[str] = None) -> bool:
+        """
+        Đóng span gốc, ghi trace ra file nếu được sample / lỗi / chậm.
+
+        Returns:
+            True nếu trace được ghi
+        """
+        if not trace_id:
+            return False
+        with self._lock:
+            trace = self._active.pop(trace_id, None)
+        if trace is None:
+            return False
+
+        end_ns = time.time_ns()
+        failed = error is not None or any(s["status"]["code"] == STATUS_ERROR for s in trace.spans)
+        slow = self.slow_seconds > 0 and (end_ns - trace.start_ns) / 1e9 >= self.slow_seconds
+        if not (failed or slow or self.sampled(trace_id)):
+            return False
+
+        root = {
+            "traceId": trace_id,
+            "spanId": trace.root_span_id,
+            "name": trace.name,
+            "kind": 1,
+            "startTimeUnixNano": str(trace.start_ns),
+            "endTimeUnixNano": str(end_ns),
+            "attributes": _attributes(trace.attributes),
+            "status": {"code": STATUS_ERROR, "message": error[:300]} if error else {"code": STATUS_OK},
+        }
+        self._write([root] + trace.spans)
+        return True
+
+    def _write(self, spans: List[dict]):
+        line = json.dumps(
+            {
+                "resourceSpans": [{
+                    "resource": {"attributes": _attributes({"service.name": "invoice-bot"})},
+                    "scopeSpans": [{"scope": {"name": "invoice-graph"}, "spans": spans}],
+                }]
+            },
+            ensure_ascii=False,
+        )
+        try:
+            with self._write_lock:
+                if self.max_bytes > 0 and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            with self._lock:
+                self.written += 1
+        except OSError as e:
+            logger.warning(f"⚠️ [Tracing] Không ghi được trace vào {self.path}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "sample_rate": self.sample_rate,
+                "slow_seconds": self.slow_seconds,
+                "active": len(self._active),
+                "started": self.started,
+                "written": self.written,
+                "dropped": self.dropped,
+            }
+
+
+# Dùng chung toàn process
+tracer = Tracer(
+    path=settings.trace_path,
+    sample_rate=settings.trace_sample_rate,
+    slow_seconds=settings.trace_slow_seconds,
+    max_bytes=settings.trace_max_bytes,
+)
+
+
+def _node_error(result: Any) -> Optional[str]:
+    # Phần lớn node tự bắt lỗi và trả về {"error": ...} thay vì raise
+    if isinstance(result, dict) and result.get("error"):
+        return str(result["error"])
+    return None
+
+
+def trace_node(name: str, fn: Callable) -> Callable:
+    """Bọc 1 node LangGraph: ghi span (start, end, outcome) vào trace của state["trace_id"]"""
+    if not tracer.enabled:
+        return fn
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(state, *args, **kwargs):
+            start_ns = time.time_ns()
+            try:
+                result = await fn(state, *args, **kwargs)
+            except BaseException as e:
+                tracer.record_span(state.get("trace_id"), name, start_ns, time.time_ns(),
+                                   f"{type(e).__name__}: {e}", node=name, page_id=state.get("page_id"))
+                raise
+            tracer.record_span(state.get("trace_id"), name, start_ns, time.time_ns(),
+                               _node_error(result), node=name, page_id=state.get("page_id"))
+            return result
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(state, *args, **kwargs):
+        start_ns = time.time_ns()
+        try:
+            result = fn(state, *args, **kwargs)
+        except BaseException as e:
+            tracer.record_span(state.get("trace_id"), name, start_ns, time.time_ns(),
+                               f"{type(e).__name__}: {e}", node=name, page_id=state.get("page_id"))
+            raise
+        tracer.record_span(state.get("trace_id"), name, start_ns, time.time_ns(),
+                           _node_error(result), node=name, page_id=state.get("page_id"))
+        return result
+
+    return wrapper
+
+
+# ========================================
+# WATERFALL VIEWER (CLI)
+# ========================================
+
+def load_traces(path: str) -> List[List[dict]]:
+    """Đọc file JSONL, mỗi phần tử là list span của 1 trace (span gốc đứng đầu)"""
+    traces = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                payload = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            spans = [
+                span
+                for resource in payload.get("resourceSpans", [])
+                for scope in resource.get("scopeSpans", [])
+                for span in scope.get("spans", [])
+            ]
+            if spans:
+                traces.append(spans)
+    return traces
+
+
+def _attr(span: dict, key: str) -> Optional[str]:
+    for item in span.get("attributes", []):
+        if item.get("key") == key:
+            return item.get("value", {}).get("stringValue")
+    return None
+
+
+def _duration_ms(span: dict) -> float:
+    return (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e6
+
+
+def render_waterfall(spans: List[dict], width: int = 50) -> str:
+    """Vẽ waterfall dạng text cho 1 trace"""
+    root = spans[0]
+    t0 = int(root["startTimeUnixNano"])
+    total = max(int(root["endTimeUnixNano"]) - t0, 1)
+
+    lines = [
+        f"trace {root['traceId']}  mid={_attr(root, 'messenger.mid') or '-'}  "
+        f"page={_attr(root, 'page_id') or '-'}  total={_duration_ms(root):.0f}ms"
+    ]
+    children = sorted(spans[1:], key=lambda s: int(s["startTimeUnixNano"]))
+    for depth, span in [(0, root)] + [(1, s) for s in children]:
+        start = (int(span["startTimeUnixNano"]) - t0) / total
+        end = (int(span["endTimeUnixNano"]) - t0) / total
+        left = min(width - 1, int(start * width))
+        bar = max(1, int(round(end * width)) - left)
+        failed = span.get("status", {}).get("code") == STATUS_ERROR
+        label = ("  " * depth + span["name"])[:22]
+        lines.append(
+            f"  {label:<22} |{' ' * left}{('▓' if failed else '█') * bar:<{width - left}}| "
+            f"{_duration_ms(span):>9.1f}ms{'  ✗ ' + span['status'].get('message', '') if failed else ''}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Xem trace invoice dạng waterfall")
+    sub = parser.add_subparsers(dest="command", required=True)
+    view = sub.add_parser("view", help="In waterfall các trace")
+    view.add_argument("--path", default=settings.trace_path or None, help="File trace (mặc định TRACE_PATH)")
+    view.add_argument("--mid", help="Lọc theo Messenger message mid")
+    view.add_argument("--trace", help="Lọc theo trace ID")
+    view.add_argument("--page", help="Lọc theo page_id")
+    view.add_argument("--slowest", type=int, help="Chỉ in N trace chậm nhất")
+    view.add_argument("--last", type=int, default=10, help="In N trace gần nhất (mặc định 10)")
+    view.add_argument("--width", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    if not args.path:
+        print("❌ TRACE_PATH chưa được cấu hình, truyền --path <file trace>")
+        return 1
+    if not os.path.exists(args.path):
+        print(f"❌ Không tìm thấy file trace: {args.path}")
+        return 1
+
+    traces = load_traces(args.path)
+    if args.mid:
+        traces = [t for t in traces if _attr(t[0], "messenger.mid") == args.mid]
+    if args.trace:
+        traces = [t for t in traces if t[0]["traceId"] == args.trace]
+    if args.page:
+        traces = [t for t in traces if _attr(t[0], "page_id") == args.page]
+
+    if args.slowest:
+        traces = sorted(traces, key=lambda t: _duration_ms(t[0]), reverse=True)[:args.slowest]
+    elif not args.trace and not args.mid:
+        traces = traces[-args.last:]
+
+    if not traces:
+        print("Không có trace nào khớp")
+        return 1
+    for spans in traces:
+        print(render_waterfall(spans, args.width))
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -49,7 +49,7 @@ def update_token():
     try:
         cursor.execute("""
             UPDATE tenant 
-            SET access_token = ? 
+            SET access_token = ?, updated_at = CURRENT_TIMESTAMP
             WHERE id = ?
         """, (new_token, page_id))
         